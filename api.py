@@ -0,0 +1,273 @@
+"""
+Headless HTTP API for visual question answering
+
+Serves the same shared model and chat history as the Streamlit UI. Uploaded
+images are not chats: they are stored apart from the history and kept while
+in use (see API_IMAGE_TTL_SECONDS), and answers are only recorded into a chat
+when its session_id is passed. With API_ENABLED it starts inside the
+Streamlit process on API_PORT; it can also run on its own with `python api.py`.
+
+    POST /api/images                      upload an image (raw body or multipart "image")
+    POST /api/images/{image_id}/questions {"question": ...} or {"questions": [...]}, "stream": bool,
+                                          "session_id": optional chat to record the answers in
+    GET  /api/history?limit=N             most recent chat sessions
+    GET  /api/history/{session_id}        one chat session with its messages
+    GET  /api/health                      model state
+"""
+import asyncio
+import io
+import json
+import threading
+from typing import Dict, List, Optional
+from PIL import Image, UnidentifiedImageError
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+from config import (
+    API_HOST,
+    API_PORT,
+    API_REQUEST_TIMEOUT_SECONDS,
+    API_MAX_QUESTIONS,
+    MAX_CHAT_HISTORY,
+)
+from model.model import Model, ModelState
+from model.admission import CancelToken, ServerBusy
+from model.registry import ModelLease, ModelRegistry
+from services import ChatService, ImageService, Metrics, RetentionService
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class VqaApi:
+    def __init__(self, model: Model):
+        self.model = model
+        self.app = Starlette(routes=[
+            Route("/api/health", self.health, methods=["GET"]),
+            Route("/api/images", self.upload_image, methods=["POST"]),
+            Route("/api/images/{image_id}/questions", self.ask, methods=["POST"]),
+            Route("/api/history", self.history, methods=["GET"]),
+            Route("/api/history/{session_id}", self.session, methods=["GET"]),
+        ], exception_handlers={ApiError: self._error_response})
+
+    @staticmethod
+    async def _error_response(request: Request, exc: ApiError) -> JSONResponse:
+        return JSONResponse({'error': exc.message}, status_code=exc.status)
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(None, fn, *args),
+                timeout=API_REQUEST_TIMEOUT_SECONDS
+            )
+        except asyncio.TimeoutError:
+            raise ApiError(504, "Request timed out")
+
+    def _require_model(self) -> None:
+        if not self.model.is_model_loaded():
+            raise ApiError(503, f"Model is not ready ({self.model.state})")
+
+    async def health(self, request: Request) -> JSONResponse:
+        status = 200 if self.model.state == ModelState.READY else 503
+        return JSONResponse({'state': self.model.state}, status_code=status)
+
+    async def upload_image(self, request: Request) -> JSONResponse:
+        with Metrics.span("api.upload_image"):
+            content_type = request.headers.get('content-type', '')
+            image_name = request.query_params.get('name', 'api-upload')
+            if content_type.startswith('multipart/form-data'):
+                form = await request.form()
+                upload = form.get('image')
+                if upload is None or isinstance(upload, str):
+                    raise ApiError(400, "Missing multipart field 'image'")
+                data = await upload.read()
+                image_name = upload.filename or image_name
+            else:
+                data = await request.body()
+            if not data:
+                raise ApiError(400, "Empty image body")
+            return JSONResponse(await self._run(self._store_image, data, image_name), status_code=201)
+
+    def _store_image(self, data: bytes, image_name: str) -> Dict:
+        try:
+            image = ImageService.preprocess(Image.open(io.BytesIO(data)))
+        except (UnidentifiedImageError, OSError):
+            raise ApiError(400, "Body is not a supported image")
+        image_hash = ImageService.content_hash(image)
+        ImageService.save_image(image, ImageService.api_ref(image_hash), image_hash)
+        if self.model.is_model_loaded():
+            self.model.prefetch_encoding(image, image_hash)
+        return {'image_id': image_hash, 'name': image_name}
+
+    def _encode(self, image_id: str):
+        if ImageService.content_hash_for_path(image_id) != image_id:
+            raise ApiError(404, f"Unknown image id {image_id}")
+        image = ImageService.load_image(ImageService.blob_path(image_id))
+        if image is None:
+            raise ApiError(404, f"Unknown image id {image_id}")
+        ImageService.mark_used(image_id)
+        encoding = self.model.encode_image(image, image_id)
+        if encoding is None:
+            raise ApiError(500, "Failed to encode image")
+        return encoding
+
+    @staticmethod
+    def _parse_questions(payload: Dict) -> List[str]:
+        questions = payload.get('questions')
+        if questions is None and 'question' in payload:
+            questions = [payload['question']]
+        if not isinstance(questions, list) or not questions:
+            raise ApiError(400, "Provide 'question' or a non-empty 'questions' list")
+        if len(questions) > API_MAX_QUESTIONS:
+            raise ApiError(400, f"At most {API_MAX_QUESTIONS} questions per request")
+        if not all(isinstance(q, str) and q.strip() for q in questions):
+            raise ApiError(400, "Questions must be non-empty strings")
+        return [q.strip() for q in questions]
+
+    async def ask(self, request: Request):
+        self._require_model()
+        image_id = request.path_params['image_id']
+        try:
+            payload = await request.json()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            raise ApiError(400, "Body must be JSON")
+        if not isinstance(payload, dict):
+            raise ApiError(400, "Body must be a JSON object")
+        questions = self._parse_questions(payload)
+        session_id = payload.get('session_id')
+
+        encoding = await self._run(self._encode, image_id)
+        if payload.get('stream'):
+            return StreamingResponse(
+                self._stream_answers(encoding, questions, session_id),
+                media_type="application/x-ndjson"
+            )
+
+        tokens = [CancelToken(API_REQUEST_TIMEOUT_SECONDS) for _ in questions]
+        try:
+            with Metrics.span("api.ask"):
+                answers = await asyncio.gather(*(
+                    self._run(self.model.get_answer, encoding, question, None, token)
+                    for question, token in zip(questions, tokens)
+                ))
+        except ServerBusy:
+            raise ApiError(503, "Server is busy, retry later")
+        finally:
+            # Covers timeouts and clients that hang up mid-request.
+            for token in tokens:
+                token.cancel()
+        results = [{'question': q, 'answer': a} for q, a in zip(questions, answers)]
+        if session_id:
+            await self._run(self._record, session_id, results)
+        return JSONResponse({'image_id': image_id, 'results': results})
+
+    async def _stream_answers(self, encoding, questions: List[str], session_id: Optional[str]):
+        loop = asyncio.get_running_loop()
+        results = []
+        for question in questions:
+            chunks = asyncio.Queue()
+            done = object()
+            busy = object()
+            token = CancelToken(API_REQUEST_TIMEOUT_SECONDS)
+
+            def produce():
+                try:
+                    for chunk in self.model.stream_answer(encoding, question, token=token):
+                        loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+                except ServerBusy:
+                    loop.call_soon_threadsafe(chunks.put_nowait, busy)
+                finally:
+                    loop.call_soon_threadsafe(chunks.put_nowait, done)
+
+            threading.Thread(target=produce, name="api-stream", daemon=True).start()
+            parts = []
+            deadline = loop.time() + API_REQUEST_TIMEOUT_SECONDS
+            try:
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.get(), timeout=max(deadline - loop.time(), 0))
+                    except asyncio.TimeoutError:
+                        yield json.dumps({'question': question, 'error': "timeout"}) + "\n"
+                        return
+                    if chunk is busy:
+                        yield json.dumps({'question': question, 'error': "busy"}) + "\n"
+                        return
+                    if chunk is done:
+                        break
+                    parts.append(chunk)
+                    yield json.dumps({'question': question, 'token': chunk}) + "\n"
+            finally:
+                # Also reached when the client disconnects and the response
+                # generator is closed.
+                token.cancel()
+            answer = ''.join(parts) or None
+            results.append({'question': question, 'answer': answer})
+            yield json.dumps({'question': question, 'answer': answer, 'done': True}) + "\n"
+        if session_id:
+            await loop.run_in_executor(None, self._record, session_id, results)
+
+    @staticmethod
+    def _record(session_id: str, results: List[Dict]) -> None:
+        session = ChatService.get_session(session_id)
+        if session is None:
+            return
+        for result in results:
+            if result['answer'] is not None:
+                ChatService.add_message(session, result['question'], result['answer'])
+        ChatService.save_session(session)
+
+    async def history(self, request: Request) -> JSONResponse:
+        try:
+            limit = int(request.query_params.get('limit', MAX_CHAT_HISTORY))
+        except ValueError:
+            raise ApiError(400, "limit must be an integer")
+        sessions = await self._run(ChatService.recent_sessions, min(max(limit, 0), MAX_CHAT_HISTORY))
+        return JSONResponse({'sessions': sessions})
+
+    async def session(self, request: Request) -> JSONResponse:
+        session = await self._run(ChatService.get_session, request.path_params['session_id'])
+        if session is None:
+            raise ApiError(404, "Unknown session id")
+        return JSONResponse(session)
+
+
+_server_lock = threading.Lock()
+_server_thread: Optional[threading.Thread] = None
+_server_lease: Optional[ModelLease] = None
+
+
+def start_api_server(host: str = API_HOST, port: int = API_PORT) -> threading.Thread:
+    """Serve the API from a background thread of the current process (idempotent).
+
+    The server holds its own model lease for the life of the process.
+    """
+    import uvicorn
+
+    global _server_thread, _server_lease
+    with _server_lock:
+        if _server_thread is None:
+            _server_lease = ModelRegistry.acquire()
+            app = VqaApi(_server_lease.model).app
+            server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+            _server_thread = threading.Thread(target=server.run, name="vqa-api", daemon=True)
+            _server_thread.start()
+        return _server_thread
+
+
+def main():
+    import uvicorn
+
+    lease = ModelRegistry.acquire()
+    Metrics.start_exporter()
+    RetentionService.start()
+    uvicorn.run(VqaApi(lease.model).app, host=API_HOST, port=API_PORT)
+
+
+if __name__ == "__main__":
+    main()
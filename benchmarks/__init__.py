@@ -0,0 +1,4 @@
+"""
+Offline benchmark suite for ChatMoonVLM
+Runs without network or GPU by using a deterministic stub model
+"""
@@ -0,0 +1,18 @@
+"""
+Streamlit script used by the page-render benchmark through AppTest.
+
+It installs the stub model as the shared registry model before main.py is
+imported, so the real application code runs end to end against it.
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.fake_model import make_fake_model
+from model.registry import ModelRegistry
+
+if ModelRegistry.shared_model() is None:
+    ModelRegistry._shared_model = make_fake_model(prefill_latency=0.005, token_latency=0.001)
+
+import main
+
+main.main()
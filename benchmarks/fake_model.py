@@ -0,0 +1,78 @@
+"""
+Deterministic stand-in for the moondream HF model.
+
+It implements the encode_image/query/caption/detect surface that model.Model
+relies on and sleeps for a configurable amount of synthetic time, so the
+application code around it can be measured without network access or a GPU.
+"""
+import hashlib
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+from PIL import Image
+from model.model import Model, ModelState
+
+
+@dataclass
+class FakeEncodedImage:
+    pos: int
+    digest: str
+
+
+class FakeMoondream:
+    def __init__(self, encode_latency: float = 0.0, prefill_latency: float = 0.0,
+                 token_latency: float = 0.0, answer_tokens: int = 16):
+        self.encode_latency = encode_latency
+        self.prefill_latency = prefill_latency
+        self.token_latency = token_latency
+        self.answer_tokens = answer_tokens
+        self.encode_calls = 0
+        self.query_calls = 0
+
+    def encode_image(self, image):
+        if isinstance(image, FakeEncodedImage):
+            return image
+        if not isinstance(image, Image.Image):
+            raise ValueError("expected a PIL image")
+        self.encode_calls += 1
+        time.sleep(self.encode_latency)
+        digest = hashlib.sha256(image.resize((16, 16)).tobytes()).hexdigest()
+        return FakeEncodedImage(pos=730, digest=digest)
+
+    def _tokens(self, image: FakeEncodedImage, question: str):
+        seed = hashlib.sha256(f"{image.digest}|{question}".encode()).hexdigest()
+        for i in range(self.answer_tokens):
+            yield f" {seed[(2 * i) % 64:(2 * i) % 64 + 2]}"
+
+    def _generate(self, image: FakeEncodedImage, question: str):
+        time.sleep(self.prefill_latency)
+        for token in self._tokens(image, question):
+            time.sleep(self.token_latency)
+            yield token
+
+    def query(self, image, question: str, stream: bool = False, settings: Optional[Dict] = None, **kwargs):
+        image = self.encode_image(image)
+        self.query_calls += 1
+        if stream:
+            return {'answer': self._generate(image, question)}
+        return {'answer': ''.join(self._generate(image, question)).strip()}
+
+    def caption(self, image, length: str = "normal", stream: bool = False, settings: Optional[Dict] = None):
+        return {'caption': self.query(image, f"caption:{length}", stream=stream, settings=settings)['answer']}
+
+    def detect(self, image, label: str, settings: Optional[Dict] = None):
+        image = self.encode_image(image)
+        self.query_calls += 1
+        time.sleep(self.prefill_latency)
+        count = int(hashlib.sha256(f"{image.digest}|{label}".encode()).hexdigest(), 16) % 3
+        return {'objects': [
+            {'x_min': 0.1 * i, 'y_min': 0.1 * i, 'x_max': 0.1 * i + 0.2, 'y_max': 0.1 * i + 0.2} for i in range(count)
+        ]}
+
+
+def make_fake_model(**latencies) -> Model:
+    """Build a ready model.Model backed by FakeMoondream."""
+    model = Model()
+    model.model = FakeMoondream(**latencies)
+    model.state = ModelState.READY
+    return model
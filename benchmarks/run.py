@@ -0,0 +1,299 @@
+"""
+Run the offline benchmark suite and print machine-readable results.
+
+    python -m benchmarks.run --output bench.json
+    python -m benchmarks.run --only model history --quick
+
+All file I/O happens in a temporary working directory, so the relative
+data/ paths from config.py never touch the real chat history or images.
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable, Dict, List
+from PIL import Image
+
+from benchmarks.fake_model import make_fake_model
+from config import PAGE_CHAT
+from services import ChatService, ImageService
+from services.history_store import JsonHistoryStore, SqliteHistoryStore
+
+
+def measure(fn: Callable[[], object], repeat: int, warmup: int = 1) -> Dict:
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return {
+        'repeat': repeat,
+        'mean_ms': 1000 * statistics.fmean(samples),
+        'median_ms': 1000 * statistics.median(samples),
+        'p95_ms': 1000 * samples[math.ceil(len(samples) * 0.95) - 1],
+        'min_ms': 1000 * samples[0],
+    }
+
+
+@contextlib.contextmanager
+def temp_workdir():
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="chatmoon-bench-") as workdir:
+        os.chdir(workdir)
+        ChatService.set_store(None)
+        try:
+            yield workdir
+        finally:
+            ChatService.set_store(None)
+            os.chdir(previous)
+
+
+def make_image(seed: int, size=(1024, 768)) -> Image.Image:
+    image = Image.new("RGB", size, ((seed * 37) % 256, (seed * 91) % 256, (seed * 13) % 256))
+    image.putpixel((seed % size[0], 0), (255, 255, 255))
+    return image
+
+
+def make_session(i: int, messages: int) -> Dict:
+    return {
+        'id': f"2025-01-01T00:00:{i:06d}",
+        'timestamp': '2025-01-01 00:00:00',
+        'image_name': f"photo_{i % 50}.jpg",
+        'image_path': f"data/images/{i:064x}.webp",
+        'chat_name': f"photo_{i % 50} {i}" if i >= 50 else f"photo_{i}",
+        'messages': [
+            {'question': f"question {m}", 'answer': "answer " * 20, 'timestamp': '00:00:00'}
+            for m in range(messages)
+        ],
+    }
+
+
+def bench_model(repeat: int) -> List[Dict]:
+    results = []
+    image = make_image(1)
+    for batching in (False, True):
+        model = make_fake_model()
+        if batching:
+            model.enable_batching(8, 0)
+        encoding = model.encode_image(image)
+        results.append({
+            'name': 'model.get_answer',
+            'params': {'batching': batching},
+            'stats': measure(lambda: model.get_answer(encoding, "What is this?"), repeat),
+        })
+        results.append({
+            'name': 'model.stream_answer',
+            'params': {'batching': batching},
+            'stats': measure(lambda: list(model.stream_answer(encoding, "What is this?")), repeat),
+        })
+    model = make_fake_model()
+    results.append({
+        'name': 'model.encode_image',
+        'params': {'source': 'pil'},
+        'stats': measure(lambda: model.encode_image(image), repeat),
+    })
+    return results
+
+
+def bench_history(repeat: int, sizes: List[int], messages: int) -> List[Dict]:
+    results = []
+    for backend in ('json', 'sqlite'):
+        for size in sizes:
+            with temp_workdir():
+                if backend == 'json':
+                    store = JsonHistoryStore("data/chat_history.json")
+                else:
+                    store = SqliteHistoryStore("data/chat_history.db")
+                history = [make_session(i, messages) for i in range(size)]
+                store.replace_all(history)
+                ChatService.set_store(store)
+                params = {'backend': backend, 'sessions': size, 'messages': messages}
+
+                results.append({
+                    'name': 'history.load_all',
+                    'params': params,
+                    'stats': measure(ChatService.load_history, repeat),
+                })
+                results.append({
+                    'name': 'history.recent_sessions',
+                    'params': params,
+                    'stats': measure(lambda: ChatService.recent_sessions(10), repeat),
+                })
+                results.append({
+                    'name': 'history.session_summaries',
+                    'params': params,
+                    'stats': measure(lambda: ChatService.session_summaries(10), repeat),
+                })
+
+                session = history[-1]
+                counter = iter(range(10 ** 9))
+
+                def append_one():
+                    ChatService.add_message(session, f"follow up {next(counter)}", "answer")
+                    store.upsert_session(session)
+
+                results.append({
+                    'name': 'history.save_message',
+                    'params': params,
+                    'stats': measure(append_one, repeat),
+                })
+                results.append({
+                    'name': 'history.generate_chat_name',
+                    'params': params,
+                    'stats': measure(
+                        lambda: ChatService.generate_chat_name(make_session(size, 0), history), repeat
+                    ),
+                })
+    return results
+
+
+def bench_images(repeat: int) -> List[Dict]:
+    results = []
+    with temp_workdir():
+        raw = make_image(2, size=(4032, 3024))
+        counter = iter(range(10 ** 9))
+        results.append({
+            'name': 'image.preprocess',
+            'params': {'size': list(raw.size)},
+            'stats': measure(lambda: ImageService.preprocess(raw), repeat),
+        })
+        image = ImageService.preprocess(raw)
+
+        def save_new():
+            path = ImageService.save_image(make_image(next(counter), size=image.size), "bench")
+            ImageService.wait_for_write(path)
+
+        results.append({
+            'name': 'image.save_image',
+            'params': {'size': list(image.size), 'dedup': False},
+            'stats': measure(save_new, repeat),
+        })
+        path = ImageService.save_image(image, "bench")
+        ImageService.wait_for_write(path)
+        results.append({
+            'name': 'image.save_image',
+            'params': {'size': list(image.size), 'dedup': True},
+            'stats': measure(lambda: ImageService.save_image(image, "bench"), repeat),
+        })
+        results.append({
+            'name': 'image.load_image',
+            'params': {'size': list(image.size)},
+            'stats': measure(lambda: ImageService.load_image(path).load(), repeat),
+        })
+    return results
+
+
+def bench_page(turns: int) -> List[Dict]:
+    from streamlit.testing.v1 import AppTest
+
+    app_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app_session.py")
+    with temp_workdir():
+        image = ImageService.preprocess(make_image(3))
+        session = ChatService.create_session("bench.jpg")
+        session['chat_name'] = "bench"
+        session['image_path'] = ImageService.save_image(image, session['id'])
+        ImageService.wait_for_write(session['image_path'])
+        ChatService.save_session(session)
+
+        at = AppTest.from_file(app_script, default_timeout=120)
+        at.session_state['page'] = PAGE_CHAT
+        at.session_state['current_chat_session'] = session
+        at.session_state['uploaded_image'] = image
+        at.session_state['chat_messages'] = []
+
+        started = time.perf_counter()
+        at.run()
+        first_render = time.perf_counter() - started
+
+        samples = []
+        for turn in range(turns):
+            started = time.perf_counter()
+            at.chat_input[0].set_value(f"Question number {turn}?").run()
+            samples.append(time.perf_counter() - started)
+        if at.exception:
+            raise RuntimeError(f"app raised: {at.exception}")
+        if len(at.session_state['chat_messages']) != turns:
+            raise RuntimeError("scripted chat session did not record every turn")
+
+    samples.sort()
+    return [
+        {'name': 'page.chat_first_render', 'params': {}, 'stats': {'repeat': 1, 'mean_ms': 1000 * first_render}},
+        {
+            'name': 'page.chat_turn',
+            'params': {'turns': turns},
+            'stats': {
+                'repeat': turns,
+                'mean_ms': 1000 * statistics.fmean(samples),
+                'median_ms': 1000 * statistics.median(samples),
+                'p95_ms': 1000 * samples[math.ceil(len(samples) * 0.95) - 1],
+                'min_ms': 1000 * samples[0],
+            },
+        },
+    ]
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stderr=subprocess.DEVNULL,
+            text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+SUITES = ('model', 'history', 'images', 'page')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline ChatMoonVLM benchmarks.")
+    parser.add_argument('--only', nargs='+', choices=SUITES, default=list(SUITES))
+    parser.add_argument('--quick', action='store_true', help="Fewer repeats and smaller history sizes")
+    parser.add_argument('--output', default=None, help="Write results as JSON to this path instead of stdout")
+    args = parser.parse_args()
+
+    repeat = 5 if args.quick else 30
+    sizes = [100, 1000] if args.quick else [100, 1000, 10000]
+
+    results = []
+    if 'model' in args.only:
+        results += bench_model(repeat * 10)
+    if 'history' in args.only:
+        results += bench_history(repeat, sizes, messages=10)
+    if 'images' in args.only:
+        results += bench_images(repeat)
+    if 'page' in args.only:
+        results += bench_page(turns=repeat)
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': datetime.now().isoformat(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
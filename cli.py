@@ -0,0 +1,227 @@
+"""
+Bulk offline VQA over a directory or manifest of images
+
+    python cli.py images/ --questions questions.txt --output results.jsonl
+    python cli.py --manifest manifest.txt --questions questions.json --output results.jsonl
+
+Images are decoded and preprocessed on a worker pool, encoded once each, and
+every question for an image is answered from that single encoding through the
+batching scheduler. Results are appended to the output as JSON lines as soon
+as they finish; rerunning the same command skips (image, question) pairs that
+already have an answer, so an interrupted run resumes where it stopped.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Set, Tuple
+from PIL import Image
+from config import (
+    SUPPORTED_IMAGE_TYPES,
+    MAX_BATCH_SIZE,
+    MAX_BATCH_WAIT_MS,
+    MODEL_PRECISION,
+    TORCH_NUM_THREADS,
+    ENCODING_CACHE_ENABLED,
+)
+from model.model import Model
+from model.admission import CancelToken, ServerBusy
+from model.encoding_cache import get_encoding_cache
+from services import ImageService
+
+# A busy model is retried with exponential backoff; after BUSY_MAX_RETRIES
+# the question is written as failed and redone by the next run.
+BUSY_RETRY_SECONDS = 0.05
+BUSY_RETRY_MAX_SECONDS = 5.0
+BUSY_MAX_RETRIES = 12
+
+
+def iter_directory(root: str) -> Iterator[Tuple[str, str]]:
+    extensions = {f".{ext}" for ext in SUPPORTED_IMAGE_TYPES}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() in extensions:
+                path = os.path.join(dirpath, filename)
+                yield os.path.relpath(path, root), path
+
+
+def iter_manifest(manifest: str) -> Iterator[Tuple[str, str]]:
+    base_dir = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('{'):
+                entry = json.loads(line)
+                path = entry['path']
+                image_id = entry.get('id', path)
+            else:
+                path = image_id = line
+            yield image_id, path if os.path.isabs(path) else os.path.join(base_dir, path)
+
+
+def load_questions(path: str) -> List[str]:
+    with open(path, 'r') as f:
+        content = f.read()
+    if path.endswith('.json'):
+        questions = json.loads(content)
+    else:
+        questions = [line.strip() for line in content.splitlines()]
+    return [q for q in questions if q]
+
+
+def load_completed(output: str) -> Set[Tuple[str, str]]:
+    completed = set()
+    if not os.path.exists(output):
+        return completed
+    with open(output, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by an interruption is simply redone.
+                continue
+            if record.get('answer') is not None:
+                completed.add((record['image_id'], record['question']))
+    return completed
+
+
+class JsonlWriter:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+        self.written = 0
+        self.failed = 0
+
+    def write(self, record: Dict) -> None:
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            self.written += 1
+            if record.get('answer') is None:
+                self.failed += 1
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def decode(path: str):
+    with Image.open(path) as image:
+        image = ImageService.preprocess(image)
+        image.load()
+    return image, ImageService.content_hash(image)
+
+
+def run(model: Model, images: Iterator[Tuple[str, str]], questions: List[str], output: str,
+        decode_workers: int, max_inflight: int) -> JsonlWriter:
+    completed = load_completed(output)
+    writer = JsonlWriter(output)
+    inflight = threading.BoundedSemaphore(max_inflight)
+    decode_pool = ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="decode")
+    answer_pool = ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix="answer")
+
+    def answer(image_id: str, path: str, encoding, question: str):
+        try:
+            started = time.perf_counter()
+            result = None
+            delay = BUSY_RETRY_SECONDS
+            for attempt in range(BUSY_MAX_RETRIES + 1):
+                try:
+                    # No deadline: the interactive one would expire requests
+                    # still queued behind the rest of the in-flight window.
+                    result = model.get_answer(encoding, question, token=CancelToken(None))
+                    break
+                except ServerBusy:
+                    if attempt < BUSY_MAX_RETRIES:
+                        time.sleep(delay)
+                        delay = min(delay * 2, BUSY_RETRY_MAX_SECONDS)
+            writer.write({
+                'image_id': image_id,
+                'path': path,
+                'question': question,
+                'answer': result,
+                'seconds': round(time.perf_counter() - started, 4),
+            })
+        finally:
+            inflight.release()
+
+    def submit_image(image_id: str, path: str, todo: List[str], decoded) -> None:
+        try:
+            image, image_hash = decoded.result()
+            encoding = model.encode_image(image, image_hash)
+        except Exception as e:
+            encoding, error = None, repr(e)
+        else:
+            error = None if encoding is not None else "encode failed"
+        if encoding is None:
+            for question in todo:
+                writer.write({'image_id': image_id, 'path': path, 'question': question, 'answer': None, 'error': error})
+            return
+        for question in todo:
+            inflight.acquire()
+            answer_pool.submit(answer, image_id, path, encoding, question)
+
+    # Keep a bounded window of images decoding ahead of the encoder.
+    window = deque()
+    try:
+        for image_id, path in images:
+            todo = [q for q in questions if (image_id, q) not in completed]
+            if not todo:
+                continue
+            window.append((image_id, path, todo, decode_pool.submit(decode, path)))
+            if len(window) > decode_workers * 2:
+                submit_image(*window.popleft())
+        while window:
+            submit_image(*window.popleft())
+    finally:
+        answer_pool.shutdown(wait=True)
+        decode_pool.shutdown(wait=True)
+        writer.close()
+    return writer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a fixed set of questions over many images.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('image_dir', nargs='?', help="Directory searched recursively for images")
+    source.add_argument('--manifest', help="File with one image path per line, or JSON lines with 'path' and optional 'id'")
+    parser.add_argument('--questions', required=True, help="Text file with one question per line, or a .json list")
+    parser.add_argument('--output', required=True, help="JSONL file results are appended to")
+    parser.add_argument('--decode-workers', type=int, default=max(1, min(4, os.cpu_count() or 1)))
+    parser.add_argument('--batch-size', type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument('--max-wait-ms', type=float, default=MAX_BATCH_WAIT_MS)
+    parser.add_argument('--precision', default=MODEL_PRECISION)
+    parser.add_argument('--threads', type=int, default=TORCH_NUM_THREADS)
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions)
+    if not questions:
+        parser.error("the questions file is empty")
+    images = iter_manifest(args.manifest) if args.manifest else iter_directory(args.image_dir)
+
+    model = Model()
+    model.load_model(precision=args.precision, num_threads=args.threads)
+    if not model.is_model_loaded():
+        print(f"Failed to load the model: {model.load_error!r}", file=sys.stderr)
+        sys.exit(1)
+    if ENCODING_CACHE_ENABLED:
+        model.attach_encoding_cache(get_encoding_cache())
+    scheduler = model.enable_batching(args.batch_size, args.max_wait_ms)
+
+    started = time.perf_counter()
+    writer = run(model, images, questions, args.output, args.decode_workers, max(2 * args.batch_size, 1))
+    elapsed = time.perf_counter() - started
+    print(
+        f"Wrote {writer.written} answers ({writer.failed} failed) in {elapsed:.1f}s. {scheduler.report()}",
+        file=sys.stderr
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,155 @@
 CHAT_HISTORY_FILE = "data/chat_history.json"
+CHAT_HISTORY_DB = "data/chat_history.db"
+HISTORY_BACKEND = "sqlite"
 IMAGE_STORAGE_DIR = "data/images"
+IMAGE_REFS_FILE = "data/images/refs.json"
+IMAGE_MAX_SIDE = 1344
+IMAGE_STORAGE_FORMAT = "WEBP"
+IMAGE_STORAGE_QUALITY = 90
+# The stored blob is also what the model encodes when a chat is reopened, so
+# it is written losslessly; IMAGE_STORAGE_QUALITY then sets compression effort.
+IMAGE_STORAGE_LOSSLESS = True
+# Smaller lossy copy written next to each blob for the chat page to show.
+IMAGE_DISPLAY_MAX_SIDE = 768
+IMAGE_DISPLAY_QUALITY = 80
+IMAGE_WRITE_WORKERS = 2
 
 MAX_CHAT_HISTORY = 10
+# Storage quotas, enforced by the background retention sweep.
+HISTORY_MAX_BYTES = 64 * 1024 * 1024
+IMAGE_STORAGE_MAX_BYTES = 1024 * 1024 * 1024
+RETENTION_ENABLED = True
+RETENTION_INTERVAL_SECONDS = 300
+# Files younger than this are never treated as orphans, since an upload is
+# stored before its chat session is saved.
+RETENTION_ORPHAN_GRACE_SECONDS = 3600
+# Messages rendered per page in the chat view; older ones load on demand.
+MESSAGES_PAGE_SIZE = 20
 SUPPORTED_IMAGE_TYPES = ["jpg", "jpeg", "png"]
+# Multi-frame chats: frames sampled from a video (decoded with PyAV) or an
+# animated GIF, or several images uploaded together.
+SUPPORTED_VIDEO_TYPES = ["mp4", "mov", "webm", "mkv", "avi", "gif"]
+# Shortest gap between sampled frames; longer clips are sampled more sparsely
+# so that FRAME_MAX_COUNT samples span the whole clip.
+FRAME_SAMPLE_SECONDS = 1.0
+FRAME_MAX_COUNT = 16
+# dHash bits (of 64) a frame may differ from the last kept frame and still be
+# skipped as a near-duplicate.
+FRAME_DEDUP_MAX_DISTANCE = 6
+FRAME_ENCODE_BATCH_SIZE = 4
+# A question about a clip is answered frame by frame, so the whole set gets
+# its own deadline instead of INFERENCE_REQUEST_TIMEOUT_SECONDS.
+FRAME_ANSWER_TIMEOUT_SECONDS = 600
 
 PAGE_MAIN = "main"
 PAGE_CHAT = "chat"
 
 MODEL_ID = "vikhyatk/moondream2"
 MODEL_REVISION = "2025-06-21"
+MODEL_WARMUP = True
+MODEL_PRECISION = "float32"
+TORCH_NUM_THREADS = None
+
+# Written by `python -m model.model_installer`; load_model falls back to the
+# hub when no verified bundle for the current precision is present.
+MODEL_BUNDLE_DIR = "models/moondream2"
+MODEL_USE_BUNDLE = True
+
+MODEL_STATUS_POLL_SECONDS = 1.0
+# A failed shared model is loaded again after this delay, doubling on every
+# consecutive failure up to the maximum.
+MODEL_LOAD_RETRY_SECONDS = 5.0
+MODEL_LOAD_RETRY_MAX_SECONDS = 300.0
+
+SHARE_MODEL_ACROSS_SESSIONS = True
+UNLOAD_MODEL_WHEN_UNUSED = False
+
+# Off by default: the pinned moondream revision has no batched forward, so a
+# batch runs its queries back to back and the wait window only adds latency.
+# Worth enabling with a worker pool, where a batch fans out across workers.
+BATCHING_ENABLED = False
+MAX_BATCH_SIZE = 8
+MAX_BATCH_WAIT_MS = 20
+
+ENCODING_CACHE_ENABLED = True
+ENCODING_CACHE_DIR = "data/encodings"
+ENCODING_CACHE_MEMORY_BYTES = 512 * 1024 * 1024
+ENCODING_CACHE_DISK_BYTES = 4 * 1024 * 1024 * 1024
+
+STREAMING_ENABLED = True
+
+PREFETCH_ENABLED = True
+PREFETCH_WORKERS = 1
+# Finished prefetches held for their chat when the encoding cache is disabled.
+PREFETCH_MAX_RESULTS = 4
+
+# max_tokens is the per-answer generation budget. 768 is moondream's own
+# default, so answers are as long as without it; lowering it bounds the time a
+# request can hold the model but cuts long answers short, and since settings
+# are part of the answer cache key, any change starts that cache afresh.
+# Without a temperature the model samples with its own default; set
+# "temperature": 0.0 for greedy, repeatable answers, which is also what lets
+# the answer cache serve them.
+GENERATION_SETTINGS = {"max_tokens": 768}
+
+# Requests admitted at once (queued or generating); beyond this callers get
+# ServerBusy instead of waiting. Each request is dropped once its deadline passes.
+INFERENCE_MAX_PENDING = 32
+INFERENCE_REQUEST_TIMEOUT_SECONDS = 120
+ANSWER_POLL_SECONDS = 0.5
+
+# Computed in the background when a chat starts, from the image encoding the
+# chat will use anyway: a caption (also the answer to DESCRIBE_QUESTION), the
+# main objects and a few suggested questions with their answers.
+INSIGHTS_ENABLED = True
+INSIGHTS_WORKERS = 1
+INSIGHTS_MAX_OBJECTS = 5
+# Objects confirmed and counted with detect; the rest are listed uncounted.
+INSIGHTS_MAX_DETECTIONS = 2
+INSIGHTS_SUGGESTED_QUESTIONS = 3
+# Insights are background work: before each model call they wait, polling at
+# this interval, until no other request is admitted.
+INSIGHTS_YIELD_SECONDS = 0.1
+# Insights not finished within this, waiting included, are dropped.
+INSIGHTS_TIMEOUT_SECONDS = 600
+DESCRIBE_QUESTION = "Describe this image."
+INSIGHTS_POLL_SECONDS = 2.0
+
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_ALLOW_SAMPLING = False
+ANSWER_CACHE_MAX_ENTRIES = 10000
+ANSWER_CACHE_TTL_SECONDS = 7 * 24 * 3600
+ANSWER_CACHE_FILE = "data/answer_cache.json"
+ANSWER_CACHE_FLUSH_SECONDS = 5
+
+# Keep each chat's KV cache (image prefix plus earlier turns) between questions
+# so follow-ups only prefill the new question.
+CHAT_CONTEXT_ENABLED = True
+CHAT_CONTEXT_MAX_BYTES = 1024 * 1024 * 1024
+CHAT_CONTEXT_IDLE_SECONDS = 15 * 60
+CHAT_CONTEXT_MAX_HISTORY_TOKENS = 1024
+
+METRICS_ENABLED = True
+# One JSON log line per span; meant for debugging, as it logs every stage of every request.
+METRICS_LOG_SPANS = False
+METRICS_FILE = "data/metrics.prom"
+METRICS_FILE_INTERVAL_SECONDS = 15
+METRICS_PORT = None
+
+API_ENABLED = False
+API_HOST = "0.0.0.0"
+API_PORT = 8502
+API_REQUEST_TIMEOUT_SECONDS = 120
+API_MAX_QUESTIONS = 20
+# Images uploaded through the API are not chats: they are kept apart from the
+# history and dropped when unused for API_IMAGE_TTL_SECONDS or beyond the
+# API_IMAGE_MAX_COUNT most recently used.
+API_IMAGE_MAX_COUNT = 100
+API_IMAGE_TTL_SECONDS = 24 * 3600
+
+INFERENCE_WORKERS = 0
+WORKER_SHM_BYTES = 512 * 1024 * 1024
+WORKER_MAX_ENCODINGS = 64
+WORKER_HEALTH_INTERVAL_SECONDS = 5
+WORKER_HEALTH_TIMEOUT_SECONDS = 30
+WORKER_REQUEST_TIMEOUT_SECONDS = 300
@@ -1,9 +1,19 @@
+import time
 import streamlit as st
 from ui.main_page import MainPage
 from ui.chat_page import ChatPage
-from config import PAGE_MAIN, PAGE_CHAT
-from model.model import Model
-import time
+from config import PAGE_MAIN, PAGE_CHAT, MODEL_STATUS_POLL_SECONDS, API_ENABLED
+from model.model import ModelState
+from model.registry import ModelRegistry
+from services.metrics import Metrics
+from services.retention_service import RetentionService
+
+Metrics.start_exporter()
+RetentionService.start()
+ModelRegistry.preload()
+if API_ENABLED:
+    from api import start_api_server
+    start_api_server()
 
 def init_session_state():
     if 'page' not in st.session_state:
@@ -13,23 +23,34 @@ def init_session_state():
 def main():
     init_session_state()
     
-    if 'model' not in st.session_state:
-        st.session_state.model = Model()
-        st.session_state.model.load_model()
+    if 'model_lease' not in st.session_state:
+        st.session_state.model_lease = ModelRegistry.acquire()
     
-    model = st.session_state.model
+    model = st.session_state.model_lease.model
     
-    if model.is_model_loaded():
-        if st.session_state.page == PAGE_MAIN:
-            MainPage.render()
-        elif st.session_state.page == PAGE_CHAT:
-            ChatPage.render(model)
-        else:
-            st.session_state.page = PAGE_MAIN
-            MainPage.render()
-    else:
+    if model.state == ModelState.FAILED:
         st.error("Please be sure that the model is installed.")
         st.stop()
+    
+    with Metrics.span("streamlit.rerun", page=st.session_state.page):
+        if model.is_model_loaded():
+            if st.session_state.page == PAGE_MAIN:
+                MainPage.render(model)
+            elif st.session_state.page == PAGE_CHAT:
+                ChatPage.render(model)
+            else:
+                st.session_state.page = PAGE_MAIN
+                MainPage.render(model)
+        else:
+            st.info("The model is loading in the background, this may take some time...")
+            if st.session_state.page == PAGE_CHAT:
+                ChatPage.apply_common_styles()
+            else:
+                MainPage.render(model)
+    
+    if not model.is_model_loaded():
+        time.sleep(MODEL_STATUS_POLL_SECONDS)
+        st.rerun()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+from config import INFERENCE_REQUEST_TIMEOUT_SECONDS
+
+
+class ServerBusy(RuntimeError):
+    """Raised instead of queueing when INFERENCE_MAX_PENDING requests are already admitted."""
+
+
+class RequestCancelled(RuntimeError):
+    pass
+
+
+class DeadlineExceeded(RequestCancelled):
+    pass
+
+
+class CancelToken:
+    """Cooperative cancellation and deadline for one inference request.
+
+    The requester calls cancel() when it no longer wants the answer; the
+    scheduler and the generation loops call check() between steps.
+    """
+
+    __slots__ = ('deadline', '_cancelled')
+
+    def __init__(self, timeout: Optional[float] = INFERENCE_REQUEST_TIMEOUT_SECONDS):
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self._cancelled = threading.Event()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def remaining(self) -> Optional[float]:
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    def check(self) -> None:
+        if self._cancelled.is_set():
+            raise RequestCancelled("Request was cancelled")
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise DeadlineExceeded("Request deadline passed")
+
+
+class AdmissionController:
+    """Bounds the number of inference requests admitted at once, queued or running."""
+
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+        self.rejected = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def admit(self):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                # Imported here because the services package imports this
+                # module, so a module-level import would be circular.
+                from services.metrics import Metrics
+
+                self.rejected += 1
+                Metrics.inc("chatmoon_admission_rejected_total")
+                raise ServerBusy(f"{self._pending} requests already pending")
+            self._pending += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._pending
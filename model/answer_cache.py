@@ -0,0 +1,146 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+from services.metrics import Metrics
+from config import (
+    MODEL_REVISION,
+    ANSWER_CACHE_ALLOW_SAMPLING,
+    ANSWER_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_TTL_SECONDS,
+    ANSWER_CACHE_FILE,
+    ANSWER_CACHE_FLUSH_SECONDS,
+)
+
+
+def normalize_question(question: str) -> str:
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip("?.! ")
+
+
+class AnswerCache:
+    """LRU + TTL memo of answers for (image, question, revision, settings).
+
+    When persist_path is set, entries are written back to a JSON file at most
+    once every flush_seconds instead of on every insert.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, persist_path: Optional[str] = None,
+                 flush_seconds: float = 5.0, allow_sampling: bool = False):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.persist_path = persist_path
+        self.flush_seconds = flush_seconds
+        self.allow_sampling = allow_sampling
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._flush_timer = None
+        self._load()
+
+    def enabled_for(self, settings: Dict) -> bool:
+        # A missing temperature means the model's default, which samples.
+        return self.allow_sampling or settings.get('temperature') == 0
+
+    @staticmethod
+    def make_key(image_key: str, question: str, settings: Dict) -> str:
+        settings_tag = json.dumps(settings, sort_keys=True)
+        return f"{image_key}|{MODEL_REVISION}|{settings_tag}|{normalize_question(question)}"
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                Metrics.inc("chatmoon_cache_requests_total", cache="answer", result="miss")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            Metrics.inc("chatmoon_cache_requests_total", cache="answer", result="hit")
+            return entry[0]
+
+    def put(self, key: str, answer: str) -> None:
+        with self._lock:
+            self._entries[key] = (answer, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._schedule_flush()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def _load(self) -> None:
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, 'r') as f:
+                entries = json.load(f)
+        except (json.JSONDecodeError, IOError):
+            return
+        if not isinstance(entries, list):
+            return
+        now = time.time()
+        for entry in entries:
+            try:
+                key, answer, created_at = entry
+                fresh = now - created_at <= self.ttl_seconds
+            except (TypeError, ValueError):
+                continue
+            if fresh and isinstance(key, str) and isinstance(answer, str):
+                self._entries[key] = (answer, created_at)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _schedule_flush(self) -> None:
+        if not self.persist_path or self._flush_timer is not None:
+            return
+        self._flush_timer = threading.Timer(self.flush_seconds, self.flush)
+        self._flush_timer.daemon = True
+        self._flush_timer.start()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_timer = None
+            if not self.persist_path:
+                return
+            entries = [[key, answer, created_at] for key, (answer, created_at) in self._entries.items()]
+        with self._flush_lock:
+            os.makedirs(os.path.dirname(self.persist_path) or '.', exist_ok=True)
+            tmp_path = f"{self.persist_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.persist_path)
+
+
+_shared_cache: Optional[AnswerCache] = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache:
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = AnswerCache(
+                ANSWER_CACHE_MAX_ENTRIES,
+                ANSWER_CACHE_TTL_SECONDS,
+                ANSWER_CACHE_FILE,
+                ANSWER_CACHE_FLUSH_SECONDS,
+                ANSWER_CACHE_ALLOW_SAMPLING,
+            )
+        return _shared_cache
@@ -0,0 +1,80 @@
+"""
+Local model bundle layout and verification.
+
+model_installer writes the bundle; Model.load_model reads from it when a
+verified bundle for the requested dtype exists.
+
+    <MODEL_BUNDLE_DIR>/source/        verified snapshot of MODEL_ID@MODEL_REVISION
+    <MODEL_BUNDLE_DIR>/<dtype>/       weights re-saved as safetensors in that dtype
+    <MODEL_BUNDLE_DIR>/<dtype>/manifest.json
+"""
+import hashlib
+import json
+import os
+from typing import Dict, Optional
+from config import MODEL_ID, MODEL_REVISION, MODEL_BUNDLE_DIR
+
+MANIFEST_NAME = "manifest.json"
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_dir() -> str:
+    return os.path.join(MODEL_BUNDLE_DIR, "source")
+
+
+def dtype_dir(dtype_name: str) -> str:
+    return os.path.join(MODEL_BUNDLE_DIR, dtype_name)
+
+
+def write_manifest(directory: str, dtype_name: str) -> Dict:
+    files = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, directory)
+            if rel == MANIFEST_NAME:
+                continue
+            files[rel] = {'sha256': sha256_file(path), 'size': os.path.getsize(path)}
+    manifest = {
+        'model_id': MODEL_ID,
+        'revision': MODEL_REVISION,
+        'dtype': dtype_name,
+        'files': files,
+    }
+    with open(os.path.join(directory, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def verify_bundle(directory: str, dtype_name: str, full: bool = False) -> bool:
+    """Check a materialized bundle against its manifest.
+
+    The default check compares file sizes only, which is cheap enough for every
+    start; full=True re-hashes every file.
+    """
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return False
+    if (manifest.get('model_id'), manifest.get('revision'), manifest.get('dtype')) != (MODEL_ID, MODEL_REVISION, dtype_name):
+        return False
+    for rel, info in manifest.get('files', {}).items():
+        path = os.path.join(directory, rel)
+        if not os.path.isfile(path) or os.path.getsize(path) != info['size']:
+            return False
+        if full and sha256_file(path) != info['sha256']:
+            return False
+    return True
+
+
+def local_bundle(dtype_name: str) -> Optional[str]:
+    directory = dtype_dir(dtype_name)
+    return directory if verify_bundle(directory, dtype_name) else None
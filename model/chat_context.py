@@ -0,0 +1,141 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+from model.encoding_cache import encoding_nbytes
+from services.metrics import Metrics
+from config import CHAT_CONTEXT_MAX_BYTES, CHAT_CONTEXT_IDLE_SECONDS
+
+
+class ChatContext:
+    """KV state of one chat: the image prefix plus the turns answered so far.
+
+    The image prefix is shared with the image encoding, so only the per-turn
+    part of the cache (positions base.pos to pos) is held here.
+    """
+
+    __slots__ = ('base', 'base_key', 'pos', 'turns', 'last_used', 'nbytes')
+
+    def __init__(self, base, base_key, pos: Optional[int] = None, turns=None):
+        self.base = base
+        self.base_key = base_key
+        self.pos = base.pos if pos is None else pos
+        self.turns = turns
+        self.last_used = time.time()
+        self.nbytes = encoding_nbytes(turns) if turns is not None else 0
+
+    @property
+    def history_tokens(self) -> int:
+        return self.pos - self.base.pos
+
+    def load_into(self, inner) -> None:
+        inner._load_encoded_image(self.base)
+        if self.turns is None:
+            return
+        start = self.base.pos
+        for block, (k, v) in zip(inner.text.blocks, self.turns):
+            block.kv_cache.k_cache[:, :, start:self.pos, :] = k
+            block.kv_cache.v_cache[:, :, start:self.pos, :] = v
+
+    def extended(self, inner, pos: int) -> 'ChatContext':
+        """Snapshot the turn positions now sitting in the module's KV cache."""
+        start = self.base.pos
+        turns = [
+            (
+                block.kv_cache.k_cache[:, :, start:pos, :].clone(),
+                block.kv_cache.v_cache[:, :, start:pos, :].clone(),
+            )
+            for block in inner.text.blocks
+        ]
+        return ChatContext(self.base, self.base_key, pos, turns)
+
+
+class ChatContextStore:
+    """Per-chat KV contexts, bounded by total bytes and dropped after idling."""
+
+    def __init__(self, max_bytes: int, idle_seconds: float):
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._contexts = OrderedDict()
+        self._bytes = 0
+
+    def get(self, chat_id: str) -> Optional[ChatContext]:
+        with self._lock:
+            self._evict_idle()
+            context = self._contexts.get(chat_id)
+            if context is None:
+                self.misses += 1
+                Metrics.inc("chatmoon_cache_requests_total", cache="chat_context", result="miss")
+                return None
+            self._contexts.move_to_end(chat_id)
+            context.last_used = time.time()
+            self.hits += 1
+            Metrics.inc("chatmoon_cache_requests_total", cache="chat_context", result="hit")
+            return context
+
+    def put(self, chat_id: str, context: ChatContext) -> None:
+        with self._lock:
+            self._drop(chat_id)
+            if context.nbytes > self.max_bytes:
+                return
+            self._contexts[chat_id] = context
+            self._bytes += context.nbytes
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._contexts))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def discard(self, chat_id: str) -> None:
+        with self._lock:
+            self._drop(chat_id)
+
+    def evict_idle(self) -> None:
+        with self._lock:
+            self._evict_idle()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._evict_idle()
+            return {
+                'chats': len(self._contexts),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _evict_idle(self) -> None:
+        cutoff = time.time() - self.idle_seconds
+        for chat_id in [c for c, context in self._contexts.items() if context.last_used < cutoff]:
+            self._drop(chat_id)
+            self.evictions += 1
+
+    def _drop(self, chat_id: str) -> None:
+        context = self._contexts.pop(chat_id, None)
+        if context is not None:
+            self._bytes -= context.nbytes
+
+
+_shared_store: Optional[ChatContextStore] = None
+_shared_store_lock = threading.Lock()
+
+
+def _sweep_idle(store: ChatContextStore) -> None:
+    while True:
+        time.sleep(max(1.0, store.idle_seconds / 4))
+        store.evict_idle()
+
+
+def get_chat_context_store() -> ChatContextStore:
+    global _shared_store
+    with _shared_store_lock:
+        if _shared_store is None:
+            _shared_store = ChatContextStore(CHAT_CONTEXT_MAX_BYTES, CHAT_CONTEXT_IDLE_SECONDS)
+            threading.Thread(
+                target=_sweep_idle, args=(_shared_store,), name="chat-context-sweeper", daemon=True
+            ).start()
+        return _shared_store
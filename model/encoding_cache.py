@@ -0,0 +1,258 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import fields, is_dataclass
+from typing import List, Optional, Tuple, Union
+from PIL import Image
+from services.metrics import Metrics
+from config import (
+    MODEL_ID,
+    MODEL_REVISION,
+    ENCODING_CACHE_DIR,
+    ENCODING_CACHE_MEMORY_BYTES,
+    ENCODING_CACHE_DISK_BYTES,
+)
+
+
+def content_hash(image: Union[str, Image.Image]) -> str:
+    digest = hashlib.sha256()
+    if isinstance(image, str):
+        with open(image, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    else:
+        digest.update(f"{image.mode}:{image.size}".encode())
+        digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def encoding_nbytes(value) -> int:
+    import torch
+
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, (list, tuple)):
+        return sum(encoding_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(encoding_nbytes(v) for v in value.values())
+    if is_dataclass(value):
+        return sum(encoding_nbytes(getattr(value, f.name)) for f in fields(value))
+    return 0
+
+
+class EncodingCache:
+    """Two-tier LRU of image encodings, keyed by image content and model revision.
+
+    The memory tier holds live objects; the disk tier holds torch files that are
+    memory-mapped on load, so a hit after a restart does not copy the tensors.
+    """
+
+    def __init__(self, cache_dir: str, memory_limit: int, disk_limit: int):
+        self.cache_dir = cache_dir
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._scan_disk()
+
+    @staticmethod
+    def model_tag(dtype_name: str = "float32", source: str = "hub") -> str:
+        # Encodings pickle classes from the remote-code module, whose path
+        # differs between hub and bundle loads, and their tensors carry the
+        # load dtype, so both are part of the tag.
+        return hashlib.sha256(f"{MODEL_ID}@{MODEL_REVISION}/{dtype_name}/{source}".encode()).hexdigest()[:16]
+
+    @staticmethod
+    def key_for(image: Union[str, Image.Image], image_hash: Optional[str] = None, tag: Optional[str] = None) -> str:
+        return f"{tag or EncodingCache.model_tag()}-{image_hash or content_hash(image)}"
+
+    def _path_for(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def _scan_disk(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pt'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name[:-3], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+    def get(self, key: str):
+        self._check_key(key)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                Metrics.inc("chatmoon_cache_requests_total", cache="encoding", result="memory_hit")
+                return self._memory[key][0]
+            on_disk = key in self._disk
+
+        if not on_disk:
+            Metrics.inc("chatmoon_cache_requests_total", cache="encoding", result="miss")
+            return None
+
+        import torch
+
+        path = self._path_for(key)
+        try:
+            value = torch.load(path, mmap=True, weights_only=False)
+            os.utime(path)
+        except Exception:
+            # Truncated files and pickles of classes that no longer import
+            # (another model revision or load source) would fail on every
+            # lookup, so the entry is dropped along with its file.
+            with self._lock:
+                self._disk_bytes -= self._disk.pop(key, 0)
+            self._remove_files([key])
+            Metrics.inc("chatmoon_cache_requests_total", cache="encoding", result="miss")
+            return None
+
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            self._put_memory(key, value)
+        Metrics.inc("chatmoon_cache_requests_total", cache="encoding", result="disk_hit")
+        return value
+
+    def put(self, key: str, value) -> None:
+        self._check_key(key)
+        with self._lock:
+            self._put_memory(key, value)
+            if key in self._disk:
+                return
+
+        import torch
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path_for(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            torch.save(value, tmp_path)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except (OSError, RuntimeError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self._lock:
+            self._disk_bytes += size - self._disk.get(key, 0)
+            self._disk[key] = size
+            victims = self._pop_disk_victims()
+        self._remove_files(victims)
+
+    @staticmethod
+    def _check_key(key: str) -> None:
+        # A missing key would otherwise be stored as "None.pt" and shared by
+        # every image encoded without one.
+        if not key:
+            raise ValueError("Encoding cache key is required")
+
+    def _put_memory(self, key: str, value) -> None:
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        size = encoding_nbytes(value)
+        if size > self.memory_limit:
+            return
+        self._memory[key] = (value, size)
+        self._memory_bytes += size
+        while self._memory_bytes > self.memory_limit:
+            _, (_, evicted_size) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted_size
+
+    def _pop_disk_victims(self) -> List[str]:
+        # Called with the lock held; the files are removed after it is released.
+        victims = []
+        while self._disk_bytes > self.disk_limit and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            victims.append(key)
+        return victims
+
+    def _remove_files(self, keys: List[str]) -> None:
+        for key in keys:
+            try:
+                os.remove(self._path_for(key))
+            except OSError:
+                pass
+
+    def sweep(self, grace_seconds: float, tag: Optional[str] = None) -> Tuple[int, int]:
+        """Reconcile the disk tier with the directory and enforce disk_limit.
+
+        Other processes (inference workers, the CLI) write to the same
+        directory, so the index kept in memory drifts. Stale temp files are
+        deleted, and so are entries not under tag (those of another model
+        revision, dtype or load source) when it is given. Returns
+        (files removed, bytes removed).
+        """
+        if not os.path.isdir(self.cache_dir):
+            return 0, 0
+        cutoff = time.time() - grace_seconds
+        removed, reclaimed = 0, 0
+        # The directory is scanned and files are deleted without the lock, so
+        # lookups and inserts only wait for the index to be swapped.
+        on_disk = {}
+        for entry in os.scandir(self.cache_dir):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            stale_tmp = entry.name.endswith('.tmp') and stat.st_mtime < cutoff
+            other_revision = entry.name.endswith('.pt') and tag is not None and not entry.name.startswith(f"{tag}-")
+            if stale_tmp or other_revision:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    continue
+                removed += 1
+                reclaimed += stat.st_size
+            elif entry.name.endswith('.pt'):
+                on_disk[entry.name[:-3]] = (stat.st_mtime, stat.st_size)
+
+        # Disk hits touch the file, so mtime order is LRU order across
+        # every process sharing the directory.
+        disk = OrderedDict(
+            (key, size) for key, (_, size) in sorted(on_disk.items(), key=lambda item: item[1][0])
+        )
+        with self._lock:
+            self._disk = disk
+            self._disk_bytes = sum(disk.values())
+            before = self._disk_bytes
+            victims = self._pop_disk_victims()
+            reclaimed += before - self._disk_bytes
+        self._remove_files(victims)
+        return removed + len(victims), reclaimed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'disk_entries': len(self._disk),
+                'disk_bytes': self._disk_bytes,
+            }
+
+
+_shared_cache: Optional[EncodingCache] = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_encoding_cache() -> EncodingCache:
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = EncodingCache(ENCODING_CACHE_DIR, ENCODING_CACHE_MEMORY_BYTES, ENCODING_CACHE_DISK_BYTES)
+        return _shared_cache
@@ -1,52 +1,636 @@
 from config import MODEL_ID, MODEL_REVISION
-from transformers import AutoModelForCausalLM
 from PIL import Image
-import torch
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from model.scheduler import InferenceScheduler
+from model.encoding_cache import EncodingCache
+from model.answer_cache import AnswerCache
+from model.chat_context import ChatContext, ChatContextStore
+from model.admission import AdmissionController, CancelToken, DeadlineExceeded, RequestCancelled, ServerBusy
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from config import PREFETCH_WORKERS, PREFETCH_MAX_RESULTS, GENERATION_SETTINGS, MODEL_PRECISION, TORCH_NUM_THREADS
+from config import FRAME_ANSWER_TIMEOUT_SECONDS
+from config import CHAT_CONTEXT_MAX_HISTORY_TOKENS, CHAT_CONTEXT_IDLE_SECONDS, MODEL_USE_BUNDLE, INFERENCE_MAX_PENDING, DESCRIBE_QUESTION
+from model.precision import apply_precision, configure_threads, dtype_name_for, torch_dtype_for
+from model.bundle import local_bundle
+from services.metrics import Metrics
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+
+@contextmanager
+def _counting_calls(obj, name: str) -> Iterator[List[int]]:
+    """Count calls to obj.name while the block runs; the count is the list's only item."""
+    method = getattr(obj, name)
+    calls = [0]
+
+    def counted(*args, **kwargs):
+        calls[0] += 1
+        return method(*args, **kwargs)
+
+    setattr(obj, name, counted)
+    try:
+        yield calls
+    finally:
+        delattr(obj, name)
+
+
+def _process_uptime() -> Optional[float]:
+    """Seconds since this process started, for cold-start time-to-ready."""
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class ImageEncoding:
+    """Opaque handle for an encoded image, returned by Model.encode_image."""
+
+    __slots__ = ('_data', '_model_id', 'key')
+
+    def __init__(self, data, model_id: int, key: Optional[str] = None):
+        self._data = data
+        self._model_id = model_id
+        self.key = key
+
+
+class ModelState:
+    NOT_LOADED = "not_loaded"
+    LOADING = "loading"
+    READY = "ready"
+    FAILED = "failed"
+
 
 class Model:
     def __init__(self):
         self.model = None
-        self.enc_image = None
+        self.state = ModelState.NOT_LOADED
+        self.load_error = None
+        # Moondream keeps its KV cache on the module itself, so every call that
+        # touches the torch model has to hold this lock.
+        self._inference_lock = threading.Lock()
+        self.scheduler = None
+        self.encoding_cache = None
+        # Set from the dtype and source the weights were loaded with.
+        self.encoding_tag = EncodingCache.model_tag(dtype_name_for(MODEL_PRECISION))
+        self.answer_cache = None
+        self.context_store = None
+        # Turns answered without generation, per chat, waiting to be prefilled
+        # by that chat's next in-context question: (base key, turns, queued at).
+        self._pending_turns = OrderedDict()
+        self._turns_lock = threading.Lock()
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="encode-prefetch")
+        self._prefetch_lock = threading.Lock()
+        self._inflight_encodings = {}
+        # Finished prefetches kept for encode_image when there is no encoding
+        # cache to hold them.
+        self._prefetched = OrderedDict()
+        self.admission = AdmissionController(INFERENCE_MAX_PENDING)
+        self._answer_pool = ThreadPoolExecutor(max_workers=INFERENCE_MAX_PENDING, thread_name_prefix="answer")
     
-    def load_model(self):
+    def load_model(self, warmup: bool = False, precision: str = MODEL_PRECISION, num_threads=TORCH_NUM_THREADS):
+        # transformers and torch are imported here so that importing this module
+        # stays cheap and the UI can render while the weights load.
+        started = time.perf_counter()
+        self.state = ModelState.LOADING
+        self.load_error = None
         try:
+            import torch
+            from transformers import AutoModelForCausalLM
+        except ImportError as e:
+            self.load_error = e
+            self.state = ModelState.FAILED
+            return
+
+        try:
+            configure_threads(num_threads)
+            dtype = torch_dtype_for(precision)
             use_cuda = torch.cuda.is_available() and (torch.version.cuda is not None)
             device_map = "auto" if use_cuda else "cpu"
 
-            self.model = AutoModelForCausalLM.from_pretrained(
-                MODEL_ID, 
-                revision=MODEL_REVISION,
-                trust_remote_code=True, 
-                device_map=device_map
-            )
-        except AssertionError:
-            self.model = AutoModelForCausalLM.from_pretrained(
-                MODEL_ID, 
-                revision=MODEL_REVISION,
-                trust_remote_code=True, 
-                device_map="cpu"
-            )
+            bundle = local_bundle(dtype_name_for(precision)) if MODEL_USE_BUNDLE else None
+            if bundle is not None:
+                # Pre-converted safetensors in the runtime dtype, memory-mapped
+                # straight from disk with no hub lookups.
+                source = {'pretrained_model_name_or_path': bundle, 'local_files_only': True}
+            else:
+                source = {'pretrained_model_name_or_path': MODEL_ID, 'revision': MODEL_REVISION}
+            source_label = "bundle" if bundle is not None else "hub"
+
+            with Metrics.span("model.from_pretrained", source=source_label):
+                try:
+                    self.model = AutoModelForCausalLM.from_pretrained(
+                        **source,
+                        trust_remote_code=True, 
+                        device_map=device_map,
+                        torch_dtype=dtype
+                    )
+                except AssertionError:
+                    self.model = AutoModelForCausalLM.from_pretrained(
+                        **source,
+                        trust_remote_code=True, 
+                        device_map="cpu",
+                        torch_dtype=dtype
+                    )
+            self.model = apply_precision(self.model, precision)
+            self.encoding_tag = EncodingCache.model_tag(dtype_name_for(precision), source_label)
         except Exception as e:
             self.model = None
+            self.load_error = e
+            Metrics.record_error("model.load_model", e)
+        if self.model is not None and warmup:
+            self.warmup()
+        self.state = ModelState.READY if self.model is not None else ModelState.FAILED
+        if self.model is not None:
+            Metrics.set_gauge("chatmoon_model_load_seconds", time.perf_counter() - started, source=source_label)
+            uptime = _process_uptime()
+            if uptime is not None:
+                Metrics.set_gauge("chatmoon_time_to_ready_seconds", uptime)
+
+    def warmup(self) -> None:
+        """Run one encode and query so lazy initialization happens before real traffic."""
+        if self.model is None:
+            return
+        image = Image.new("RGB", (378, 378), (127, 127, 127))
+        try:
+            # The encoding caches are bypassed so the blank image never ends
+            # up stored next to real ones.
+            with Metrics.span("model.warmup"):
+                with self._inference_lock:
+                    enc_image = self.model.encode_image(image)
+                self._answer_batch([(enc_image, DESCRIBE_QUESTION)])
+        except Exception as e:
+            Metrics.record_error("model.warmup", e)
     
+    def attach_encoding_cache(self, cache: EncodingCache) -> None:
+        self.encoding_cache = cache
+
+    def attach_answer_cache(self, cache: AnswerCache) -> None:
+        self.answer_cache = cache
+
+    def attach_context_store(self, store: ChatContextStore) -> None:
+        self.context_store = store
+
+    def enable_batching(self, max_batch_size: int, max_wait_ms: float) -> InferenceScheduler:
+        if self.scheduler is None:
+            self.scheduler = InferenceScheduler(self._answer_batch, max_batch_size, max_wait_ms)
+        return self.scheduler
+
     def is_model_loaded(self):
-        return self.model is not None
+        return self.model is not None and self.state == ModelState.READY
+
+    def encode_image(self, image: Union[str, Image.Image], image_hash: Optional[str] = None) -> Optional[ImageEncoding]:
+        try:
+            with Metrics.span("model.encode_image"):
+                if self.model is None:
+                    raise RuntimeError("Model not loaded")
+                key = self._encoding_key(image, image_hash)
+                with self._prefetch_lock:
+                    future = self._inflight_encodings.get(key) or self._prefetched.pop(key, None)
+                if future is not None and not future.cancelled():
+                    encoding = future.result()
+                    if encoding is not None:
+                        return encoding
+                return self._encode(image, key)
+        except Exception as e:
+            Metrics.record_error("model.encode_image", e)
+            return None
+
+    def encode_batch(self, images: List[Union[str, Image.Image]],
+                     image_hashes: Optional[List[Optional[str]]] = None) -> List[Optional[ImageEncoding]]:
+        """Encode several images as one admitted request, with None for any that fail.
+
+        The pinned moondream revision has no batched vision encoder, so each
+        image goes through encode_image and shares its caching and in-flight
+        prefetches. All None when the server is busy.
+        """
+        image_hashes = image_hashes or [None] * len(images)
+        try:
+            with Metrics.span("model.encode_batch"), self.admission.admit():
+                encodings = [self.encode_image(image, image_hash) for image, image_hash in zip(images, image_hashes)]
+        except ServerBusy:
+            return [None] * len(images)
+        Metrics.observe("chatmoon_encode_batch_size", len(images), buckets=(1, 2, 4, 8, 16, 32))
+        return encodings
+
+    def prefetch_encoding(self, image: Image.Image, image_hash: Optional[str] = None) -> Optional[Future]:
+        """Start encoding in the background; encode_image attaches to the result."""
+        if self.model is None:
+            return None
+        key = self._encoding_key(image, image_hash)
+        with self._prefetch_lock:
+            future = self._inflight_encodings.get(key)
+            if future is None:
+                future = self._prefetch_pool.submit(self._encode_quietly, image, key)
+                self._inflight_encodings[key] = future
+                future.add_done_callback(lambda f: self._forget_prefetch(key, f))
+            return future
+
+    def cancel_prefetch(self, future: Optional[Future]) -> None:
+        # A prefetch that already started runs to completion; its result then
+        # lives on in the encoding cache, where LRU eviction takes care of it,
+        # or is dropped here.
+        if future is None:
+            return
+        future.cancel()
+        with self._prefetch_lock:
+            for key, held in list(self._prefetched.items()):
+                if held is future:
+                    del self._prefetched[key]
+
+    def _forget_prefetch(self, key, future: Future) -> None:
+        with self._prefetch_lock:
+            if self._inflight_encodings.get(key) is not future:
+                return
+            del self._inflight_encodings[key]
+            if (self.encoding_cache is None and key is not None
+                    and not future.cancelled() and future.result() is not None):
+                self._prefetched[key] = future
+                while len(self._prefetched) > PREFETCH_MAX_RESULTS:
+                    self._prefetched.popitem(last=False)
+
+    def _encoding_key(self, image: Union[str, Image.Image], image_hash: Optional[str]) -> Optional[str]:
+        if self.encoding_cache is None and image_hash is None:
+            return None
+        return EncodingCache.key_for(image, image_hash, self.encoding_tag)
 
-    def encode_image(self,image_path: str):
+    def _encode_quietly(self, image: Union[str, Image.Image], key: Optional[str]) -> Optional[ImageEncoding]:
+        # Prefetch is speculative, so it takes an admission slot like any other
+        # request and is simply dropped when the server is busy.
         try:
-            if self.model is None:
-                raise RuntimeError("Model not loaded")
-            image = Image.open(image_path)
+            with Metrics.span("model.prefetch_encoding"), self.admission.admit():
+                return self._encode(image, key)
+        except ServerBusy:
+            Metrics.inc("chatmoon_prefetch_total", result="busy")
+            return None
+        except Exception:
+            return None
+
+    def _encode(self, image: Union[str, Image.Image], key: Optional[str]) -> ImageEncoding:
+        cache = self.encoding_cache if key is not None else None
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                return ImageEncoding(cached, id(self), key)
+        if isinstance(image, str):
+            image = Image.open(image)
+            image.load()
+        with self._inference_lock:
             enc_image = self.model.encode_image(image)
-            self.enc_image = enc_image
-        except:
-            self.enc_image = None
+        if cache is not None:
+            cache.put(key, enc_image)
+        return ImageEncoding(enc_image, id(self), key)
     
-    def get_answer(self, question: str):
+    def get_answer(self, encoding: Optional[ImageEncoding], question: str,
+                   context_id: Optional[str] = None, token: Optional[CancelToken] = None) -> Optional[str]:
+        """Answer a question, or None on failure, cancellation or an expired deadline.
+
+        Raises ServerBusy when INFERENCE_MAX_PENDING requests are already admitted.
+        """
+        token = token or CancelToken()
+        try:
+            with Metrics.span("model.get_answer"):
+                if self.model is None or encoding is None:
+                    raise RuntimeError("Model/image not ready")
+                if encoding._model_id != id(self):
+                    raise RuntimeError("Encoding belongs to a different model")
+                cache_key = self._answer_cache_key(encoding, question)
+                if cache_key is not None:
+                    cached = self.answer_cache.get(cache_key)
+                    if cached is not None:
+                        if context_id is not None:
+                            self.record_turn(context_id, encoding, question, cached)
+                        return cached
+                if context_id is not None and self._supports_context():
+                    # Context turns bypass the scheduler: each one runs against
+                    # its chat's own stored turns, which a batch cannot share.
+                    with self.admission.admit():
+                        return ''.join(self._stream_in_context(context_id, encoding, question, token, cache_key))
+                with self.admission.admit():
+                    if self.scheduler is not None:
+                        future = self.scheduler.submit(encoding._data, question, token)
+                        try:
+                            answer = future.result(timeout=token.remaining())
+                        except FutureTimeout:
+                            token.cancel()
+                            raise DeadlineExceeded("Request deadline passed")
+                    else:
+                        answer = self._answer_batch([(encoding._data, question)], [token])[0]
+                        if isinstance(answer, Exception):
+                            raise answer
+                if cache_key is not None:
+                    self.answer_cache.put(cache_key, answer)
+                return answer
+        except ServerBusy:
+            raise
+        except RequestCancelled:
+            return None
+        except Exception as e:
+            Metrics.record_error("model.get_answer", e)
+            return None
+
+    def submit_answer(self, encoding: Optional[ImageEncoding], question: str,
+                      context_id: Optional[str] = None, token: Optional[CancelToken] = None) -> Future:
+        """Run get_answer off the calling thread so the caller can keep polling and cancel."""
+        return self._answer_pool.submit(self.get_answer, encoding, question, context_id, token)
+
+    def answer_frames(self, encodings: List[Optional[ImageEncoding]], question: str,
+                      token: Optional[CancelToken] = None) -> List[Optional[str]]:
+        """Answer one question about every frame, with None for frames that fail.
+
+        The frame set is one admitted request with its own deadline: cached
+        answers are reused and the rest run one frame at a time, releasing
+        the inference lock in between. Raises ServerBusy when
+        INFERENCE_MAX_PENDING requests are already admitted.
+        """
+        token = token or CancelToken(FRAME_ANSWER_TIMEOUT_SECONDS)
+        answers = [None] * len(encodings)
+        pending = []
+        with Metrics.span("model.answer_frames"):
+            for i, encoding in enumerate(encodings):
+                if encoding is None or encoding._model_id != id(self):
+                    continue
+                cache_key = self._answer_cache_key(encoding, question)
+                cached = self.answer_cache.get(cache_key) if cache_key is not None else None
+                if cached is not None:
+                    answers[i] = cached
+                else:
+                    pending.append((i, encoding, cache_key))
+            if pending and self.model is not None:
+                with self.admission.admit():
+                    results = self._answer_batch([(e._data, question) for _, e, _ in pending], [token] * len(pending))
+                for (i, _, cache_key), result in zip(pending, results):
+                    if isinstance(result, Exception):
+                        continue
+                    answers[i] = result
+                    if cache_key is not None:
+                        self.answer_cache.put(cache_key, result)
+        return answers
+
+    def submit_answer_frames(self, encodings: List[Optional[ImageEncoding]], question: str,
+                             token: Optional[CancelToken] = None) -> Future:
+        return self._answer_pool.submit(self.answer_frames, encodings, question, token)
+
+    def caption(self, encoding: Optional[ImageEncoding], length: str = "normal",
+                token: Optional[CancelToken] = None) -> Optional[str]:
+        """Caption an encoded image, or None on failure.
+
+        Falls back to a plain description query when the loaded model has no
+        caption head (a worker pool, for instance).
+        """
+        if not hasattr(self.model, 'caption'):
+            return self.get_answer(encoding, DESCRIBE_QUESTION, token=token)
+        token = token or CancelToken()
+        try:
+            with Metrics.span("model.caption"):
+                self._check_encoding(encoding)
+                with self.admission.admit(), self._inference_lock:
+                    token.check()
+                    return self.model.caption(encoding._data, length=length, settings=GENERATION_SETTINGS)['caption'].strip()
+        except ServerBusy:
+            raise
+        except RequestCancelled:
+            return None
+        except Exception as e:
+            Metrics.record_error("model.caption", e)
+            return None
+
+    def detect(self, encoding: Optional[ImageEncoding], label: str,
+               token: Optional[CancelToken] = None) -> Optional[List[Dict]]:
+        """Bounding boxes of every `label` in the image, or None if detection is unavailable or fails."""
+        if not hasattr(self.model, 'detect'):
+            return None
+        token = token or CancelToken()
+        try:
+            with Metrics.span("model.detect"):
+                self._check_encoding(encoding)
+                with self.admission.admit(), self._inference_lock:
+                    token.check()
+                    return self.model.detect(encoding._data, label)['objects']
+        except ServerBusy:
+            raise
+        except RequestCancelled:
+            return None
+        except Exception as e:
+            Metrics.record_error("model.detect", e)
+            return None
+
+    def _check_encoding(self, encoding: Optional[ImageEncoding]) -> None:
+        if self.model is None or encoding is None:
+            raise RuntimeError("Model/image not ready")
+        if encoding._model_id != id(self):
+            raise RuntimeError("Encoding belongs to a different model")
+
+    def _answer_cache_key(self, encoding: ImageEncoding, question: str) -> Optional[str]:
+        if self.answer_cache is None or encoding.key is None:
+            return None
+        if not self.answer_cache.enabled_for(GENERATION_SETTINGS):
+            return None
+        return AnswerCache.make_key(encoding.key, question, GENERATION_SETTINGS)
+
+    def stream_answer(self, encoding: Optional[ImageEncoding], question: str,
+                      context_id: Optional[str] = None, token: Optional[CancelToken] = None) -> Iterator[str]:
+        token = token or CancelToken()
+        started = time.perf_counter()
         try:
-            if self.model is None or self.enc_image is None:
+            if self.model is None or encoding is None:
                 raise RuntimeError("Model/image not ready")
-            answer = self.model.query(self.enc_image, question)['answer']
-            return answer
-        except:
-            return None
\ No newline at end of file
+            if encoding._model_id != id(self):
+                raise RuntimeError("Encoding belongs to a different model")
+            cache_key = self._answer_cache_key(encoding, question)
+            if cache_key is not None:
+                cached = self.answer_cache.get(cache_key)
+                if cached is not None:
+                    if context_id is not None:
+                        self.record_turn(context_id, encoding, question, cached)
+                    yield cached
+                    return
+            if context_id is not None and self._supports_context():
+                with self.admission.admit():
+                    yield from self._stream_in_context(context_id, encoding, question, token, cache_key)
+                Metrics.observe("chatmoon_stage_duration_seconds", time.perf_counter() - started, stage="model.stream_answer")
+                return
+            chunks = []
+            # The lock is held until the generator is exhausted or closed, since
+            # every token is decoded against the shared KV cache.
+            with self.admission.admit(), self._inference_lock:
+                token.check()
+                stream = self.model.query(
+                    encoding._data, question, stream=True, settings=GENERATION_SETTINGS
+                )['answer']
+                for chunk in stream:
+                    token.check()
+                    if not chunks:
+                        Metrics.observe("chatmoon_time_to_first_token_seconds", time.perf_counter() - started)
+                    chunks.append(chunk)
+                    yield chunk
+            if cache_key is not None:
+                self.answer_cache.put(cache_key, ''.join(chunks))
+            Metrics.observe("chatmoon_stage_duration_seconds", time.perf_counter() - started, stage="model.stream_answer")
+        except ServerBusy:
+            raise
+        except RequestCancelled as e:
+            Metrics.inc("chatmoon_requests_cancelled_total", reason=type(e).__name__, stage="generating")
+            return
+        except Exception as e:
+            Metrics.record_error("model.stream_answer", e)
+            return
+
+    def _supports_context(self) -> bool:
+        # Context reuse drives moondream's own prefill helpers; anything that
+        # does not expose them (another revision, a worker pool) answers
+        # every question from the image prefix alone.
+        inner = getattr(self.model, 'model', None)
+        return self.context_store is not None and all(
+            hasattr(inner, name) for name in (
+                '_load_encoded_image', '_generate_answer', '_prefill_prompt', '_decode_one_tok',
+                'tokenizer', 'text', 'config',
+            )
+        )
+
+    def _open_context(self, context_id: str, encoding: ImageEncoding, new_tokens: int) -> ChatContext:
+        # Starts over from the image prefix when the chat is new, the image
+        # changed, or the turns would not fit in the model's context.
+        inner = self.model.model
+        base_key = encoding.key or id(encoding._data)
+        context = self.context_store.get(context_id)
+        if (context is None or context.base_key != base_key
+                or context.history_tokens > CHAT_CONTEXT_MAX_HISTORY_TOKENS
+                or context.pos + new_tokens > inner.config.text.max_context):
+            context = ChatContext(encoding._data, base_key)
+        return context
+
+    @staticmethod
+    def _query_prompt(inner, question: str) -> List[int]:
+        template = inner.config.tokenizer.templates["query"]
+        return template["prefix"] + inner.tokenizer.encode(" " + question).ids + template["suffix"]
+
+    def record_turn(self, context_id: str, encoding: Optional[ImageEncoding], question: str, answer: str) -> None:
+        """Add a turn answered without generation (a cached or precomputed answer) to a chat's KV context.
+
+        Only the tokens are queued here; the chat's next in-context question
+        prefills them, so the caller never waits for the model.
+        """
+        if not answer or encoding is None or not self._supports_context():
+            return
+        inner = self.model.model
+        try:
+            self._check_encoding(encoding)
+            tokens = self._query_prompt(inner, question) + inner.tokenizer.encode(answer).ids
+        except Exception as e:
+            # A context missing this turn would answer later questions as if
+            # it had never been asked.
+            self.context_store.discard(context_id)
+            Metrics.record_error("model.record_turn", e)
+            return
+        base_key = encoding.key or id(encoding._data)
+        now = time.time()
+        with self._turns_lock:
+            while self._pending_turns:
+                oldest = next(iter(self._pending_turns))
+                if self._pending_turns[oldest][2] > now - CHAT_CONTEXT_IDLE_SECONDS:
+                    break
+                del self._pending_turns[oldest]
+            queued_key, turns, _ = self._pending_turns.pop(context_id, (base_key, [], now))
+            if queued_key != base_key:
+                turns = []
+            self._pending_turns[context_id] = (base_key, turns + [tokens], now)
+
+    def _take_pending_turns(self, context_id: str, encoding: ImageEncoding) -> List[int]:
+        with self._turns_lock:
+            base_key, turns, _ = self._pending_turns.pop(context_id, (None, [], 0.0))
+        if base_key != (encoding.key or id(encoding._data)):
+            return []
+        return [t for turn in turns for t in turn]
+
+    def _stream_in_context(self, context_id: str, encoding: ImageEncoding, question: str,
+                           token: CancelToken, cache_key: Optional[str] = None) -> Iterator[str]:
+        import torch
+
+        inner = self.model.model
+        prompt = self._query_prompt(inner, question)
+        max_tokens = GENERATION_SETTINGS.get("max_tokens", 768)
+        turn_tokens = self._take_pending_turns(context_id, encoding)
+        context = self._open_context(context_id, encoding, len(turn_tokens) + len(prompt) + max_tokens)
+        if context.pos + len(turn_tokens) + len(prompt) + max_tokens > inner.config.text.max_context:
+            turn_tokens = []
+        reused_tokens = context.history_tokens
+
+        started = time.perf_counter()
+        chunks = []
+        stored = False
+        try:
+            with self._inference_lock, _counting_calls(inner, '_decode_one_tok') as steps:
+                token.check()
+                context.load_into(inner)
+                pos = context.pos
+                if turn_tokens:
+                    inner._prefill_prompt(torch.tensor([turn_tokens], device=inner.device), pos, 0.0, 0.0)
+                    pos += len(turn_tokens)
+                prompt_tokens = torch.tensor([prompt], device=inner.device)
+                for chunk in inner._generate_answer(prompt_tokens, pos, GENERATION_SETTINGS):
+                    # A cancelled turn leaves the stored context at the previous turn.
+                    token.check()
+                    if not chunks:
+                        prefill_seconds = time.perf_counter() - started
+                        Metrics.observe("chatmoon_prefill_seconds", prefill_seconds, mode="context")
+                        Metrics.observe("chatmoon_time_to_first_token_seconds", prefill_seconds)
+                    chunks.append(chunk)
+                    yield chunk
+                # Each decode step writes the token it was fed at the next
+                # position, so the cache now holds the prompt and those tokens.
+                end = pos + len(prompt) + steps[0]
+                self.context_store.put(context_id, context.extended(inner, end))
+                stored = True
+        finally:
+            if turn_tokens and not stored:
+                # The queued turns were taken, so the previous turn's context
+                # no longer covers everything the chat was answered.
+                self.context_store.discard(context_id)
+        if cache_key is not None and chunks and not reused_tokens and not turn_tokens:
+            # Only an answer from the image alone is what a plain query gives.
+            self.answer_cache.put(cache_key, ''.join(chunks))
+        if chunks and reused_tokens:
+            # Without the stored turns these tokens would be prefilled again at
+            # the per-token rate this question's prompt just took.
+            Metrics.inc("chatmoon_context_reused_tokens_total", reused_tokens)
+            Metrics.inc("chatmoon_context_prefill_saved_seconds_total", prefill_seconds * reused_tokens / len(prompt))
+
+    def _answer_batch(self, requests: List[Tuple[object, str]], tokens: Optional[List] = None) -> List:
+        # The pinned moondream revision exposes no batched query, so a batch
+        # runs its generations back to back. The lock is taken per generation,
+        # so one long batch does not hold off every other session.
+        answers = []
+        tokens = tokens or [None] * len(requests)
+        for (enc_image, question), token in zip(requests, tokens):
+            try:
+                with self._inference_lock:
+                    if token is None:
+                        answers.append(
+                            self.model.query(enc_image, question, settings=GENERATION_SETTINGS)['answer']
+                        )
+                    else:
+                        answers.append(self._generate_cancellable(enc_image, question, token))
+            except Exception as e:
+                answers.append(e)
+        return answers
+
+    def _generate_cancellable(self, enc_image, question: str, token: CancelToken) -> str:
+        # Streaming internally puts a check between tokens, so an abandoned
+        # request stops instead of generating up to max_tokens.
+        token.check()
+        chunks = []
+        for chunk in self.model.query(enc_image, question, stream=True, settings=GENERATION_SETTINGS)['answer']:
+            try:
+                token.check()
+            except RequestCancelled as e:
+                Metrics.inc("chatmoon_requests_cancelled_total", reason=type(e).__name__, stage="generating")
+                raise
+            chunks.append(chunk)
+        return ''.join(chunks)
@@ -1,17 +1,154 @@
-from huggingface_hub import snapshot_download
-import sys
+"""
+Build the local model bundle used for fast cold starts.
+
+Downloads MODEL_ID@MODEL_REVISION into MODEL_BUNDLE_DIR/source, verifies every
+file against the hub's checksums (re-fetching any that fail), then loads the
+model once and re-saves it as safetensors in the runtime dtype so load_model
+can memory-map it without hub lookups. Interrupted runs resume where they
+stopped; a finished bundle is left untouched.
+
+    python -m model.model_installer --precision bfloat16
+"""
+import argparse
+import hashlib
 import os
-script_dir = os.path.dirname(os.path.abspath(__file__))
-parent_dir = os.path.dirname(script_dir)
-sys.path.append(parent_dir)
-from config import MODEL_ID, MODEL_REVISION
+import shutil
+import time
+from config import MODEL_ID, MODEL_REVISION, MODEL_PRECISION
+from model.bundle import dtype_dir, local_bundle, source_dir, sha256_file, verify_bundle, write_manifest
+from model.precision import PRECISION_MODES, dtype_name_for, torch_dtype_for
+
+DOWNLOAD_ATTEMPTS = 3
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".safetensors.index.json", ".bin.index.json")
+
+
+def _git_blob_sha1(path: str) -> str:
+    digest = hashlib.sha1()
+    digest.update(f"blob {os.path.getsize(path)}\0".encode())
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _expected_files():
+    from huggingface_hub import HfApi
+
+    info = HfApi().model_info(MODEL_ID, revision=MODEL_REVISION, files_metadata=True)
+    return info.siblings
+
+
+def _mismatched_files(directory: str, siblings) -> list:
+    bad = []
+    for sibling in siblings:
+        path = os.path.join(directory, sibling.rfilename)
+        if not os.path.isfile(path):
+            bad.append(sibling.rfilename)
+        elif sibling.lfs is not None:
+            if sha256_file(path) != sibling.lfs.sha256:
+                bad.append(sibling.rfilename)
+        elif sibling.blob_id and _git_blob_sha1(path) != sibling.blob_id:
+            bad.append(sibling.rfilename)
+    return bad
+
+
+def download_source() -> str:
+    """Fetch and verify the snapshot, retrying with resume on failure."""
+    from huggingface_hub import hf_hub_download, snapshot_download
+
+    directory = source_dir()
+    siblings = _expected_files()
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        try:
+            snapshot_download(MODEL_ID, revision=MODEL_REVISION, local_dir=directory, max_workers=4)
+            bad = _mismatched_files(directory, siblings)
+            for name in bad:
+                print(f"Checksum mismatch for {name}, downloading it again...")
+                os.remove(os.path.join(directory, name))
+                hf_hub_download(MODEL_ID, name, revision=MODEL_REVISION, local_dir=directory, force_download=True)
+            if not bad or not _mismatched_files(directory, siblings):
+                return directory
+        except Exception as e:
+            print(f"Download attempt {attempt} failed: {e!r}")
+        if attempt < DOWNLOAD_ATTEMPTS:
+            time.sleep(2 ** attempt)
+    raise RuntimeError(f"Could not download a verified copy of {MODEL_ID}@{MODEL_REVISION}")
+
+
+def materialize(source: str, precision: str) -> str:
+    """Re-save the model as safetensors in the dtype load_model will use."""
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    dtype_name = dtype_name_for(precision)
+    target = dtype_dir(dtype_name)
+    staging = f"{target}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+
+    model = AutoModelForCausalLM.from_pretrained(
+        source,
+        trust_remote_code=True,
+        local_files_only=True,
+        device_map="cpu",
+        torch_dtype=torch_dtype_for(precision)
+    )
+    with torch.no_grad():
+        model.save_pretrained(staging, safe_serialization=True)
+    # Tokenizer files and remote code that save_pretrained does not write.
+    for root, _, names in os.walk(source):
+        if os.path.relpath(root, source).split(os.sep)[0] in (".cache", ".git"):
+            continue
+        for name in names:
+            if name.endswith(WEIGHT_SUFFIXES):
+                continue
+            rel = os.path.relpath(os.path.join(root, name), source)
+            destination = os.path.join(staging, rel)
+            if not os.path.exists(destination):
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                shutil.copy2(os.path.join(root, name), destination)
+
+    write_manifest(staging, dtype_name)
+    # The old bundle is moved aside rather than deleted first, so a failure
+    # here never leaves the target half removed.
+    retired = f"{target}.old"
+    shutil.rmtree(retired, ignore_errors=True)
+    if os.path.exists(target):
+        os.replace(target, retired)
+    os.replace(staging, target)
+    shutil.rmtree(retired, ignore_errors=True)
+    return target
+
+
+def install(precision: str, verify: bool = False) -> str:
+    dtype_name = dtype_name_for(precision)
+    existing = local_bundle(dtype_name)
+    if existing and (not verify or verify_bundle(existing, dtype_name, full=True)):
+        print(f"Bundle for {dtype_name} already present at {existing}.")
+        return existing
+
+    print(f"Downloading {MODEL_ID}@{MODEL_REVISION}...")
+    started = time.perf_counter()
+    source = download_source()
+    print(f"Download verified in {time.perf_counter() - started:.1f}s.")
+
+    print(f"Writing {dtype_name} weights...")
+    started = time.perf_counter()
+    target = materialize(source, precision)
+    print(f"Bundle written to {target} in {time.perf_counter() - started:.1f}s.")
+    return target
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download, verify and materialize the model bundle.")
+    parser.add_argument('--precision', default=MODEL_PRECISION, choices=PRECISION_MODES)
+    parser.add_argument('--verify', action='store_true', help="Re-hash an existing bundle instead of trusting its sizes")
+    parser.add_argument('--keep-source', action='store_true', help="Keep the downloaded snapshot after materializing")
+    args = parser.parse_args()
 
-print(f"Downloading {MODEL_ID}...")
+    install(args.precision, args.verify)
+    if not args.keep_source:
+        shutil.rmtree(source_dir(), ignore_errors=True)
 
-snapshot_download(
-    MODEL_ID, 
-    revision=MODEL_REVISION,
-    max_workers=4
-)
 
-print("Download complete.")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+PRECISION_MODES = ("float32", "bfloat16", "int8")
+
+
+def dtype_name_for(precision: str) -> str:
+    if precision not in PRECISION_MODES:
+        raise ValueError(f"Unknown precision mode: {precision}")
+    # int8 keeps float32 weights at load time and quantizes afterwards.
+    return "bfloat16" if precision == "bfloat16" else "float32"
+
+
+def torch_dtype_for(precision: str):
+    import torch
+
+    return getattr(torch, dtype_name_for(precision))
+
+
+def configure_threads(num_threads) -> None:
+    import torch
+
+    if num_threads:
+        torch.set_num_threads(int(num_threads))
+
+
+def text_decoder(hf_model):
+    """Return the text decoder module of a moondream model, or the model itself."""
+    inner = getattr(hf_model, 'model', hf_model)
+    return getattr(inner, 'text', inner)
+
+
+def apply_precision(hf_model, precision: str):
+    if precision != "int8":
+        return hf_model
+
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+
+    # Quantizing in place swaps the Linear submodules on the decoder itself,
+    # so the model keeps its references to it.
+    quantize_dynamic(text_decoder(hf_model), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return hf_model
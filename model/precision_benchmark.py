@@ -0,0 +1,144 @@
+"""
+Compare the precision modes of Model.load_model on this machine.
+
+Each mode is loaded in its own process so that memory numbers are not polluted
+by the previous mode. Latency, resident memory and answer agreement with the
+float32 baseline are reported per mode. Answers are decoded greedily, so
+disagreement comes from the precision and not from sampling.
+
+    python -m model.precision_benchmark --images a.jpg b.jpg --questions "What is this?"
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import time
+from config import GENERATION_SETTINGS
+from model.precision import PRECISION_MODES
+
+COMPARISON_SETTINGS = {**GENERATION_SETTINGS, "temperature": 0.0}
+
+
+def _rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _run_mode(precision, num_threads, images, questions, results):
+    from PIL import Image
+    from model.model import Model
+
+    rss_before = _rss_bytes()
+    started = time.perf_counter()
+    model = Model()
+    model.load_model(precision=precision, num_threads=num_threads)
+    load_seconds = time.perf_counter() - started
+    if not model.is_model_loaded():
+        results.put({'precision': precision, 'error': repr(model.load_error)})
+        return
+    rss_loaded = _rss_bytes()
+
+    encode_seconds = []
+    query_seconds = []
+    answers = []
+    for image_path in images:
+        image = Image.open(image_path)
+        image.load()
+        started = time.perf_counter()
+        encoding = model._encode(image, None)
+        encode_seconds.append(time.perf_counter() - started)
+        for question in questions:
+            started = time.perf_counter()
+            try:
+                answer = model.model.query(encoding._data, question, settings=COMPARISON_SETTINGS)['answer']
+            except Exception:
+                answer = None
+            query_seconds.append(time.perf_counter() - started)
+            answers.append(answer)
+
+    results.put({
+        'precision': precision,
+        'load_seconds': load_seconds,
+        'model_rss_bytes': rss_loaded - rss_before,
+        'peak_rss_bytes': _rss_bytes(),
+        'mean_encode_seconds': sum(encode_seconds) / len(encode_seconds),
+        'mean_query_seconds': sum(query_seconds) / len(query_seconds),
+        'answers': answers,
+    })
+
+
+def _token_overlap(a: str, b: str) -> float:
+    tokens_a, tokens_b = set(a.lower().split()), set(b.lower().split())
+    if not tokens_a and not tokens_b:
+        return 1.0
+    return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+
+
+def compare(modes, num_threads, images, questions):
+    ctx = multiprocessing.get_context('spawn')
+    reports = []
+    for precision in modes:
+        results = ctx.Queue()
+        process = ctx.Process(target=_run_mode, args=(precision, num_threads, images, questions, results))
+        process.start()
+        report = None
+        while report is None and (process.is_alive() or not results.empty()):
+            try:
+                report = results.get(timeout=1)
+            except queue.Empty:
+                pass
+        process.join()
+        reports.append(report or {'precision': precision, 'error': f"exit code {process.exitcode}"})
+
+    baseline = next((r for r in reports if r['precision'] == 'float32' and 'answers' in r), None)
+    for report in reports:
+        if baseline is None or 'answers' not in report:
+            continue
+        pairs = [
+            (a, b) for a, b in zip(report['answers'], baseline['answers'])
+            if a is not None and b is not None
+        ]
+        report['exact_agreement'] = sum(a.strip() == b.strip() for a, b in pairs) / len(pairs) if pairs else 0.0
+        report['token_agreement'] = sum(_token_overlap(a, b) for a, b in pairs) / len(pairs) if pairs else 0.0
+        report['speedup_vs_float32'] = baseline['mean_query_seconds'] / report['mean_query_seconds']
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare Model precision modes against float32.")
+    parser.add_argument('--images', nargs='+', required=True)
+    parser.add_argument('--questions', nargs='+', default=["Describe this image."])
+    parser.add_argument('--modes', nargs='+', default=list(PRECISION_MODES), choices=PRECISION_MODES)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--output', default=None, help="Write the full report as JSON to this path")
+    args = parser.parse_args()
+
+    modes = args.modes if 'float32' in args.modes else ['float32'] + args.modes
+    reports = compare(modes, args.threads, args.images, args.questions)
+
+    for report in reports:
+        if 'error' in report:
+            print(f"{report['precision']:>9}: failed ({report['error']})")
+            continue
+        print(
+            f"{report['precision']:>9}: load {report['load_seconds']:.1f}s, "
+            f"rss {report['model_rss_bytes'] / 2**20:.0f} MiB, "
+            f"encode {1000 * report['mean_encode_seconds']:.0f} ms, "
+            f"query {1000 * report['mean_query_seconds']:.0f} ms "
+            f"(x{report.get('speedup_vs_float32', 1.0):.2f}), "
+            f"agreement {100 * report.get('exact_agreement', 1.0):.0f}% exact / "
+            f"{100 * report.get('token_agreement', 1.0):.0f}% tokens"
+        )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import threading
+import time
+import weakref
+from typing import Optional
+from config import (
+    SHARE_MODEL_ACROSS_SESSIONS,
+    UNLOAD_MODEL_WHEN_UNUSED,
+    BATCHING_ENABLED,
+    MAX_BATCH_SIZE,
+    MAX_BATCH_WAIT_MS,
+    ENCODING_CACHE_ENABLED,
+    ANSWER_CACHE_ENABLED,
+    CHAT_CONTEXT_ENABLED,
+    MODEL_WARMUP,
+    INFERENCE_WORKERS,
+    MODEL_LOAD_RETRY_SECONDS,
+    MODEL_LOAD_RETRY_MAX_SECONDS,
+)
+from model.model import Model, ModelState
+from model.worker_pool import RemoteModel
+from model.encoding_cache import get_encoding_cache
+from model.answer_cache import get_answer_cache
+from model.chat_context import get_chat_context_store
+from services.metrics import Metrics
+
+
+class ModelLease:
+    def __init__(self, model: Model):
+        self.model = model
+        self._finalizer = weakref.finalize(self, ModelRegistry._release, model)
+
+    def release(self) -> None:
+        self._finalizer()
+
+    @property
+    def released(self) -> bool:
+        return not self._finalizer.alive
+
+
+class ModelRegistry:
+    _lock = threading.Lock()
+    _shared_model: Optional[Model] = None
+    _ref_count = 0
+    _preloaded = False
+    _load_failures = 0
+    _retry_at = 0.0
+
+    @classmethod
+    def preload(cls) -> Optional[Model]:
+        """Start loading the shared model in the background without taking a reference.
+
+        Streamlit runs the main script on every rerun, so only the first call
+        per process starts a load.
+        """
+        if not SHARE_MODEL_ACROSS_SESSIONS:
+            return None
+        with cls._lock:
+            if not cls._preloaded:
+                cls._preloaded = True
+                cls._ensure_shared_model()
+            return cls._shared_model
+
+    @classmethod
+    def acquire(cls) -> ModelLease:
+        if not SHARE_MODEL_ACROSS_SESSIONS:
+            return ModelLease(cls._create_model())
+
+        with cls._lock:
+            model = cls._ensure_shared_model()
+            cls._ref_count += 1
+            return ModelLease(model)
+
+    @classmethod
+    def _ensure_shared_model(cls) -> Model:
+        failed = cls._shared_model is not None and cls._shared_model.state == ModelState.FAILED
+        if failed and time.monotonic() < cls._retry_at:
+            return cls._shared_model
+        if cls._shared_model is None or failed:
+            cls._shared_model = cls._create_model()
+            Metrics.register_collector("model", cls._collect_metrics)
+        return cls._shared_model
+
+    @classmethod
+    def _collect_metrics(cls) -> None:
+        model = cls._shared_model
+        Metrics.set_gauge("chatmoon_model_sessions", cls._ref_count)
+        if model is None:
+            return
+        for state in (ModelState.LOADING, ModelState.READY, ModelState.FAILED):
+            Metrics.set_gauge("chatmoon_model_state", 1 if model.state == state else 0, state=state)
+        if model.scheduler is not None:
+            Metrics.set_gauge("chatmoon_queue_depth", model.scheduler.queue_depth())
+        Metrics.set_gauge("chatmoon_admission_pending", model.admission.pending())
+        if model.answer_cache is not None:
+            Metrics.set_gauge("chatmoon_cache_hit_rate", model.answer_cache.stats()['hit_rate'], cache="answer")
+        if model.encoding_cache is not None:
+            for name, value in model.encoding_cache.stats().items():
+                Metrics.set_gauge(f"chatmoon_encoding_cache_{name}", value)
+        if model.context_store is not None:
+            for name, value in model.context_store.stats().items():
+                Metrics.set_gauge(f"chatmoon_chat_context_{name}", value)
+        if isinstance(model, RemoteModel):
+            for worker in model.worker_health():
+                Metrics.set_gauge("chatmoon_worker_healthy", int(worker['alive'] and worker['ready']), worker=worker['worker'])
+                Metrics.set_gauge("chatmoon_worker_inflight", worker['inflight'], worker=worker['worker'])
+
+    @staticmethod
+    def _create_model() -> Model:
+        model = RemoteModel(INFERENCE_WORKERS) if INFERENCE_WORKERS > 0 else Model()
+        model.state = ModelState.LOADING
+        # Remote workers keep their own encoding cache next to their encodings.
+        if ENCODING_CACHE_ENABLED and not isinstance(model, RemoteModel):
+            model.attach_encoding_cache(get_encoding_cache())
+        if ANSWER_CACHE_ENABLED:
+            model.attach_answer_cache(get_answer_cache())
+        if CHAT_CONTEXT_ENABLED and not isinstance(model, RemoteModel):
+            model.attach_context_store(get_chat_context_store())
+        threading.Thread(
+            target=ModelRegistry._load_in_background,
+            args=(model,),
+            name="model-loader",
+            daemon=True
+        ).start()
+        return model
+
+    @staticmethod
+    def _load_in_background(model: Model) -> None:
+        model.load_model(warmup=MODEL_WARMUP)
+        if BATCHING_ENABLED and model.is_model_loaded():
+            model.enable_batching(MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS)
+        ModelRegistry._record_load(model)
+
+    @classmethod
+    def _record_load(cls, model: Model) -> None:
+        with cls._lock:
+            if model is not cls._shared_model:
+                return
+            if model.state != ModelState.FAILED:
+                cls._load_failures = 0
+                return
+            cls._load_failures += 1
+            delay = min(MODEL_LOAD_RETRY_SECONDS * 2 ** (cls._load_failures - 1), MODEL_LOAD_RETRY_MAX_SECONDS)
+            cls._retry_at = time.monotonic() + delay
+
+    @classmethod
+    def _release(cls, model: Model) -> None:
+        with cls._lock:
+            if model is not cls._shared_model:
+                return
+            cls._ref_count = max(cls._ref_count - 1, 0)
+            if cls._ref_count == 0 and UNLOAD_MODEL_WHEN_UNUSED:
+                cls._shared_model = None
+
+    @classmethod
+    def ref_count(cls) -> int:
+        with cls._lock:
+            return cls._ref_count
+
+    @classmethod
+    def shared_model(cls) -> Optional[Model]:
+        with cls._lock:
+            return cls._shared_model
@@ -0,0 +1,147 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Tuple
+from services.metrics import Metrics
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+class _PendingRequest:
+    __slots__ = ('payload', 'question', 'token', 'future', 'enqueued_at')
+
+    def __init__(self, payload, question: str, token):
+        self.payload = payload
+        self.question = question
+        self.token = token
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class InferenceScheduler:
+    """Collects query requests from all sessions and runs them in micro-batches.
+
+    A batch closes when it reaches max_batch_size or when max_wait_ms has passed
+    since its first request was queued. Larger windows raise throughput under
+    load at the cost of added latency for the first request in each batch.
+    """
+
+    def __init__(self, run_batch: Callable[[List[Tuple[object, str]], List], List], max_batch_size: int, max_wait_ms: float):
+        self._run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)
+        self._requests = 0
+        self._batches = 0
+        self._queue_wait_total = 0.0
+        self._busy_time = 0.0
+        self._started_at = time.perf_counter()
+        self._worker = threading.Thread(target=self._loop, name="inference-scheduler", daemon=True)
+        self._worker.start()
+
+    def submit(self, payload, question: str, token=None) -> Future:
+        request = _PendingRequest(payload, question, token)
+        self._queue.put(request)
+        return request.future
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def _collect_batch(self) -> List[_PendingRequest]:
+        batch = [self._queue.get()]
+        deadline = batch[0].enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drop_abandoned(self, batch: List[_PendingRequest]) -> List[_PendingRequest]:
+        live = []
+        for request in batch:
+            try:
+                if request.token is not None:
+                    request.token.check()
+            except Exception as e:
+                Metrics.inc("chatmoon_requests_cancelled_total", reason=type(e).__name__, stage="queued")
+                request.future.set_exception(e)
+                continue
+            live.append(request)
+        return live
+
+    def _loop(self):
+        while True:
+            # Requests whose caller gave up or whose deadline passed while
+            # queued are failed here instead of taking a slot in the batch.
+            batch = self._drop_abandoned(self._collect_batch())
+            if not batch:
+                continue
+            started = time.perf_counter()
+            try:
+                results = self._run_batch([(r.payload, r.question) for r in batch], [r.token for r in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            finished = time.perf_counter()
+            if len(results) != len(batch):
+                error = RuntimeError(f"Batch of {len(batch)} returned {len(results)} results")
+                Metrics.record_error("scheduler.batch", error)
+                results = list(results[:len(batch)]) + [error] * (len(batch) - len(results))
+
+            for request, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    request.future.set_exception(result)
+                else:
+                    request.future.set_result(result)
+
+            Metrics.observe("chatmoon_batch_size", len(batch), buckets=BATCH_SIZE_BUCKETS)
+            Metrics.observe("chatmoon_stage_duration_seconds", finished - started, stage="scheduler.batch")
+            for request in batch:
+                Metrics.observe("chatmoon_queue_wait_seconds", started - request.enqueued_at)
+
+            with self._stats_lock:
+                self._requests += len(batch)
+                self._batches += 1
+                self._busy_time += finished - started
+                for request in batch:
+                    self._queue_wait_total += started - request.enqueued_at
+                    self._latencies.append(finished - request.enqueued_at)
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            elapsed = time.perf_counter() - self._started_at
+            requests = self._requests
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'requests': requests,
+                'batches': self._batches,
+                'queue_depth': self._queue.qsize(),
+                'avg_batch_size': requests / self._batches if self._batches else 0.0,
+                'avg_queue_wait_ms': 1000.0 * self._queue_wait_total / requests if requests else 0.0,
+                'p50_latency_ms': 1000.0 * latencies[len(latencies) // 2] if latencies else 0.0,
+                'p95_latency_ms': 1000.0 * latencies[int(len(latencies) * 0.95) - 1] if latencies else 0.0,
+                'throughput_rps': requests / self._busy_time if self._busy_time else 0.0,
+                'utilization': self._busy_time / elapsed if elapsed else 0.0,
+            }
+
+    def report(self) -> str:
+        s = self.stats()
+        return (
+            f"batch<={s['max_batch_size']} wait<={s['max_wait_ms']:.0f}ms: "
+            f"{s['requests']} requests in {s['batches']} batches "
+            f"(avg {s['avg_batch_size']:.2f}), "
+            f"queue wait {s['avg_queue_wait_ms']:.1f}ms, "
+            f"p50 {s['p50_latency_ms']:.1f}ms, p95 {s['p95_latency_ms']:.1f}ms, "
+            f"{s['throughput_rps']:.2f} req/s while busy, "
+            f"utilization {100 * s['utilization']:.0f}%"
+        )
@@ -0,0 +1,492 @@
+"""
+Out-of-process inference workers.
+
+Each worker process loads its own Model and keeps the encodings of the images
+routed to it. Decoded images reach a worker through shared memory, and
+encodings never cross the process boundary: follow-up questions are routed to
+the worker that already holds the image's encoding. If that worker died or
+evicted the encoding, the image is re-encoded from shared memory on whichever
+worker takes the question, and shared again from its stored blob when it has
+left shared memory too.
+
+Every worker answers on its own response queue, read by its own dispatch
+thread, so a slow or restarted worker never holds up another's replies. A
+request that times out marks its worker as hung and restarts it, since the
+ping thread keeps answering while the inference loop is stuck.
+
+RemoteModel presents the usual Model interface on top of the pool, so the
+scheduler, caches and UI use it unchanged.
+"""
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Tuple
+from PIL import Image
+from config import (
+    MODEL_WARMUP,
+    MODEL_PRECISION,
+    TORCH_NUM_THREADS,
+    GENERATION_SETTINGS,
+    ENCODING_CACHE_ENABLED,
+    WORKER_SHM_BYTES,
+    WORKER_MAX_ENCODINGS,
+    WORKER_HEALTH_INTERVAL_SECONDS,
+    WORKER_HEALTH_TIMEOUT_SECONDS,
+    WORKER_REQUEST_TIMEOUT_SECONDS,
+)
+from model.model import Model, ModelState
+from services.metrics import Metrics
+
+
+class WorkerError(RuntimeError):
+    pass
+
+
+class _MissingEncoding(Exception):
+    pass
+
+
+class RemoteEncoding:
+    __slots__ = ('image_key',)
+
+    def __init__(self, image_key: str):
+        self.image_key = image_key
+
+
+def _attach_image(shm_name: str, size: Tuple[int, int], mode: str) -> Image.Image:
+    # Spawned workers share the client's resource tracker, so attaching here
+    # does not hand ownership of the segment to the worker.
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        return Image.frombuffer(mode, size, shm.buf, "raw", mode, 0, 1).copy()
+    finally:
+        shm.close()
+
+
+def _worker_main(worker_id: int, requests, control, responses, precision: str, num_threads, model_factory) -> None:
+    if model_factory is not None:
+        model = model_factory()
+    else:
+        model = Model()
+        model.load_model(warmup=MODEL_WARMUP, precision=precision, num_threads=num_threads)
+        if ENCODING_CACHE_ENABLED:
+            from model.encoding_cache import get_encoding_cache
+            model.attach_encoding_cache(get_encoding_cache())
+    if not model.is_model_loaded():
+        responses.put(('failed', worker_id, None, repr(model.load_error)))
+        return
+
+    def answer_pings():
+        while True:
+            req_id = control.get()
+            if req_id is None:
+                return
+            responses.put(('pong', worker_id, req_id, None))
+
+    threading.Thread(target=answer_pings, name="worker-ping", daemon=True).start()
+    responses.put(('ready', worker_id, None, None))
+
+    encodings = OrderedDict()
+    while True:
+        message = requests.get()
+        if message is None:
+            return
+        op, req_id, payload = message
+        try:
+            if op == 'encode':
+                shm_name, size, mode, image_key = payload
+                image = _attach_image(shm_name, size, mode)
+                encodings[image_key] = model._encode(image, model._encoding_key(image, image_key))
+                encodings.move_to_end(image_key)
+                while len(encodings) > WORKER_MAX_ENCODINGS:
+                    encodings.popitem(last=False)
+                responses.put(('result', worker_id, req_id, None))
+            elif op == 'query':
+                image_key, question, stream, settings = payload
+                encoding = encodings.get(image_key)
+                if encoding is None:
+                    responses.put(('missing', worker_id, req_id, None))
+                    continue
+                encodings.move_to_end(image_key)
+                result = model.model.query(encoding._data, question, stream=stream, settings=settings)['answer']
+                if stream:
+                    for chunk in result:
+                        responses.put(('chunk', worker_id, req_id, chunk))
+                    result = None
+                responses.put(('result', worker_id, req_id, result))
+            else:
+                responses.put(('error', worker_id, req_id, f"unknown op {op}"))
+        except Exception as e:
+            responses.put(('error', worker_id, req_id, repr(e)))
+
+
+class _Worker:
+    def __init__(self, worker_id: int, ctx, precision: str, num_threads, model_factory):
+        self.worker_id = worker_id
+        self.requests = ctx.Queue()
+        self.control = ctx.Queue()
+        self.responses = ctx.Queue()
+        self.ready = threading.Event()
+        self.error = None
+        self.inflight = 0
+        self.last_pong = time.monotonic()
+        self.process = ctx.Process(
+            target=_worker_main,
+            args=(worker_id, self.requests, self.control, self.responses, precision, num_threads, model_factory),
+            name=f"inference-worker-{worker_id}",
+            daemon=True
+        )
+        self.process.start()
+
+    def healthy(self) -> bool:
+        return self.ready.is_set() and self.process.is_alive()
+
+    def stop(self) -> None:
+        for q in (self.requests, self.control):
+            try:
+                q.put_nowait(None)
+            except Exception:
+                pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+        self.close_responses()
+
+    def close_responses(self) -> None:
+        # Ends this worker's dispatch thread once it has read what is left.
+        try:
+            self.responses.put_nowait(None)
+        except Exception:
+            pass
+
+
+class _Call:
+    __slots__ = ('worker_id', 'messages')
+
+    def __init__(self, worker_id: int):
+        self.worker_id = worker_id
+        self.messages = queue.Queue()
+
+
+class WorkerPoolClient:
+    """Stands in for the HF model inside RemoteModel and routes calls to workers.
+
+    model_factory, when given, must be a picklable callable returning a ready
+    Model; it replaces loading the real weights in each worker.
+    """
+
+    def __init__(self, num_workers: int, precision: str = MODEL_PRECISION, num_threads=TORCH_NUM_THREADS,
+                 model_factory=None):
+        self.num_workers = num_workers
+        self.precision = precision
+        self.num_threads = num_threads
+        self.model_factory = model_factory
+        self._ctx = multiprocessing.get_context('spawn')
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._calls: Dict[int, _Call] = {}
+        self._workers: List[_Worker] = []
+        self._affinity: Dict[str, int] = {}
+        self._images = OrderedDict()
+        self._image_bytes = 0
+        # Segments a worker may still attach to are never evicted.
+        self._pins = Counter()
+        self._executor = ThreadPoolExecutor(max_workers=4 * num_workers, thread_name_prefix="worker-client")
+        self.restarts = 0
+
+    def start(self, timeout: Optional[float] = None) -> None:
+        with self._lock:
+            self._workers = [self._spawn(i) for i in range(self.num_workers)]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in list(self._workers):
+            while not worker.ready.is_set() and worker.error is None and worker.process.is_alive():
+                if deadline is not None and time.monotonic() > deadline:
+                    break
+                worker.ready.wait(0.5)
+        if not any(w.healthy() for w in self._workers):
+            errors = [w.error or f"exit code {w.process.exitcode}" for w in self._workers]
+            self.shutdown()
+            raise WorkerError(f"No inference worker started: {errors}")
+        threading.Thread(target=self._monitor, name="worker-monitor", daemon=True).start()
+
+    def _spawn(self, worker_id: int) -> _Worker:
+        worker = _Worker(worker_id, self._ctx, self.precision, self.num_threads, self.model_factory)
+        threading.Thread(target=self._dispatch, args=(worker,), name=f"worker-dispatch-{worker_id}", daemon=True).start()
+        return worker
+
+    def shutdown(self) -> None:
+        with self._lock:
+            workers, self._workers = self._workers, []
+            images, self._images = self._images, OrderedDict()
+        for worker in workers:
+            worker.stop()
+        for shm, _, _ in images.values():
+            shm.close()
+            shm.unlink()
+
+    def _dispatch(self, worker: _Worker) -> None:
+        while True:
+            message = worker.responses.get()
+            if message is None:
+                return
+            kind, _, req_id, payload = message
+            if kind == 'ready':
+                worker.ready.set()
+                worker.last_pong = time.monotonic()
+            elif kind == 'failed':
+                worker.error = payload
+            elif kind == 'pong':
+                worker.last_pong = time.monotonic()
+            else:
+                with self._lock:
+                    call = self._calls.get(req_id)
+                if call is not None:
+                    call.messages.put((kind, payload))
+
+    def _monitor(self) -> None:
+        while True:
+            time.sleep(WORKER_HEALTH_INTERVAL_SECONDS)
+            with self._lock:
+                workers = list(self._workers)
+            if not workers:
+                return
+            for worker in workers:
+                stale = time.monotonic() - worker.last_pong > WORKER_HEALTH_TIMEOUT_SECONDS
+                if worker.ready.is_set() and (not worker.process.is_alive() or stale):
+                    self._restart(worker)
+                elif worker.ready.is_set():
+                    worker.control.put(next(self._ids))
+
+    def _restart(self, worker: _Worker) -> None:
+        with self._lock:
+            if worker.worker_id >= len(self._workers) or self._workers[worker.worker_id] is not worker:
+                return
+            self._affinity = {k: w for k, w in self._affinity.items() if w != worker.worker_id}
+            orphaned = [(req_id, call) for req_id, call in self._calls.items() if call.worker_id == worker.worker_id]
+            replacement = self._spawn(worker.worker_id)
+            self._workers[worker.worker_id] = replacement
+            self.restarts += 1
+        Metrics.inc("chatmoon_worker_restarts_total", worker=worker.worker_id)
+        for _, call in orphaned:
+            call.messages.put(('error', f"worker {worker.worker_id} restarted"))
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.close_responses()
+
+    def health(self) -> List[Dict]:
+        with self._lock:
+            return [
+                {
+                    'worker': w.worker_id,
+                    'alive': w.process.is_alive(),
+                    'ready': w.ready.is_set(),
+                    'inflight': w.inflight,
+                    'seconds_since_pong': round(time.monotonic() - w.last_pong, 1),
+                }
+                for w in self._workers
+            ]
+
+    def _pick_worker(self, image_key: Optional[str]) -> _Worker:
+        with self._lock:
+            if image_key is not None:
+                worker_id = self._affinity.get(image_key)
+                if worker_id is not None and self._workers[worker_id].healthy():
+                    return self._workers[worker_id]
+            candidates = [w for w in self._workers if w.healthy()]
+            if not candidates:
+                raise WorkerError("No healthy inference worker")
+            # Ties go to the worker holding the fewest encodings, so idle
+            # workers share the resident images evenly.
+            held = {}
+            for worker_id in self._affinity.values():
+                held[worker_id] = held.get(worker_id, 0) + 1
+            return min(candidates, key=lambda w: (w.inflight, held.get(w.worker_id, 0)))
+
+    def _call(self, worker: _Worker, op: str, payload, stream: bool = False):
+        req_id = next(self._ids)
+        call = _Call(worker.worker_id)
+        with self._lock:
+            self._calls[req_id] = call
+            worker.inflight += 1
+        try:
+            worker.requests.put((op, req_id, payload))
+            while True:
+                kind, value = call.messages.get(timeout=WORKER_REQUEST_TIMEOUT_SECONDS)
+                if kind == 'chunk' and stream:
+                    yield value
+                    continue
+                if kind == 'missing':
+                    raise _MissingEncoding()
+                if kind == 'error':
+                    raise WorkerError(value)
+                if not stream:
+                    yield value
+                return
+        except queue.Empty:
+            # The ping thread still answers while a torch loop hangs, so the
+            # timeout is what takes a stuck worker out of rotation.
+            self._restart(worker)
+            raise WorkerError(f"worker {worker.worker_id} timed out")
+        finally:
+            with self._lock:
+                self._calls.pop(req_id, None)
+                worker.inflight -= 1
+
+    def _share_image(self, image_key: str, image: Image.Image) -> Tuple[str, Tuple[int, int], str]:
+        """Put the image in shared memory and pin it; the caller must _unpin it."""
+        with self._lock:
+            entry = self._images.get(image_key)
+            if entry is not None:
+                self._images.move_to_end(image_key)
+                self._pins[image_key] += 1
+                return entry[0].name, entry[1], entry[2]
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        data = image.tobytes()
+        shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        shm.buf[:len(data)] = data
+        with self._lock:
+            entry = self._images.get(image_key)
+            if entry is not None:
+                # Another thread shared the same image meanwhile.
+                shm.close()
+                shm.unlink()
+                self._images.move_to_end(image_key)
+                self._pins[image_key] += 1
+                return entry[0].name, entry[1], entry[2]
+            self._images[image_key] = (shm, image.size, image.mode)
+            self._image_bytes += shm.size
+            self._pins[image_key] += 1
+            self._evict_images()
+        return shm.name, image.size, image.mode
+
+    def _unpin(self, image_key: str) -> None:
+        with self._lock:
+            self._pins[image_key] -= 1
+            if self._pins[image_key] <= 0:
+                del self._pins[image_key]
+            self._evict_images()
+
+    def _evict_images(self) -> None:
+        # Called with the lock held. Least recently used first, skipping
+        # pinned segments; the limit may be exceeded until they are unpinned.
+        for key in list(self._images):
+            if self._image_bytes <= WORKER_SHM_BYTES or len(self._images) <= 1:
+                return
+            if self._pins[key]:
+                continue
+            old, _, _ = self._images.pop(key)
+            self._image_bytes -= old.size
+            old.close()
+            old.unlink()
+
+    def _shared(self, image_key: str) -> Tuple[str, Tuple[int, int], str]:
+        """Like _share_image, sharing the stored blob again if the segment was evicted."""
+        with self._lock:
+            entry = self._images.get(image_key)
+            if entry is not None:
+                self._images.move_to_end(image_key)
+                self._pins[image_key] += 1
+                return entry[0].name, entry[1], entry[2]
+        from services.image_service import ImageService
+
+        # Evicted from shared memory; stored images are named by the same
+        # content hash, so the blob is shared again.
+        image = ImageService.load_image(ImageService.blob_path(image_key))
+        if image is None:
+            raise WorkerError("Image is no longer in shared memory or storage; encode it again")
+        return self._share_image(image_key, image)
+
+    def _encode_on(self, worker: _Worker, image_key: str) -> None:
+        shm_name, size, mode = self._shared(image_key)
+        try:
+            list(self._call(worker, 'encode', (shm_name, size, mode, image_key)))
+        finally:
+            self._unpin(image_key)
+        with self._lock:
+            self._affinity[image_key] = worker.worker_id
+
+    def encode_image(self, image: Image.Image) -> RemoteEncoding:
+        from services.image_service import ImageService
+
+        image_key = ImageService.content_hash(image)
+        self._share_image(image_key, image)
+        try:
+            self._encode_on(self._pick_worker(image_key), image_key)
+        finally:
+            self._unpin(image_key)
+        return RemoteEncoding(image_key)
+
+    def _query(self, encoding: RemoteEncoding, question: str, stream: bool, settings: Optional[Dict]):
+        for attempt in range(2):
+            worker = self._pick_worker(encoding.image_key)
+            try:
+                if attempt:
+                    self._encode_on(worker, encoding.image_key)
+                yield from self._call(worker, 'query', (encoding.image_key, question, stream, settings), stream)
+                return
+            except _MissingEncoding:
+                with self._lock:
+                    self._affinity.pop(encoding.image_key, None)
+        raise WorkerError("Could not place the image encoding on a worker")
+
+    def query(self, encoding: RemoteEncoding, question: str, stream: bool = False, settings: Optional[Dict] = None, **kwargs):
+        if stream:
+            return {'answer': self._query(encoding, question, True, settings)}
+        return {'answer': next(self._query(encoding, question, False, settings))}
+
+    def submit_query(self, encoding: RemoteEncoding, question: str, settings: Optional[Dict]) -> Future:
+        return self._executor.submit(lambda: self.query(encoding, question, settings=settings)['answer'])
+
+
+class RemoteModel(Model):
+    def __init__(self, num_workers: int, model_factory=None):
+        super().__init__()
+        self.num_workers = num_workers
+        self.model_factory = model_factory
+        # Workers serialize their own torch calls; the client only routes.
+        self._inference_lock = nullcontext()
+
+    def load_model(self, warmup: bool = False, precision: str = MODEL_PRECISION, num_threads=TORCH_NUM_THREADS):
+        self.state = ModelState.LOADING
+        self.load_error = None
+        client = WorkerPoolClient(self.num_workers, precision, num_threads, self.model_factory)
+        try:
+            client.start()
+            self.model = client
+        except Exception as e:
+            self.model = None
+            self.load_error = e
+            Metrics.record_error("model.load_model", e)
+        self.state = ModelState.READY if self.model is not None else ModelState.FAILED
+
+    def _answer_batch(self, requests: List[Tuple[object, str]], tokens: Optional[List] = None) -> List:
+        # A query already sent to a worker runs to completion; cancellation
+        # only keeps abandoned requests from being dispatched.
+        futures = []
+        for (enc, question), token in zip(requests, tokens or [None] * len(requests)):
+            try:
+                if token is not None:
+                    token.check()
+                futures.append(self.model.submit_query(enc, question, GENERATION_SETTINGS))
+            except Exception as e:
+                futures.append(e)
+        answers = []
+        for future in futures:
+            if isinstance(future, Exception):
+                answers.append(future)
+                continue
+            try:
+                answers.append(future.result())
+            except Exception as e:
+                answers.append(e)
+        return answers
+
+    def worker_health(self) -> List[Dict]:
+        return self.model.health() if self.model is not None else []
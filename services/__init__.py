@@ -1,4 +1,8 @@
 from services.chat_service import ChatService
 from services.image_service import ImageService
+from services.metrics import Metrics
+from services.retention_service import RetentionService
+from services.insight_service import InsightService
+from services.frame_service import FrameService
 
-__all__ = ['ChatService', 'ImageService']
+__all__ = ['ChatService', 'ImageService', 'Metrics', 'RetentionService', 'InsightService', 'FrameService']
@@ -1,20 +1,40 @@
-import json
 import os
+import threading
 from datetime import datetime
-from typing import List, Dict, Optional
-from config import CHAT_HISTORY_FILE, MAX_CHAT_HISTORY, IMAGE_STORAGE_DIR
+from typing import List, Dict, Optional, Tuple
+from config import CHAT_HISTORY_FILE, CHAT_HISTORY_DB, HISTORY_BACKEND, MAX_CHAT_HISTORY, RETENTION_ENABLED
+from services.image_service import ImageService
+from services.metrics import Metrics
+from services.history_store import HistoryStore, JsonHistoryStore, SqliteHistoryStore
 
 
 class ChatService:
+    _store: Optional[HistoryStore] = None
+    _store_lock = threading.Lock()
+    # (store, revision, limit, summaries) from the last session_summaries call.
+    _summaries: Optional[Tuple] = None
+
+    @staticmethod
+    def get_store() -> HistoryStore:
+        with ChatService._store_lock:
+            if ChatService._store is None:
+                if HISTORY_BACKEND == "sqlite":
+                    ChatService._store = SqliteHistoryStore(CHAT_HISTORY_DB, legacy_json_path=CHAT_HISTORY_FILE)
+                else:
+                    ChatService._store = JsonHistoryStore(CHAT_HISTORY_FILE)
+            return ChatService._store
+
+    @staticmethod
+    def set_store(store: HistoryStore) -> None:
+        with ChatService._store_lock:
+            if ChatService._store is not None and ChatService._store is not store:
+                ChatService._store.close()
+            ChatService._store = store
+
     @staticmethod
     def load_history() -> List[Dict]:
-        if os.path.exists(CHAT_HISTORY_FILE):
-            try:
-                with open(CHAT_HISTORY_FILE, 'r') as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, IOError):
-                return []
-        return []
+        with Metrics.span("chat.load_history"):
+            return ChatService.get_store().load_all()
     
     @staticmethod
     def save_history(history: List[Dict]) -> None:
@@ -23,20 +43,69 @@ class ChatService:
         history = history[-MAX_CHAT_HISTORY:]
         new_chat_ids = {chat['id'] for chat in history}
         
-        removed_chat_ids = old_chat_ids - new_chat_ids
-        for chat_id in removed_chat_ids:
-            for ext in ['.png', '.jpg', '.jpeg']:
-                img_path = os.path.join(IMAGE_STORAGE_DIR, f"{chat_id}{ext}")
-                if os.path.exists(img_path):
-                    try:
-                        os.remove(img_path)
-                    except OSError:
-                        pass
-        
-        os.makedirs(os.path.dirname(CHAT_HISTORY_FILE), exist_ok=True)
-        with open(CHAT_HISTORY_FILE, 'w') as f:
-            json.dump(history, f, indent=2)
+        with Metrics.span("chat.save_history"):
+            # With retention enabled, images of dropped chats are reclaimed by
+            # the background sweep instead of on the request path.
+            if not RETENTION_ENABLED:
+                removed_chat_ids = old_chat_ids - new_chat_ids
+                for chat_id in removed_chat_ids:
+                    ImageService.release_image(chat_id)
+            
+            ChatService.get_store().replace_all(history)
+
+    @staticmethod
+    def save_session(session: Dict) -> None:
+        with Metrics.span("chat.save_session"):
+            store = ChatService.get_store()
+            store.upsert_session(session)
+            # The count cap is cheap, so it is kept inline even with retention
+            # enabled; only the images of pruned chats wait for the sweep.
+            pruned = store.prune(MAX_CHAT_HISTORY)
+            if not RETENTION_ENABLED:
+                for chat_id in pruned:
+                    ImageService.release_image(chat_id)
+
+    @staticmethod
+    def get_session(session_id: str) -> Optional[Dict]:
+        return ChatService.get_store().get_session(session_id)
+
+    @staticmethod
+    def save_insights(session_id: str, insights: Dict) -> bool:
+        with Metrics.span("chat.save_insights"):
+            return ChatService.get_store().set_insights(session_id, insights)
+
+    @staticmethod
+    def get_insights(session_id: str) -> Optional[Dict]:
+        for summary in ChatService.session_summaries():
+            if summary['id'] == session_id:
+                return summary.get('insights')
+        return None
+
+    @staticmethod
+    def recent_sessions(limit: int = MAX_CHAT_HISTORY) -> List[Dict]:
+        with Metrics.span("chat.recent_sessions"):
+            return ChatService.get_store().recent_sessions(limit)
     
+    @staticmethod
+    def session_summaries(limit: int = MAX_CHAT_HISTORY) -> List[Dict]:
+        """Recent sessions without their messages, reused until the history changes.
+
+        The returned list is shared between callers and must not be modified.
+        """
+        store = ChatService.get_store()
+        revision = store.revision()
+        cached = ChatService._summaries
+        if (revision is not None and cached is not None and cached[0] is store
+                and cached[1] == revision and cached[2] >= limit):
+            Metrics.inc("chatmoon_cache_requests_total", cache="history_summaries", result="hit")
+            return cached[3][:limit]
+        Metrics.inc("chatmoon_cache_requests_total", cache="history_summaries", result="miss")
+        fetch = max(limit, MAX_CHAT_HISTORY)
+        with Metrics.span("chat.session_summaries"):
+            summaries = store.session_summaries(fetch)
+        ChatService._summaries = (store, revision, fetch, summaries)
+        return summaries[:limit]
+
     @staticmethod
     def create_session(image_name: str) -> Dict:
         chat_id = datetime.now().isoformat()
@@ -44,7 +113,6 @@ class ChatService:
             'id': chat_id,
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             'image_name': image_name,
-            'image_path': os.path.join(IMAGE_STORAGE_DIR, f"{chat_id}.png"),
             'messages': []
         }
     
@@ -0,0 +1,188 @@
+"""
+Frame Service - Multi-frame input from videos, animated GIFs and image sets
+
+Frames are decoded one at a time, so a long clip is never held in memory, and
+sampled every FRAME_SAMPLE_SECONDS, or more sparsely when the clip is too long
+for FRAME_MAX_COUNT samples at that rate to reach its end. Each sampled frame
+is compared with the last kept one by a 64-bit difference hash (dHash) and
+near-duplicates are dropped before any model work. Kept frames are stored like uploaded images and
+encoded in batches of FRAME_ENCODE_BATCH_SIZE, with the next batch decoding
+while the previous one encodes.
+"""
+import os
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from PIL import Image, ImageSequence
+from services.image_service import ImageService
+from services.metrics import Metrics
+from config import (
+    SUPPORTED_VIDEO_TYPES,
+    FRAME_SAMPLE_SECONDS,
+    FRAME_MAX_COUNT,
+    FRAME_DEDUP_MAX_DISTANCE,
+    FRAME_ENCODE_BATCH_SIZE,
+)
+
+
+class FrameDecodeError(RuntimeError):
+    pass
+
+
+class FrameService:
+    _encoder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="frame-encoder")
+
+    @staticmethod
+    def is_video(name: str) -> bool:
+        return os.path.splitext(name)[1].lower().lstrip('.') in SUPPORTED_VIDEO_TYPES
+
+    @staticmethod
+    def dhash(image: Image.Image) -> int:
+        small = image.resize((9, 8), Image.BILINEAR).convert("L")
+        pixels = list(small.getdata())
+        bits = 0
+        for row in range(8):
+            for col in range(8):
+                bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+        return bits
+
+    @staticmethod
+    def format_timestamp(seconds: float) -> str:
+        return f"{int(seconds // 60)}:{seconds % 60:04.1f}"
+
+    @staticmethod
+    def sample_interval(duration: Optional[float]) -> float:
+        # Spreads FRAME_MAX_COUNT samples over the whole clip when it is long;
+        # an unknown duration falls back to the fixed interval.
+        if not duration:
+            return FRAME_SAMPLE_SECONDS
+        return max(FRAME_SAMPLE_SECONDS, duration / FRAME_MAX_COUNT)
+
+    @staticmethod
+    def open_frames(uploads: List) -> Iterator[Tuple[str, Image.Image]]:
+        """(label, frame) for every upload, labelled by time within a clip and by name across files."""
+        for upload in uploads:
+            prefix = f"{upload.name} " if len(uploads) > 1 else ""
+            if upload.name.lower().endswith('.gif'):
+                frames = FrameService.iter_animation(upload)
+            elif FrameService.is_video(upload.name):
+                frames = FrameService.iter_video(upload)
+            else:
+                try:
+                    yield upload.name, Image.open(upload)
+                except (IOError, OSError):
+                    raise FrameDecodeError(f"{upload.name} is not a supported image")
+                continue
+            for seconds, frame in frames:
+                yield f"{prefix}{FrameService.format_timestamp(seconds)}", frame
+
+    @staticmethod
+    def iter_video(source) -> Iterator[Tuple[float, Image.Image]]:
+        try:
+            import av
+        except ImportError:
+            raise FrameDecodeError("Video input needs PyAV (pip install av)")
+        try:
+            with av.open(source) as container:
+                stream = container.streams.video[0]
+                stream.thread_type = "AUTO"
+                if stream.duration is not None and stream.time_base is not None:
+                    duration = float(stream.duration * stream.time_base)
+                elif container.duration is not None:
+                    duration = container.duration / av.time_base
+                else:
+                    duration = None
+                interval = FrameService.sample_interval(duration)
+                next_sample = 0.0
+                for frame in container.decode(stream):
+                    if frame.time is None or frame.time < next_sample:
+                        continue
+                    next_sample = frame.time + interval
+                    yield frame.time, frame.to_image()
+        except (av.FFmpegError, IndexError) as e:
+            raise FrameDecodeError(f"Could not decode video: {e}")
+
+    @staticmethod
+    def iter_animation(source) -> Iterator[Tuple[float, Image.Image]]:
+        try:
+            animation = Image.open(source)
+        except (IOError, OSError):
+            raise FrameDecodeError("Could not decode animation")
+        duration = sum(frame.info.get('duration', 100) for frame in ImageSequence.Iterator(animation)) / 1000
+        interval = FrameService.sample_interval(duration)
+        elapsed, next_sample = 0.0, 0.0
+        for frame in ImageSequence.Iterator(animation):
+            if elapsed >= next_sample:
+                next_sample = elapsed + interval
+                yield elapsed, frame.convert("RGB")
+            elapsed += frame.info.get('duration', 100) / 1000
+
+    @staticmethod
+    def sample_frames(frames: Iterable[Tuple[str, Image.Image]]) -> Iterator[Dict]:
+        """Preprocessed frames, skipping near-duplicates of the last kept frame."""
+        last_hash = None
+        kept = 0
+        for label, frame in frames:
+            frame_hash = FrameService.dhash(frame)
+            if last_hash is not None and bin(frame_hash ^ last_hash).count('1') <= FRAME_DEDUP_MAX_DISTANCE:
+                Metrics.inc("chatmoon_frames_total", result="duplicate")
+                continue
+            last_hash = frame_hash
+            Metrics.inc("chatmoon_frames_total", result="kept")
+            yield {'label': label, 'image': ImageService.preprocess(frame)}
+            kept += 1
+            if kept >= FRAME_MAX_COUNT:
+                return
+
+    @staticmethod
+    def ingest(model, frames: Iterable[Tuple[str, Image.Image]], chat_id: str) -> Tuple[List[Dict], List]:
+        """Store and encode the sampled frames of one chat.
+
+        Returns the frame records for the session ({'label', 'image_path'})
+        and the matching encodings, None where encoding failed.
+        """
+        records, encodings = [], []
+        batch: List[Tuple[Image.Image, str]] = []
+        pending: Optional[Future] = None
+        with Metrics.span("frames.ingest"):
+            for frame in FrameService.sample_frames(frames):
+                content_hash = ImageService.content_hash(frame['image'])
+                records.append({
+                    'label': frame['label'],
+                    'image_path': ImageService.save_image(frame['image'], chat_id, content_hash),
+                })
+                batch.append((frame['image'], content_hash))
+                if len(batch) == FRAME_ENCODE_BATCH_SIZE:
+                    pending = FrameService._encode_after(model, pending, batch, encodings)
+                    batch = []
+            if batch:
+                pending = FrameService._encode_after(model, pending, batch, encodings)
+            if pending is not None:
+                encodings.extend(pending.result())
+        return records, encodings
+
+    @staticmethod
+    def _encode_after(model, pending: Optional[Future], batch, encodings: List) -> Future:
+        # Waiting for the previous batch first keeps at most one batch decoded
+        # ahead of the encoder.
+        if pending is not None:
+            encodings.extend(pending.result())
+        images, hashes = zip(*batch)
+        return FrameService._encoder.submit(model.encode_batch, list(images), list(hashes))
+
+    @staticmethod
+    def attribute_answers(frame_answers: List[Dict]) -> Optional[str]:
+        """One line per distinct answer, naming the frames that gave it, and the frames that gave none."""
+        grouped = OrderedDict()
+        unanswered = []
+        for item in frame_answers:
+            if item['answer']:
+                grouped.setdefault(item['answer'].strip(), []).append(item['label'])
+            else:
+                unanswered.append(item['label'])
+        if not grouped:
+            return None
+        lines = [f"**{', '.join(labels)}**: {answer}" for answer, labels in grouped.items()]
+        if unanswered:
+            lines.append(f"_No answer for {', '.join(unanswered)} (failed or timed out)._")
+        return "\n\n".join(lines)
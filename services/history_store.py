@@ -0,0 +1,494 @@
+"""
+History Store - Pluggable persistence backends for chat sessions
+"""
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+SESSION_COLUMNS = ('id', 'timestamp', 'image_name', 'image_path', 'chat_name')
+# Written in the background by InsightService. A session saved without this
+# key keeps the stored value, so a stale copy held by the UI cannot drop it.
+INSIGHTS_KEY = 'insights'
+
+
+def summarize_session(session: Dict) -> Dict:
+    summary = {k: v for k, v in session.items() if k != 'messages'}
+    summary['message_count'] = len(session.get('messages', []))
+    return summary
+
+
+class HistoryStore(ABC):
+    """Persistence interface used by ChatService.
+
+    Sessions are returned oldest first, matching the order of the original
+    JSON history list.
+    """
+
+    @abstractmethod
+    def load_all(self) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_session(self, session_id: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def recent_sessions(self, limit: int) -> List[Dict]:
+        raise NotImplementedError
+
+    def session_summaries(self, limit: int) -> List[Dict]:
+        """Newest first, with a message_count in place of the messages."""
+        return [summarize_session(session) for session in self.recent_sessions(limit)]
+
+    def revision(self):
+        """Opaque value that changes whenever the stored history changes, or None if unknown."""
+        return None
+
+    def count_sessions(self) -> int:
+        return len(self.load_all())
+
+    @abstractmethod
+    def size_bytes(self) -> int:
+        """Bytes of history currently stored, ignoring space a compaction would free."""
+        raise NotImplementedError
+
+    def compact(self) -> int:
+        """Give free space back to the filesystem; returns the bytes reclaimed."""
+        return 0
+
+    @abstractmethod
+    def upsert_session(self, session: Dict) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    @abstractmethod
+    def set_insights(self, session_id: str, insights: Dict) -> bool:
+        """Attach insights to a stored session; False if the session no longer exists."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_sessions(self, session_ids: Iterable[str]) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def prune(self, max_sessions: int) -> List[str]:
+        raise NotImplementedError
+
+    def replace_all(self, history: List[Dict]) -> None:
+        keep_ids = {session['id'] for session in history}
+        stale_ids = [s['id'] for s in self.load_all() if s['id'] not in keep_ids]
+        self.delete_sessions(stale_ids)
+        for session in history:
+            self.upsert_session(session)
+
+
+class JsonHistoryStore(HistoryStore):
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self) -> List[Dict]:
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    return json.load(f)
+            except (json.JSONDecodeError, IOError):
+                return []
+        return []
+
+    def _write(self, history: List[Dict]) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(history, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def load_all(self) -> List[Dict]:
+        return self._read()
+
+    def get_session(self, session_id: str) -> Optional[Dict]:
+        for session in self._read():
+            if session['id'] == session_id:
+                return session
+        return None
+
+    def recent_sessions(self, limit: int) -> List[Dict]:
+        return list(reversed(self._read()[-limit:])) if limit > 0 else []
+
+    def revision(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return (0, 0)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def count_sessions(self) -> int:
+        return len(self._read())
+
+    def size_bytes(self) -> int:
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def upsert_session(self, session: Dict) -> None:
+        with self._lock:
+            history = self._read()
+            for i, existing in enumerate(history):
+                if existing['id'] == session['id']:
+                    if INSIGHTS_KEY not in session and INSIGHTS_KEY in existing:
+                        session = dict(session, **{INSIGHTS_KEY: existing[INSIGHTS_KEY]})
+                    history[i] = session
+                    break
+            else:
+                history.append(session)
+            self._write(history)
+
+    def set_insights(self, session_id: str, insights: Dict) -> bool:
+        with self._lock:
+            history = self._read()
+            for session in history:
+                if session['id'] == session_id:
+                    session[INSIGHTS_KEY] = insights
+                    self._write(history)
+                    return True
+            return False
+
+    def delete_sessions(self, session_ids: Iterable[str]) -> None:
+        session_ids = set(session_ids)
+        if not session_ids:
+            return
+        with self._lock:
+            self._write([s for s in self._read() if s['id'] not in session_ids])
+
+    def prune(self, max_sessions: int) -> List[str]:
+        with self._lock:
+            history = self._read()
+            if len(history) <= max_sessions:
+                return []
+            cut = len(history) - max_sessions
+            removed = [s['id'] for s in history[:cut]]
+            self._write(history[cut:])
+            return removed
+
+    def replace_all(self, history: List[Dict]) -> None:
+        with self._lock:
+            self._write(history)
+
+
+class SqliteHistoryStore(HistoryStore):
+    """SQLite backend in WAL mode.
+
+    Session metadata lives in one row per session and messages are append-only
+    rows keyed by (session_id, idx). Keys the schema does not know about are
+    kept in the session's extra JSON column, except insights, which have their
+    own table so they can be written without rewriting the session row.
+    """
+
+    def __init__(self, path: str, legacy_json_path: Optional[str] = None):
+        self.path = path
+        self._local = threading.local()
+        # Every connection by the thread that opened it, so connections of
+        # finished threads (Streamlit starts one per script run) get closed.
+        self._conns: Dict[threading.Thread, sqlite3.Connection] = {}
+        self._conns_lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._create_schema()
+        if legacy_json_path:
+            self.migrate_from_json(legacy_json_path)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # check_same_thread is off only so close() can run from another
+            # thread; each connection is still used by its own thread alone.
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+            with self._conns_lock:
+                for thread in [t for t in self._conns if not t.is_alive()]:
+                    self._conns.pop(thread).close()
+                self._conns[threading.current_thread()] = conn
+        return conn
+
+    def close(self) -> None:
+        with self._conns_lock:
+            for conn in self._conns.values():
+                conn.close()
+            self._conns.clear()
+        self._local = threading.local()
+
+    def _create_schema(self) -> None:
+        with self._conn() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS sessions (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT NOT NULL UNIQUE,
+                    timestamp TEXT,
+                    image_name TEXT,
+                    image_path TEXT,
+                    chat_name TEXT,
+                    extra TEXT
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    session_id TEXT NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+                    idx INTEGER NOT NULL,
+                    question TEXT,
+                    answer TEXT,
+                    timestamp TEXT,
+                    extra TEXT,
+                    PRIMARY KEY (session_id, idx)
+                );
+                CREATE TABLE IF NOT EXISTS session_insights (
+                    session_id TEXT PRIMARY KEY REFERENCES sessions(id) ON DELETE CASCADE,
+                    data TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS history_revision (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    value INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO history_revision (id, value) VALUES (0, 0);
+                CREATE TRIGGER IF NOT EXISTS sessions_insert_revision AFTER INSERT ON sessions
+                BEGIN UPDATE history_revision SET value = value + 1; END;
+                CREATE TRIGGER IF NOT EXISTS sessions_update_revision AFTER UPDATE ON sessions
+                BEGIN UPDATE history_revision SET value = value + 1; END;
+                CREATE TRIGGER IF NOT EXISTS sessions_delete_revision AFTER DELETE ON sessions
+                BEGIN UPDATE history_revision SET value = value + 1; END;
+                CREATE TRIGGER IF NOT EXISTS messages_insert_revision AFTER INSERT ON messages
+                BEGIN UPDATE history_revision SET value = value + 1; END;
+                CREATE TRIGGER IF NOT EXISTS messages_update_revision AFTER UPDATE ON messages
+                BEGIN UPDATE history_revision SET value = value + 1; END;
+                CREATE TRIGGER IF NOT EXISTS messages_delete_revision AFTER DELETE ON messages
+                BEGIN UPDATE history_revision SET value = value + 1; END;
+                CREATE TRIGGER IF NOT EXISTS insights_insert_revision AFTER INSERT ON session_insights
+                BEGIN UPDATE history_revision SET value = value + 1; END;
+                CREATE TRIGGER IF NOT EXISTS insights_update_revision AFTER UPDATE ON session_insights
+                BEGIN UPDATE history_revision SET value = value + 1; END;
+                """
+            )
+
+    @staticmethod
+    def _split_extra(record: Dict, known: Iterable[str]) -> Optional[str]:
+        extra = {k: v for k, v in record.items() if k not in known}
+        return json.dumps(extra) if extra else None
+
+    _SELECT_SESSIONS = (
+        "SELECT s.*, i.data AS insights FROM sessions s LEFT JOIN session_insights i ON i.session_id = s.id"
+    )
+
+    def _session_from_row(self, row: sqlite3.Row, messages: Optional[List[Dict]]) -> Dict:
+        session = {}
+        for column in SESSION_COLUMNS:
+            if row[column] is not None:
+                session[column] = row[column]
+        if row['extra']:
+            session.update(json.loads(row['extra']))
+        if row['insights']:
+            session[INSIGHTS_KEY] = json.loads(row['insights'])
+        if messages is not None:
+            session['messages'] = messages
+        return session
+
+    @staticmethod
+    def _message_from_row(row: sqlite3.Row) -> Dict:
+        message = {
+            'question': row['question'],
+            'answer': row['answer'],
+            'timestamp': row['timestamp'],
+        }
+        if row['extra']:
+            message.update(json.loads(row['extra']))
+        return message
+
+    def _load_sessions(self, rows: List[sqlite3.Row]) -> List[Dict]:
+        if not rows:
+            return []
+        ids = [row['id'] for row in rows]
+        placeholders = ','.join('?' * len(ids))
+        messages = {session_id: [] for session_id in ids}
+        for row in self._conn().execute(
+            f"SELECT * FROM messages WHERE session_id IN ({placeholders}) ORDER BY session_id, idx",
+            ids
+        ):
+            messages[row['session_id']].append(self._message_from_row(row))
+        return [self._session_from_row(row, messages[row['id']]) for row in rows]
+
+    def load_all(self) -> List[Dict]:
+        rows = self._conn().execute(f"{self._SELECT_SESSIONS} ORDER BY s.seq").fetchall()
+        return self._load_sessions(rows)
+
+    def get_session(self, session_id: str) -> Optional[Dict]:
+        rows = self._conn().execute(f"{self._SELECT_SESSIONS} WHERE s.id = ?", (session_id,)).fetchall()
+        sessions = self._load_sessions(rows)
+        return sessions[0] if sessions else None
+
+    def recent_sessions(self, limit: int) -> List[Dict]:
+        rows = self._conn().execute(
+            f"{self._SELECT_SESSIONS} ORDER BY s.seq DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return self._load_sessions(rows)
+
+    def session_summaries(self, limit: int) -> List[Dict]:
+        rows = self._conn().execute(
+            """
+            SELECT s.*, i.data AS insights,
+                (SELECT COUNT(*) FROM messages m WHERE m.session_id = s.id) AS message_count
+            FROM sessions s LEFT JOIN session_insights i ON i.session_id = s.id
+            ORDER BY s.seq DESC LIMIT ?
+            """,
+            (limit,)
+        ).fetchall()
+        summaries = []
+        for row in rows:
+            summary = self._session_from_row(row, None)
+            summary['message_count'] = row['message_count']
+            summaries.append(summary)
+        return summaries
+
+    def revision(self):
+        # Bumped by triggers, so writes from other processes count too.
+        return self._conn().execute("SELECT value FROM history_revision WHERE id = 0").fetchone()[0]
+
+    def upsert_session(self, session: Dict) -> None:
+        conn = self._conn()
+        with conn:
+            self._upsert_session(conn, session)
+
+    def _upsert_session(self, conn: sqlite3.Connection, session: Dict) -> None:
+        values = [session.get(column) for column in SESSION_COLUMNS]
+        extra = self._split_extra(session, SESSION_COLUMNS + ('messages', INSIGHTS_KEY))
+        conn.execute(
+            """
+            INSERT INTO sessions (id, timestamp, image_name, image_path, chat_name, extra)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                timestamp = excluded.timestamp,
+                image_name = excluded.image_name,
+                image_path = excluded.image_path,
+                chat_name = excluded.chat_name,
+                extra = excluded.extra
+            """,
+            values + [extra]
+        )
+        if INSIGHTS_KEY in session:
+            self._write_insights(conn, session['id'], session[INSIGHTS_KEY])
+        # Appends are the common case, but edited or removed messages are
+        # written too, so only rows that differ are touched.
+        stored = {
+            row['idx']: tuple(row)[1:]
+            for row in conn.execute(
+                "SELECT idx, question, answer, timestamp, extra FROM messages WHERE session_id = ?",
+                (session['id'],)
+            )
+        }
+        messages = session.get('messages', [])
+        for idx, message in enumerate(messages):
+            values = self._message_values(message)
+            if idx not in stored:
+                conn.execute(
+                    "INSERT INTO messages (session_id, idx, question, answer, timestamp, extra) VALUES (?, ?, ?, ?, ?, ?)",
+                    (session['id'], idx) + values
+                )
+            elif stored[idx] != values:
+                conn.execute(
+                    "UPDATE messages SET question = ?, answer = ?, timestamp = ?, extra = ? WHERE session_id = ? AND idx = ?",
+                    values + (session['id'], idx)
+                )
+        if len(stored) > len(messages):
+            conn.execute("DELETE FROM messages WHERE session_id = ? AND idx >= ?", (session['id'], len(messages)))
+
+    def _message_values(self, message: Dict) -> Tuple:
+        return (
+            message.get('question'),
+            message.get('answer'),
+            message.get('timestamp'),
+            self._split_extra(message, ('question', 'answer', 'timestamp')),
+        )
+
+    @staticmethod
+    def _write_insights(conn: sqlite3.Connection, session_id: str, insights: Dict) -> int:
+        # Selecting from sessions turns a missing session into a no-op instead
+        # of a foreign key error.
+        return conn.execute(
+            """
+            INSERT INTO session_insights (session_id, data)
+            SELECT id, ? FROM sessions WHERE id = ?
+            ON CONFLICT(session_id) DO UPDATE SET data = excluded.data
+            """,
+            (json.dumps(insights), session_id)
+        ).rowcount
+
+    def set_insights(self, session_id: str, insights: Dict) -> bool:
+        conn = self._conn()
+        with conn:
+            return self._write_insights(conn, session_id, insights) > 0
+
+    def delete_sessions(self, session_ids: Iterable[str]) -> None:
+        session_ids = list(session_ids)
+        if not session_ids:
+            return
+        conn = self._conn()
+        with conn:
+            conn.executemany("DELETE FROM sessions WHERE id = ?", [(i,) for i in session_ids])
+
+    def prune(self, max_sessions: int) -> List[str]:
+        conn = self._conn()
+        with conn:
+            removed = [
+                row['id'] for row in conn.execute(
+                    "SELECT id FROM sessions ORDER BY seq DESC LIMIT -1 OFFSET ?", (max_sessions,)
+                )
+            ]
+            conn.executemany("DELETE FROM sessions WHERE id = ?", [(i,) for i in removed])
+        return removed
+
+    def count_sessions(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def size_bytes(self) -> int:
+        conn = self._conn()
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        used = conn.execute("PRAGMA page_count").fetchone()[0] - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return used * page_size
+
+    def _file_bytes(self) -> int:
+        total = 0
+        for suffix in ('', '-wal'):
+            try:
+                total += os.path.getsize(self.path + suffix)
+            except OSError:
+                pass
+        return total
+
+    def compact(self) -> int:
+        conn = self._conn()
+        before = self._file_bytes()
+        pages = conn.execute("PRAGMA page_count").fetchone()[0]
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        # VACUUM rewrites the whole file, so only pay for it once a quarter of
+        # the pages are free.
+        if pages and free * 4 >= pages:
+            conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return max(0, before - self._file_bytes())
+
+    def migrate_from_json(self, json_path: str) -> int:
+        if not os.path.exists(json_path) or self.count_sessions() > 0:
+            return 0
+        history = JsonHistoryStore(json_path).load_all()
+        conn = self._conn()
+        with conn:
+            for session in history:
+                self._upsert_session(conn, session)
+        os.replace(json_path, f"{json_path}.migrated")
+        return len(history)
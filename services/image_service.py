@@ -1,26 +1,332 @@
 """
 Image Service - Handles image storage and retrieval
+
+Images are stored once per distinct content under IMAGE_STORAGE_DIR, named by
+their content hash. IMAGE_REFS_FILE maps each hash to the chat ids that use it,
+and a blob is removed when its last chat releases it. Images uploaded through
+the API are referenced as "api:<hash>" instead of by a chat, and expire by
+last use rather than with the history.
+
+Uploads are preprocessed once (EXIF orientation, downscale to the size the
+vision encoder uses) and the stored variant is written off the request thread,
+losslessly by default since reopened chats encode from it. A smaller lossy
+display copy is written next to it for the chat page.
 """
+import hashlib
+import json
 import os
-from PIL import Image
-from typing import Optional
-from config import IMAGE_STORAGE_DIR
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from PIL import Image, ImageOps
+from typing import Dict, List, Optional, Tuple
+from services.metrics import Metrics
+from config import (
+    IMAGE_STORAGE_DIR,
+    IMAGE_REFS_FILE,
+    IMAGE_MAX_SIDE,
+    IMAGE_STORAGE_FORMAT,
+    IMAGE_STORAGE_QUALITY,
+    IMAGE_STORAGE_LOSSLESS,
+    IMAGE_DISPLAY_MAX_SIDE,
+    IMAGE_DISPLAY_QUALITY,
+    IMAGE_WRITE_WORKERS,
+)
+
+BLOB_EXTENSIONS = {'WEBP': '.webp', 'JPEG': '.jpg', 'PNG': '.png'}
+API_REF_PREFIX = "api:"
 
 
 class ImageService:
     
+    _refs_lock = threading.Lock()
+    _writer = ThreadPoolExecutor(max_workers=IMAGE_WRITE_WORKERS, thread_name_prefix="image-writer")
+    _pending_lock = threading.Lock()
+    _pending: Dict[str, Future] = {}
+    _pending_images: Dict[str, Image.Image] = {}
+
+    @staticmethod
+    def preprocess(image: Image.Image) -> Image.Image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if max(image.size) > IMAGE_MAX_SIDE:
+            image = image.copy()
+            image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+        return image
+
+    @staticmethod
+    def content_hash(image: Image.Image) -> str:
+        digest = hashlib.sha256()
+        digest.update(f"{image.mode}:{image.size}".encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def content_hash_for_path(image_path: str) -> Optional[str]:
+        stem = os.path.splitext(os.path.basename(image_path))[0]
+        if len(stem) == 64 and all(c in '0123456789abcdef' for c in stem):
+            return stem
+        return None
+
+    @staticmethod
+    def blob_path(content_hash: str) -> str:
+        ext = BLOB_EXTENSIONS.get(IMAGE_STORAGE_FORMAT, '.png')
+        return os.path.join(IMAGE_STORAGE_DIR, f"{content_hash}{ext}")
+
+    @staticmethod
+    def display_path(image_path: str) -> str:
+        root, ext = os.path.splitext(image_path)
+        return f"{root}.display{ext}"
+
     @staticmethod
-    def save_image(image: Image.Image, chat_id: str) -> str:
-        os.makedirs(IMAGE_STORAGE_DIR, exist_ok=True)
-        image_path = os.path.join(IMAGE_STORAGE_DIR, f"{chat_id}.png")
-        image.save(image_path)
-        return image_path
+    def stored_bytes(image_path: str) -> int:
+        """Size on disk of a stored image together with its display copy."""
+        total = 0
+        for path in (image_path, ImageService.display_path(image_path)):
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+        return total
+
+    @staticmethod
+    def save_image(image: Image.Image, chat_id: str, content_hash: Optional[str] = None) -> str:
+        with Metrics.span("image.save_image"):
+            os.makedirs(IMAGE_STORAGE_DIR, exist_ok=True)
+            content_hash = content_hash or ImageService.content_hash(image)
+            image_path = ImageService.blob_path(content_hash)
+
+            with ImageService._pending_lock:
+                if image_path not in ImageService._pending and not os.path.exists(image_path):
+                    ImageService._pending_images[image_path] = image
+                    ImageService._pending[image_path] = ImageService._writer.submit(
+                        ImageService._write_blob, image, image_path
+                    )
+
+            with ImageService._refs_lock:
+                refs = ImageService._load_refs()
+                chat_ids = refs.setdefault(content_hash, [])
+                if chat_id not in chat_ids:
+                    chat_ids.append(chat_id)
+                ImageService._save_refs(refs)
+            return image_path
+
+    @staticmethod
+    def release_image(chat_id: str) -> int:
+        """Drop chat_id's references; returns the bytes of blobs that became unused."""
+        freed = 0
+        with ImageService._refs_lock:
+            refs = ImageService._load_refs()
+            for content_hash in list(refs):
+                chat_ids = refs[content_hash]
+                if chat_id not in chat_ids:
+                    continue
+                chat_ids.remove(chat_id)
+                if not chat_ids:
+                    del refs[content_hash]
+                    for ext in set(BLOB_EXTENSIONS.values()):
+                        blob = os.path.join(IMAGE_STORAGE_DIR, f"{content_hash}{ext}")
+                        freed += ImageService._remove_file(blob)
+                        freed += ImageService._remove_file(ImageService.display_path(blob))
+            ImageService._save_refs(refs)
+        return freed
+
+    @staticmethod
+    def session_paths(session: Dict) -> List[str]:
+        """Normalized paths of every image a session shows: its upload and any frames."""
+        paths = [session['image_path']] if session.get('image_path') else []
+        paths += [frame['image_path'] for frame in session.get('frames', [])]
+        return [os.path.normpath(path) for path in paths]
+
+    @staticmethod
+    def api_ref(content_hash: str) -> str:
+        return f"{API_REF_PREFIX}{content_hash}"
+
+    @staticmethod
+    def mark_used(content_hash: str) -> None:
+        # The blob's mtime doubles as the last-use time of an API image.
+        try:
+            os.utime(ImageService.blob_path(content_hash))
+        except OSError:
+            pass
+
+    @staticmethod
+    def expire_api_images(max_count: int, ttl_seconds: float) -> Tuple[int, int]:
+        """Release API images unused for ttl_seconds or beyond the max_count most recent.
+
+        Returns (files removed, bytes removed); a blob a chat still uses stays.
+        """
+        with ImageService._refs_lock:
+            refs = ImageService._load_refs()
+            api_hashes = [h for h, chat_ids in refs.items() if ImageService.api_ref(h) in chat_ids]
+        last_used = {}
+        for content_hash in api_hashes:
+            try:
+                last_used[content_hash] = os.path.getmtime(ImageService.blob_path(content_hash))
+            except OSError:
+                last_used[content_hash] = 0.0
+        by_recency = sorted(api_hashes, key=last_used.get, reverse=True)
+        cutoff = time.time() - ttl_seconds
+        expired = by_recency[max_count:] + [h for h in by_recency[:max_count] if last_used[h] < cutoff]
+        removed, reclaimed = 0, 0
+        for content_hash in expired:
+            freed = ImageService.release_image(ImageService.api_ref(content_hash))
+            removed += 1 if freed else 0
+            reclaimed += freed
+        return removed, reclaimed
+
+    @staticmethod
+    def storage_bytes() -> int:
+        total = 0
+        if os.path.isdir(IMAGE_STORAGE_DIR):
+            for entry in os.scandir(IMAGE_STORAGE_DIR):
+                if entry.is_file() and entry.path != IMAGE_REFS_FILE:
+                    total += entry.stat().st_size
+        return total
+
+    @staticmethod
+    def sweep_orphans(sessions: List[Dict], grace_seconds: float) -> Tuple[int, int]:
+        """Drop refs of vanished chats and delete files no session points at.
+
+        Files younger than grace_seconds are kept, since an upload is stored
+        before its session is saved. Returns (files removed, bytes removed).
+        """
+        live_ids = {session['id'] for session in sessions}
+        live_paths = {path for session in sessions for path in ImageService.session_paths(session)}
+        cutoff = time.time() - grace_seconds
+
+        with ImageService._refs_lock:
+            refs = ImageService._load_refs()
+            for content_hash in list(refs):
+                blob = ImageService.blob_path(content_hash)
+                young = os.path.exists(blob) and os.path.getmtime(blob) > cutoff
+                refs[content_hash] = [
+                    c for c in refs[content_hash] if c in live_ids or young or c.startswith(API_REF_PREFIX)
+                ]
+                if not refs[content_hash]:
+                    del refs[content_hash]
+            ImageService._save_refs(refs)
+            referenced = {os.path.normpath(ImageService.blob_path(h)) for h in refs} | live_paths
+            referenced |= {ImageService.display_path(path) for path in referenced}
+
+        with ImageService._pending_lock:
+            pending = {os.path.normpath(path) for path in ImageService._pending}
+            pending |= {ImageService.display_path(path) for path in pending}
+
+        removed, reclaimed = 0, 0
+        if not os.path.isdir(IMAGE_STORAGE_DIR):
+            return removed, reclaimed
+        for entry in os.scandir(IMAGE_STORAGE_DIR):
+            path = os.path.normpath(entry.path)
+            if not entry.is_file() or path == os.path.normpath(IMAGE_REFS_FILE):
+                continue
+            if path in referenced or path in pending or (path.endswith('.tmp') and path[:-4] in pending):
+                continue
+            try:
+                stat = entry.stat()
+                if stat.st_mtime > cutoff:
+                    continue
+                os.remove(entry.path)
+            except OSError:
+                continue
+            removed += 1
+            reclaimed += stat.st_size
+        return removed, reclaimed
+    
+    @staticmethod
+    def wait_for_write(image_path: str) -> bool:
+        """Wait for a pending write; False if it failed, in which case the file is missing."""
+        with ImageService._pending_lock:
+            future = ImageService._pending.get(image_path)
+        if future is None:
+            return True
+        try:
+            future.result()
+            return True
+        except Exception as e:
+            Metrics.record_error("image.write_blob", e)
+            return False
+
+    @staticmethod
+    def _write_blob(image: Image.Image, image_path: str) -> None:
+        display = image
+        if max(image.size) > IMAGE_DISPLAY_MAX_SIDE:
+            display = image.copy()
+            display.thumbnail((IMAGE_DISPLAY_MAX_SIDE, IMAGE_DISPLAY_MAX_SIDE), Image.LANCZOS)
+        # The display copy goes first, so once the blob exists both do.
+        writes = [
+            (display, ImageService.display_path(image_path), IMAGE_DISPLAY_QUALITY, False),
+            (image, image_path, IMAGE_STORAGE_QUALITY, IMAGE_STORAGE_LOSSLESS),
+        ]
+        tmp_path = None
+        try:
+            with Metrics.span("image.write_blob"):
+                for variant, path, quality, lossless in writes:
+                    tmp_path = f"{path}.tmp"
+                    variant.save(tmp_path, format=IMAGE_STORAGE_FORMAT, quality=quality, lossless=lossless)
+                    os.replace(tmp_path, path)
+        except Exception:
+            ImageService._remove_file(tmp_path)
+            raise
+        finally:
+            with ImageService._pending_lock:
+                ImageService._pending.pop(image_path, None)
+                ImageService._pending_images.pop(image_path, None)
     
     @staticmethod
     def load_image(image_path: str) -> Optional[Image.Image]:
+        with ImageService._pending_lock:
+            pending_image = ImageService._pending_images.get(image_path)
+        if pending_image is not None:
+            return pending_image
         if os.path.exists(image_path):
             try:
                 return Image.open(image_path)
             except (IOError, OSError):
                 return None
         return None
+
+    @staticmethod
+    def load_display_image(image_path: str) -> Optional[Image.Image]:
+        """The display copy of a stored image, or the image itself when there is none."""
+        with ImageService._pending_lock:
+            pending_image = ImageService._pending_images.get(image_path)
+        if pending_image is not None:
+            return pending_image
+        display_path = ImageService.display_path(image_path)
+        if os.path.exists(display_path):
+            try:
+                return Image.open(display_path)
+            except (IOError, OSError):
+                pass
+        return ImageService.load_image(image_path)
+
+    @staticmethod
+    def _load_refs() -> Dict[str, List[str]]:
+        if os.path.exists(IMAGE_REFS_FILE):
+            try:
+                with open(IMAGE_REFS_FILE, 'r') as f:
+                    return json.load(f)
+            except (json.JSONDecodeError, IOError):
+                return {}
+        return {}
+
+    @staticmethod
+    def _save_refs(refs: Dict[str, List[str]]) -> None:
+        os.makedirs(os.path.dirname(IMAGE_REFS_FILE), exist_ok=True)
+        tmp_path = f"{IMAGE_REFS_FILE}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(refs, f)
+        os.replace(tmp_path, IMAGE_REFS_FILE)
+
+    @staticmethod
+    def _remove_file(path: str) -> int:
+        if os.path.exists(path):
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                return size
+            except OSError:
+                pass
+        return 0
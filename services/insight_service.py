@@ -0,0 +1,147 @@
+"""
+Insight Service - Precomputed caption, objects and suggested questions per chat
+
+When a chat starts, a background worker encodes its image once (attaching to
+the upload's prefetch when one is running) and derives from that encoding:
+  * a caption, which doubles as the answer to DESCRIBE_QUESTION
+  * the main objects, listed by one query and counted with moondream's detect
+  * suggested questions about those objects, answered ahead of time
+The result is stored with the session, so opening the chat or asking a
+suggested question needs no generation. Each step waits while other requests
+are admitted, so a user's questions go ahead of the remaining steps.
+"""
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+from PIL import Image
+from model.admission import CancelToken, RequestCancelled, ServerBusy
+from services.chat_service import ChatService
+from services.metrics import Metrics
+from config import (
+    INSIGHTS_ENABLED,
+    INSIGHTS_WORKERS,
+    INSIGHTS_MAX_OBJECTS,
+    INSIGHTS_MAX_DETECTIONS,
+    INSIGHTS_SUGGESTED_QUESTIONS,
+    INSIGHTS_YIELD_SECONDS,
+    INSIGHTS_TIMEOUT_SECONDS,
+    DESCRIBE_QUESTION,
+)
+
+OBJECTS_QUESTION = "List the main objects in this image, separated by commas."
+
+
+class InsightService:
+    _lock = threading.Lock()
+    _pool: Optional[ThreadPoolExecutor] = None
+    _pending: Dict[str, Future] = {}
+
+    @staticmethod
+    def start(model, session_id: str, image: Image.Image, image_hash: Optional[str] = None) -> Optional[Future]:
+        if not INSIGHTS_ENABLED or not model.is_model_loaded():
+            return None
+        with InsightService._lock:
+            if InsightService._pool is None:
+                InsightService._pool = ThreadPoolExecutor(max_workers=INSIGHTS_WORKERS, thread_name_prefix="insights")
+            future = InsightService._pending.get(session_id)
+            if future is None:
+                future = InsightService._pool.submit(InsightService._run, model, session_id, image, image_hash)
+                InsightService._pending[session_id] = future
+                future.add_done_callback(lambda f: InsightService._forget(session_id, f))
+            return future
+
+    @staticmethod
+    def is_pending(session_id: str) -> bool:
+        with InsightService._lock:
+            return session_id in InsightService._pending
+
+    @staticmethod
+    def _forget(session_id: str, future: Future) -> None:
+        with InsightService._lock:
+            if InsightService._pending.get(session_id) is future:
+                del InsightService._pending[session_id]
+
+    @staticmethod
+    def _run(model, session_id: str, image: Image.Image, image_hash: Optional[str]) -> Optional[Dict]:
+        try:
+            with Metrics.span("insights.compute"):
+                encoding = model.encode_image(image, image_hash)
+                if encoding is None:
+                    raise RuntimeError("Failed to encode image")
+                insights = InsightService.compute(model, encoding)
+            # The chat may have been pruned while its insights were computed.
+            stored = ChatService.save_insights(session_id, insights)
+            Metrics.inc("chatmoon_insights_total", result="stored" if stored else "dropped")
+            return insights
+        except ServerBusy:
+            Metrics.inc("chatmoon_insights_total", result="busy")
+        except RequestCancelled:
+            Metrics.inc("chatmoon_insights_total", result="timeout")
+        except Exception as e:
+            Metrics.inc("chatmoon_insights_total", result="error")
+            Metrics.record_error("insights.compute", e)
+        return None
+
+    @staticmethod
+    def compute(model, encoding, token: Optional[CancelToken] = None) -> Dict:
+        token = token or CancelToken(INSIGHTS_TIMEOUT_SECONDS)
+        InsightService._yield(model, token)
+        caption = model.caption(encoding, token=token)
+        objects = InsightService._objects(model, encoding, token)
+        suggestions = []
+        if caption:
+            suggestions.append({'question': DESCRIBE_QUESTION, 'answer': caption})
+        for obj in objects:
+            if len(suggestions) >= INSIGHTS_SUGGESTED_QUESTIONS:
+                break
+            question = f"What can you tell me about the {obj['label']}?"
+            InsightService._yield(model, token)
+            answer = model.get_answer(encoding, question, token=token)
+            if answer:
+                suggestions.append({'question': question, 'answer': answer})
+        return {
+            'caption': caption,
+            'objects': objects,
+            'suggestions': suggestions,
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        }
+
+    @staticmethod
+    def _yield(model, token: CancelToken) -> None:
+        # Between steps this worker holds no admission slot, so anything
+        # pending is someone else's request.
+        while model.admission.pending() > 0:
+            token.check()
+            time.sleep(INSIGHTS_YIELD_SECONDS)
+        token.check()
+
+    @staticmethod
+    def _objects(model, encoding, token: CancelToken) -> List[Dict]:
+        # detect needs a label to look for, so the candidates come from a
+        # query and detect confirms and counts the first few of them.
+        InsightService._yield(model, token)
+        answer = model.get_answer(encoding, OBJECTS_QUESTION, token=token)
+        objects = []
+        for i, label in enumerate(InsightService.parse_labels(answer or '')):
+            if i >= INSIGHTS_MAX_DETECTIONS:
+                objects.append({'label': label})
+                continue
+            InsightService._yield(model, token)
+            boxes = model.detect(encoding, label, token)
+            if boxes is None:
+                objects.append({'label': label})
+            elif boxes:
+                objects.append({'label': label, 'count': len(boxes)})
+        return objects
+
+    @staticmethod
+    def parse_labels(answer: str) -> List[str]:
+        labels = []
+        for part in re.split(r",|;|\n|\band\b", answer.lower()):
+            label = re.sub(r"^(a|an|the|some)\s+", "", part.strip(" .*-\t"))
+            if label and len(label) <= 40 and label not in labels:
+                labels.append(label)
+        return labels[:INSIGHTS_MAX_OBJECTS]
@@ -0,0 +1,218 @@
+"""
+Metrics - Timing spans, counters and gauges with Prometheus text export
+
+Spans record a latency histogram per stage and count failures. Recorded
+errors are written as JSON log lines on the "chatmoon.metrics" logger, and so
+is every span when METRICS_LOG_SPANS is set (off by default). The current
+values can be rendered in the Prometheus text format, written to METRICS_FILE
+periodically and, when METRICS_PORT is set, served at /metrics.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, Tuple
+from config import (
+    METRICS_ENABLED,
+    METRICS_LOG_SPANS,
+    METRICS_FILE,
+    METRICS_FILE_INTERVAL_SECONDS,
+    METRICS_PORT,
+)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+logger = logging.getLogger("chatmoon.metrics")
+
+
+def _label_key(labels: Dict) -> Tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Iterable[Tuple[str, str]], extra: Dict = None) -> str:
+    pairs = list(labels) + sorted((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class _Histogram:
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.total += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+    _lock = threading.Lock()
+    _histograms: Dict[Tuple[str, Tuple], _Histogram] = {}
+    _counters: Dict[Tuple[str, Tuple], float] = {}
+    _gauges: Dict[Tuple[str, Tuple], float] = {}
+    _collectors: Dict[str, Callable[[], None]] = {}
+    _exporter_started = False
+
+    @staticmethod
+    def observe(name: str, value: float, buckets: Tuple = DEFAULT_BUCKETS, **labels) -> None:
+        if not METRICS_ENABLED:
+            return
+        key = (name, _label_key(labels))
+        with Metrics._lock:
+            histogram = Metrics._histograms.get(key)
+            if histogram is None:
+                histogram = Metrics._histograms[key] = _Histogram(buckets)
+            histogram.observe(value)
+
+    @staticmethod
+    def inc(name: str, value: float = 1.0, **labels) -> None:
+        if not METRICS_ENABLED:
+            return
+        key = (name, _label_key(labels))
+        with Metrics._lock:
+            Metrics._counters[key] = Metrics._counters.get(key, 0.0) + value
+
+    @staticmethod
+    def set_gauge(name: str, value: float, **labels) -> None:
+        if not METRICS_ENABLED:
+            return
+        with Metrics._lock:
+            Metrics._gauges[(name, _label_key(labels))] = float(value)
+
+    @staticmethod
+    @contextmanager
+    def span(stage: str, **labels):
+        """Time a stage; exceptions are counted and re-raised.
+
+        Streamlit's rerun/stop signals derive from BaseException, so they end the
+        span without being counted as errors.
+        """
+        started = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            Metrics.observe("chatmoon_stage_duration_seconds", duration, stage=stage, **labels)
+            if error is not None:
+                Metrics.inc("chatmoon_stage_errors_total", stage=stage, error=type(error).__name__, **labels)
+            if METRICS_ENABLED and METRICS_LOG_SPANS:
+                record = {'stage': stage, 'duration_ms': round(1000 * duration, 3), **labels}
+                if error is not None:
+                    record['error'] = repr(error)
+                logger.info(json.dumps(record, default=str))
+
+    @staticmethod
+    def record_error(stage: str, error: BaseException) -> None:
+        Metrics.inc("chatmoon_stage_errors_total", stage=stage, error=type(error).__name__)
+        logger.warning(json.dumps({'stage': stage, 'error': repr(error)}, default=str))
+
+    @staticmethod
+    def register_collector(name: str, collector: Callable[[], None]) -> None:
+        """Register a callback that refreshes gauges right before each export."""
+        with Metrics._lock:
+            Metrics._collectors[name] = collector
+
+    @staticmethod
+    def render_prometheus() -> str:
+        with Metrics._lock:
+            collectors = list(Metrics._collectors.values())
+        for collector in collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.warning(json.dumps({'collector_error': repr(e)}))
+
+        lines = []
+        with Metrics._lock:
+            for kind, values in (('counter', Metrics._counters), ('gauge', Metrics._gauges)):
+                seen = set()
+                for (name, labels), value in sorted(values.items()):
+                    if name not in seen:
+                        lines.append(f"# TYPE {name} {kind}")
+                        seen.add(name)
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+
+            seen = set()
+            for (name, labels), histogram in sorted(Metrics._histograms.items(), key=lambda item: item[0]):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} histogram")
+                    seen.add(name)
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f"{name}_bucket{_format_labels(labels, {'le': bound})} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels, {'le': '+Inf'})} {histogram.count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.total}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def write_file(path: str = METRICS_FILE) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(Metrics.render_prometheus())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def start_exporter() -> None:
+        with Metrics._lock:
+            if Metrics._exporter_started or not METRICS_ENABLED:
+                return
+            Metrics._exporter_started = True
+
+        if METRICS_LOG_SPANS and not logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+
+        if METRICS_FILE:
+            threading.Thread(target=Metrics._file_loop, name="metrics-file", daemon=True).start()
+
+        if METRICS_PORT:
+            server = ThreadingHTTPServer(("0.0.0.0", int(METRICS_PORT)), _MetricsHandler)
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+
+    @staticmethod
+    def _file_loop() -> None:
+        while True:
+            time.sleep(METRICS_FILE_INTERVAL_SECONDS)
+            try:
+                Metrics.write_file()
+            except OSError as e:
+                logger.warning(json.dumps({'metrics_file_error': repr(e)}))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = Metrics.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,164 @@
+"""
+Retention Service - Background quotas and garbage collection for stored data
+
+Every RETENTION_INTERVAL_SECONDS, off the request path:
+  * history is trimmed to MAX_CHAT_HISTORY sessions
+  * API images unused for API_IMAGE_TTL_SECONDS, or beyond the
+    API_IMAGE_MAX_COUNT most recently used, are released
+  * image files and refs that no session points at are deleted
+  * the oldest sessions are dropped while history, or the images sessions
+    still use, exceed their byte quotas
+  * the encoding cache directory is reconciled with ENCODING_CACHE_DISK_BYTES
+"""
+import json
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+from services.chat_service import ChatService
+from services.image_service import ImageService
+from services.metrics import Metrics, logger
+from config import (
+    MAX_CHAT_HISTORY,
+    HISTORY_MAX_BYTES,
+    IMAGE_STORAGE_MAX_BYTES,
+    RETENTION_ENABLED,
+    RETENTION_INTERVAL_SECONDS,
+    RETENTION_ORPHAN_GRACE_SECONDS,
+    ENCODING_CACHE_ENABLED,
+    API_IMAGE_MAX_COUNT,
+    API_IMAGE_TTL_SECONDS,
+)
+
+
+class RetentionService:
+    _lock = threading.Lock()
+    _run_lock = threading.Lock()
+    _started = False
+    last_report: Optional[Dict] = None
+
+    @staticmethod
+    def start() -> None:
+        with RetentionService._lock:
+            if RetentionService._started or not RETENTION_ENABLED:
+                return
+            RetentionService._started = True
+        threading.Thread(target=RetentionService._loop, name="retention", daemon=True).start()
+
+    @staticmethod
+    def _loop() -> None:
+        while True:
+            try:
+                RetentionService.run_once()
+            except Exception as e:
+                Metrics.record_error("retention.sweep", e)
+            time.sleep(RETENTION_INTERVAL_SECONDS)
+
+    @staticmethod
+    def run_once() -> Dict:
+        with RetentionService._run_lock, Metrics.span("retention.sweep"):
+            report = {
+                'sessions_removed': 0,
+                'history_bytes_reclaimed': 0,
+                'image_files_removed': 0,
+                'image_bytes_reclaimed': 0,
+                'encoding_files_removed': 0,
+                'encoding_bytes_reclaimed': 0,
+            }
+            store = ChatService.get_store()
+
+            RetentionService._drop_sessions(store, store.prune(MAX_CHAT_HISTORY), report)
+
+            files, reclaimed = ImageService.expire_api_images(API_IMAGE_MAX_COUNT, API_IMAGE_TTL_SECONDS)
+            report['image_files_removed'] += files
+            report['image_bytes_reclaimed'] += reclaimed
+
+            # Orphans go first, so the image quota below only weighs what the
+            # remaining sessions reference.
+            sessions = store.session_summaries(store.count_sessions())
+            files, reclaimed = ImageService.sweep_orphans(sessions, RETENTION_ORPHAN_GRACE_SECONDS)
+            report['image_files_removed'] += files
+            report['image_bytes_reclaimed'] += reclaimed
+
+            drop = RetentionService._sessions_over_quota(sessions, store.size_bytes())
+            if drop:
+                RetentionService._drop_sessions(store, store.prune(len(sessions) - drop), report)
+            report['history_bytes_reclaimed'] += store.compact()
+
+            encoding_bytes = None
+            if ENCODING_CACHE_ENABLED:
+                from model.encoding_cache import get_encoding_cache
+                from model.model import ModelState
+                from model.registry import ModelRegistry
+
+                cache = get_encoding_cache()
+                # Entries of another dtype or load source are only known to be
+                # stale once a model writing to this cache has loaded.
+                model = ModelRegistry.shared_model()
+                tag = None
+                if model is not None and model.encoding_cache is cache and model.state == ModelState.READY:
+                    tag = model.encoding_tag
+                files, reclaimed = cache.sweep(RETENTION_ORPHAN_GRACE_SECONDS, tag)
+                report['encoding_files_removed'] = files
+                report['encoding_bytes_reclaimed'] = reclaimed
+                encoding_bytes = cache.stats()['disk_bytes']
+
+            RetentionService._export(report, store.size_bytes(), ImageService.storage_bytes(), encoding_bytes)
+            RetentionService.last_report = report
+            return report
+
+    @staticmethod
+    def _sessions_over_quota(sessions: List[Dict], history_bytes: int) -> int:
+        """How many of the oldest sessions (given newest first) to drop to get under both quotas.
+
+        A session's share of the history bytes is taken as proportional to
+        its messages; its images count once no newer session uses them. The
+        newest session is always kept.
+        """
+        sizes = {}
+        for session in sessions:
+            for path in ImageService.session_paths(session):
+                if path not in sizes:
+                    sizes[path] = ImageService.stored_bytes(path)
+        history_excess = history_bytes - HISTORY_MAX_BYTES
+        image_excess = sum(sizes.values()) - IMAGE_STORAGE_MAX_BYTES
+        if history_excess <= 0 and image_excess <= 0:
+            return 0
+
+        weights = [session.get('message_count', 0) + 1 for session in sessions]
+        total_weight = sum(weights)
+        users = Counter(path for session in sessions for path in set(ImageService.session_paths(session)))
+        drop = 0
+        for session, weight in zip(reversed(sessions[1:]), reversed(weights[1:])):
+            if history_excess <= 0 and image_excess <= 0:
+                break
+            drop += 1
+            history_excess -= history_bytes * weight / total_weight
+            for path in set(ImageService.session_paths(session)):
+                users[path] -= 1
+                if not users[path]:
+                    image_excess -= sizes[path]
+        return drop
+
+    @staticmethod
+    def _drop_sessions(store, chat_ids, report: Dict) -> None:
+        for chat_id in chat_ids:
+            freed = ImageService.release_image(chat_id)
+            report['image_bytes_reclaimed'] += freed
+            if freed:
+                report['image_files_removed'] += 1
+        report['sessions_removed'] += len(chat_ids)
+
+    @staticmethod
+    def _export(report: Dict, history_bytes: int, image_bytes: int, encoding_bytes: Optional[int]) -> None:
+        for kind in ('history', 'image', 'encoding'):
+            Metrics.inc("chatmoon_retention_reclaimed_bytes_total", report[f'{kind}_bytes_reclaimed'], kind=kind)
+        Metrics.inc("chatmoon_retention_removed_total", report['sessions_removed'], kind="session")
+        Metrics.inc("chatmoon_retention_removed_total", report['image_files_removed'], kind="image")
+        Metrics.inc("chatmoon_retention_removed_total", report['encoding_files_removed'], kind="encoding")
+        Metrics.set_gauge("chatmoon_storage_bytes", history_bytes, kind="history")
+        Metrics.set_gauge("chatmoon_storage_bytes", image_bytes, kind="image")
+        if encoding_bytes is not None:
+            Metrics.set_gauge("chatmoon_storage_bytes", encoding_bytes, kind="encoding")
+        if any(report.values()):
+            logger.info(json.dumps({'retention': report}))
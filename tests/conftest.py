@@ -0,0 +1,20 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True)
+def isolated_data_dir(tmp_path, monkeypatch):
+    # Storage paths in config are relative to the working directory, so every
+    # test writes its history, images and caches under its own tmp_path.
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def fake_model():
+    from benchmarks.fake_model import make_fake_model
+
+    return make_fake_model()
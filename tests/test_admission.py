@@ -0,0 +1,47 @@
+import time
+import pytest
+from model.admission import AdmissionController, CancelToken, DeadlineExceeded, RequestCancelled, ServerBusy
+
+
+def test_admit_rejects_beyond_max_pending():
+    admission = AdmissionController(2)
+    with admission.admit(), admission.admit():
+        assert admission.pending() == 2
+        with pytest.raises(ServerBusy):
+            with admission.admit():
+                pass
+    assert admission.pending() == 0
+    assert admission.rejected == 1
+
+
+def test_admit_releases_slot_on_error():
+    admission = AdmissionController(1)
+    with pytest.raises(ValueError):
+        with admission.admit():
+            raise ValueError()
+    with admission.admit():
+        assert admission.pending() == 1
+
+
+def test_cancel_token_cancel():
+    token = CancelToken()
+    token.check()
+    token.cancel()
+    assert token.cancelled
+    with pytest.raises(RequestCancelled):
+        token.check()
+
+
+def test_cancel_token_deadline():
+    token = CancelToken(0.01)
+    assert 0 < token.remaining() <= 0.01
+    time.sleep(0.02)
+    assert token.remaining() == 0.0
+    with pytest.raises(DeadlineExceeded):
+        token.check()
+
+
+def test_cancel_token_without_deadline():
+    token = CancelToken(None)
+    assert token.remaining() is None
+    token.check()
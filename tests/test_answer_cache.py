@@ -0,0 +1,50 @@
+import json
+import time
+from model.answer_cache import AnswerCache, normalize_question
+
+
+def test_lru_eviction():
+    cache = AnswerCache(max_entries=2, ttl_seconds=60)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    cache.get("a")
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+
+
+def test_ttl_expiry():
+    cache = AnswerCache(max_entries=10, ttl_seconds=0.01)
+    cache.put("a", "1")
+    time.sleep(0.02)
+    assert cache.get("a") is None
+
+
+def test_only_serves_greedy_settings():
+    cache = AnswerCache(max_entries=10, ttl_seconds=60)
+    assert cache.enabled_for({"temperature": 0.0})
+    assert not cache.enabled_for({"temperature": 0.5})
+    assert not cache.enabled_for({"max_tokens": 768})
+    assert AnswerCache(10, 60, allow_sampling=True).enabled_for({})
+
+
+def test_key_normalizes_question():
+    settings = {"temperature": 0.0}
+    assert normalize_question("  What is THIS?  ") == "what is this"
+    assert AnswerCache.make_key("img", "What is this?", settings) == AnswerCache.make_key("img", "what is this", settings)
+    assert AnswerCache.make_key("img", "q", settings) != AnswerCache.make_key("img", "q", {"temperature": 0.5})
+
+
+def test_persists_and_skips_malformed_entries():
+    cache = AnswerCache(max_entries=10, ttl_seconds=60, persist_path="answers.json")
+    cache.put("a", "1")
+    cache.flush()
+    with open("answers.json") as f:
+        entries = json.load(f)
+    entries += [["b"], "junk", None, ["c", "3", "not a time"]]
+    with open("answers.json", "w") as f:
+        json.dump(entries, f)
+    reloaded = AnswerCache(max_entries=10, ttl_seconds=60, persist_path="answers.json")
+    assert reloaded.get("a") == "1"
+    assert reloaded.stats()['entries'] == 1
@@ -0,0 +1,24 @@
+import json
+import random
+from PIL import Image
+import cli
+import model.model as model_module
+from model.admission import CancelToken
+
+
+def test_queued_answers_are_not_cut_off_by_the_interactive_deadline(fake_model, monkeypatch, tmp_path):
+    # A short default deadline stands in for the interactive one at real
+    # CPU speeds: eight answers at 50 ms each queue far longer than 100 ms.
+    monkeypatch.setattr(model_module, "CancelToken", lambda timeout=0.1: CancelToken(timeout))
+    fake_model.model.prefill_latency = 0.05
+    fake_model.enable_batching(max_batch_size=1, max_wait_ms=0)
+    Image.frombytes("RGB", (32, 32), random.Random(0).randbytes(32 * 32 * 3)).save(tmp_path / "a.png")
+    questions = [f"question {i}" for i in range(8)]
+
+    writer = cli.run(fake_model, cli.iter_directory(str(tmp_path)), questions, "out.jsonl",
+                     decode_workers=1, max_inflight=8)
+
+    with open("out.jsonl") as f:
+        records = [json.loads(line) for line in f]
+    assert writer.failed == 0
+    assert sorted(r['question'] for r in records) == questions
@@ -0,0 +1,103 @@
+import os
+import sys
+import types
+import pytest
+import torch
+from PIL import Image
+from model.encoding_cache import EncodingCache
+
+
+def make_encoding_cache(memory_limit=1024, disk_limit=10 * 1024):
+    return EncodingCache("encodings", memory_limit, disk_limit)
+
+
+def test_round_trip_through_disk():
+    cache = make_encoding_cache()
+    key = EncodingCache.key_for(Image.new("RGB", (8, 8)))
+    cache.put(key, torch.ones(4))
+    fresh = make_encoding_cache()
+    assert torch.equal(fresh.get(key), torch.ones(4))
+
+
+def test_memory_evicts_least_recently_used():
+    cache = make_encoding_cache(memory_limit=2 * 64)
+    cache.put("tag-a", torch.zeros(16))
+    cache.put("tag-b", torch.zeros(16))
+    cache.get("tag-a")
+    cache.put("tag-c", torch.zeros(16))
+    assert set(cache._memory) == {"tag-a", "tag-c"}
+    assert cache.stats()['memory_bytes'] == 2 * 64
+
+
+def test_disk_evicts_to_limit():
+    cache = make_encoding_cache(disk_limit=1)
+    cache.put("tag-a", torch.zeros(16))
+    assert cache.stats()['disk_entries'] == 0
+    assert not os.path.exists(os.path.join("encodings", "tag-a.pt"))
+
+
+def write_entry(key: str, value=None, raw: bytes = None) -> str:
+    os.makedirs("encodings", exist_ok=True)
+    path = os.path.join("encodings", f"{key}.pt")
+    if raw is not None:
+        with open(path, 'wb') as f:
+            f.write(raw)
+    else:
+        torch.save(value, path)
+    return path
+
+
+def pickle_of_removed_class(monkeypatch, key: str) -> str:
+    module = types.ModuleType("removed_remote_code")
+    Encoded = type("Encoded", (), {'__module__': module.__name__})
+    module.Encoded = Encoded
+    monkeypatch.setitem(sys.modules, module.__name__, module)
+    path = write_entry(key, Encoded())
+    monkeypatch.delitem(sys.modules, module.__name__)
+    return path
+
+
+@pytest.mark.parametrize("corrupt", ["truncated", "missing_class"])
+def test_unreadable_entry_is_dropped_with_its_file(monkeypatch, corrupt):
+    if corrupt == "truncated":
+        path = write_entry("tag-a", raw=b"not a torch file")
+    else:
+        path = pickle_of_removed_class(monkeypatch, "tag-a")
+    cache = make_encoding_cache()
+    assert cache.stats()['disk_entries'] == 1
+    assert cache.get("tag-a") is None
+    assert cache.stats()['disk_entries'] == 0
+    assert not os.path.exists(path)
+
+
+def test_rejects_missing_key():
+    cache = make_encoding_cache()
+    with pytest.raises(ValueError):
+        cache.put(None, torch.zeros(1))
+    with pytest.raises(ValueError):
+        cache.get(None)
+
+
+def test_key_prefers_given_hash():
+    image = Image.new("RGB", (8, 8))
+    assert EncodingCache.key_for(image, "abc").endswith("-abc")
+    assert EncodingCache.key_for(image) == EncodingCache.key_for(image.copy())
+
+
+def test_tag_separates_dtype_and_load_source():
+    tags = {
+        EncodingCache.model_tag("float32", "hub"),
+        EncodingCache.model_tag("bfloat16", "hub"),
+        EncodingCache.model_tag("float32", "bundle"),
+    }
+    assert len(tags) == 3
+
+
+def test_sweep_only_drops_other_tags_when_given_one():
+    cache = make_encoding_cache()
+    hub, bundle = EncodingCache.model_tag("float32", "hub"), EncodingCache.model_tag("float32", "bundle")
+    cache.put(f"{hub}-a", torch.zeros(4))
+    cache.put(f"{bundle}-a", torch.zeros(4))
+    assert cache.sweep(grace_seconds=0)[0] == 0
+    assert cache.sweep(grace_seconds=0, tag=bundle)[0] == 1
+    assert os.listdir("encodings") == [f"{bundle}-a.pt"]
@@ -0,0 +1,79 @@
+import random
+import pytest
+from PIL import Image
+import services.frame_service as frame_service
+from services.frame_service import FrameService
+
+
+def noise(seed: int, size=(64, 64)) -> Image.Image:
+    return Image.frombytes("RGB", size, random.Random(seed).randbytes(size[0] * size[1] * 3))
+
+
+def test_dhash_is_stable_and_tells_images_apart():
+    image = noise(0)
+    assert FrameService.dhash(image) == FrameService.dhash(image.copy())
+    assert FrameService.dhash(image) == FrameService.dhash(image.resize((128, 128)))
+    assert bin(FrameService.dhash(image) ^ FrameService.dhash(noise(1))).count('1') > 6
+
+
+def test_sample_frames_skips_near_duplicates():
+    first, second = noise(0), noise(1)
+    frames = [("a", first), ("b", first.copy()), ("c", second), ("d", second.copy())]
+    assert [frame['label'] for frame in FrameService.sample_frames(frames)] == ["a", "c"]
+
+
+def test_sample_frames_stops_at_max_count(monkeypatch):
+    monkeypatch.setattr(frame_service, "FRAME_MAX_COUNT", 2)
+    frames = [(str(i), noise(i)) for i in range(5)]
+    assert len(list(FrameService.sample_frames(frames))) == 2
+
+
+def test_format_timestamp():
+    assert FrameService.format_timestamp(0) == "0:00.0"
+    assert FrameService.format_timestamp(75.25) == "1:15.2"
+
+
+def test_attribute_answers_groups_frames_by_answer():
+    answers = [
+        {'label': "0:00.0", 'answer': "a cat"},
+        {'label': "0:01.0", 'answer': "a cat "},
+        {'label': "0:02.0", 'answer': None},
+        {'label': "0:03.0", 'answer': "a dog"},
+    ]
+    assert FrameService.attribute_answers(answers) == (
+        "**0:00.0, 0:01.0**: a cat\n\n**0:03.0**: a dog\n\n_No answer for 0:02.0 (failed or timed out)._"
+    )
+    assert FrameService.attribute_answers([{'label': "x", 'answer': None}]) is None
+
+
+def test_sample_interval_spreads_long_clips():
+    assert FrameService.sample_interval(None) == frame_service.FRAME_SAMPLE_SECONDS
+    assert FrameService.sample_interval(5.0) == frame_service.FRAME_SAMPLE_SECONDS
+    assert FrameService.sample_interval(300.0) == 300.0 / frame_service.FRAME_MAX_COUNT
+
+
+def test_animation_samples_reach_the_end_of_the_clip(tmp_path, monkeypatch):
+    monkeypatch.setattr(frame_service, "FRAME_MAX_COUNT", 4)
+    path = tmp_path / "clip.gif"
+    frames = [noise(i, (32, 32)) for i in range(40)]
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=1000, loop=0)
+    seconds = [elapsed for elapsed, _ in FrameService.iter_animation(str(path))]
+    assert seconds == [0.0, 10.0, 20.0, 30.0]
+
+
+def test_video_samples_reach_the_end_of_the_clip(tmp_path, monkeypatch):
+    av = pytest.importorskip("av")
+    monkeypatch.setattr(frame_service, "FRAME_MAX_COUNT", 4)
+    path = str(tmp_path / "clip.mp4")
+    with av.open(path, "w") as container:
+        stream = container.add_stream("mpeg4", rate=2)
+        stream.width, stream.height, stream.pix_fmt = 64, 64, "yuv420p"
+        for i in range(80):
+            frame = av.VideoFrame.from_image(noise(i))
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    seconds = [elapsed for elapsed, _ in FrameService.iter_video(path)]
+    assert len(seconds) == 4
+    assert seconds[-1] >= 29.0
@@ -0,0 +1,87 @@
+import pytest
+from services.history_store import HistoryStore, JsonHistoryStore, SqliteHistoryStore
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def store(request):
+    if request.param == "json":
+        yield JsonHistoryStore("data/history.json")
+    else:
+        store = SqliteHistoryStore("data/history.db")
+        yield store
+        store.close()
+
+
+def make_session(session_id: str, messages=0):
+    return {
+        'id': session_id,
+        'timestamp': "2026-01-01 00:00:00",
+        'image_name': f"{session_id}.png",
+        'image_path': f"data/images/{session_id}.webp",
+        'chat_name': session_id,
+        'messages': [
+            {'question': f"q{i}", 'answer': f"a{i}", 'timestamp': "00:00:00"} for i in range(messages)
+        ],
+    }
+
+
+def test_history_store_is_abstract():
+    with pytest.raises(TypeError):
+        HistoryStore()
+
+
+def test_upsert_and_get(store):
+    store.upsert_session(make_session("a", messages=2))
+    assert store.get_session("a") == make_session("a", messages=2)
+    assert store.get_session("missing") is None
+    assert store.count_sessions() == 1
+
+
+def test_upsert_keeps_edits_and_removals(store):
+    session = make_session("a", messages=3)
+    store.upsert_session(session)
+    session['messages'][0]['answer'] = "edited"
+    del session['messages'][2]
+    store.upsert_session(session)
+    assert store.get_session("a")['messages'] == session['messages']
+
+
+def test_recent_sessions_and_summaries_are_newest_first(store):
+    for session_id in "abc":
+        store.upsert_session(make_session(session_id, messages=1))
+    assert [s['id'] for s in store.recent_sessions(2)] == ["c", "b"]
+    summaries = store.session_summaries(3)
+    assert [s['id'] for s in summaries] == ["c", "b", "a"]
+    assert all('messages' not in s and s['message_count'] == 1 for s in summaries)
+
+
+def test_prune_drops_oldest(store):
+    for session_id in "abcd":
+        store.upsert_session(make_session(session_id))
+    assert sorted(store.prune(2)) == ["a", "b"]
+    assert [s['id'] for s in store.load_all()] == ["c", "d"]
+    assert store.prune(2) == []
+
+
+def test_insights_survive_a_save_without_them(store):
+    store.upsert_session(make_session("a"))
+    assert store.set_insights("a", {'caption': "a cat"})
+    assert not store.set_insights("missing", {'caption': "x"})
+    store.upsert_session(make_session("a", messages=1))
+    assert store.get_session("a")['insights'] == {'caption': "a cat"}
+
+
+def test_delete_and_replace_all(store):
+    for session_id in "abc":
+        store.upsert_session(make_session(session_id))
+    store.delete_sessions(["b"])
+    assert [s['id'] for s in store.load_all()] == ["a", "c"]
+    store.replace_all([make_session("c"), make_session("d")])
+    assert [s['id'] for s in store.load_all()] == ["c", "d"]
+
+
+def test_revision_changes_on_write(store):
+    store.upsert_session(make_session("a"))
+    before = store.revision()
+    store.upsert_session(make_session("a", messages=1))
+    assert store.revision() != before
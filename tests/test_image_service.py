@@ -0,0 +1,45 @@
+import os
+import random
+from PIL import Image
+from services.image_service import ImageService
+
+
+def noise(size) -> Image.Image:
+    return Image.frombytes("RGB", size, random.Random(0).randbytes(size[0] * size[1] * 3))
+
+
+def stored(chat_id: str, size=(1200, 900)) -> str:
+    image = ImageService.preprocess(noise(size))
+    path = ImageService.save_image(image, chat_id)
+    assert ImageService.wait_for_write(path)
+    return path
+
+
+def test_blob_is_lossless_and_display_copy_is_smaller():
+    image = ImageService.preprocess(noise((1200, 900)))
+    path = ImageService.save_image(image, "chat")
+    assert ImageService.wait_for_write(path)
+    assert ImageService.content_hash(Image.open(path).convert("RGB")) == ImageService.content_hash(image)
+    display = ImageService.load_display_image(path)
+    assert max(display.size) == 768
+    assert os.path.getsize(ImageService.display_path(path)) < os.path.getsize(path)
+    assert ImageService.stored_bytes(path) == os.path.getsize(path) + os.path.getsize(ImageService.display_path(path))
+
+
+def test_release_removes_display_copy():
+    path = stored("chat")
+    ImageService.release_image("chat")
+    assert not os.path.exists(path)
+    assert not os.path.exists(ImageService.display_path(path))
+
+
+def test_sweep_keeps_display_copies_of_live_sessions():
+    path = stored("chat")
+    ImageService.sweep_orphans([{'id': "chat", 'image_path': path}], grace_seconds=0)
+    assert os.path.exists(ImageService.display_path(path))
+
+
+def test_display_falls_back_to_the_stored_image():
+    path = stored("chat", size=(64, 64))
+    os.remove(ImageService.display_path(path))
+    assert ImageService.load_display_image(path).size == (64, 64)
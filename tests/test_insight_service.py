@@ -0,0 +1,33 @@
+import services.insight_service as insight_service
+from services.insight_service import InsightService, OBJECTS_QUESTION
+
+
+def test_parse_labels_splits_and_strips_articles():
+    answer = "A dog, two cats; the red ball and some trees.\n- a dog"
+    assert InsightService.parse_labels(answer) == ["dog", "two cats", "red ball", "trees"]
+
+
+def test_parse_labels_caps_and_filters(monkeypatch):
+    monkeypatch.setattr(insight_service, "INSIGHTS_MAX_OBJECTS", 2)
+    assert InsightService.parse_labels("x" * 41 + ", cup, plate, fork") == ["cup", "plate"]
+    assert InsightService.parse_labels("") == []
+
+
+def test_compute_caps_detect_calls(fake_model, monkeypatch):
+    monkeypatch.setattr(insight_service, "INSIGHTS_MAX_DETECTIONS", 1)
+    answer = fake_model.get_answer
+    monkeypatch.setattr(
+        fake_model, "get_answer",
+        lambda encoding, question, *args, **kwargs:
+            "a cup, a plate, a fork" if question == OBJECTS_QUESTION else answer(encoding, question, *args, **kwargs)
+    )
+    labels = []
+    monkeypatch.setattr(fake_model, "detect", lambda encoding, label, token=None: labels.append(label) or [{}])
+    from PIL import Image
+
+    encoding = fake_model.encode_image(Image.new("RGB", (32, 32)))
+    insights = InsightService.compute(fake_model, encoding)
+    assert labels == ["cup"]
+    assert insights['objects'] == [{'label': "cup", 'count': 1}, {'label': "plate"}, {'label': "fork"}]
+    assert insights['caption']
+    assert insights['suggestions'][0]['answer'] == insights['caption']
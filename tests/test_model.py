@@ -0,0 +1,158 @@
+import random
+from types import SimpleNamespace
+import pytest
+from PIL import Image
+from config import INFERENCE_REQUEST_TIMEOUT_SECONDS
+from model.admission import AdmissionController, CancelToken, ServerBusy
+from model.answer_cache import AnswerCache
+from model.chat_context import ChatContextStore
+from model.encoding_cache import EncodingCache
+
+
+def noise(seed: int) -> Image.Image:
+    return Image.frombytes("RGB", (32, 32), random.Random(seed).randbytes(32 * 32 * 3))
+
+
+@pytest.fixture
+def cached_model(fake_model):
+    fake_model.attach_encoding_cache(EncodingCache("encodings", 1 << 20, 1 << 20))
+    fake_model.attach_answer_cache(AnswerCache(100, 60, allow_sampling=True))
+    return fake_model
+
+
+def test_encode_image_reuses_cached_encoding(cached_model):
+    image = noise(0)
+    first = cached_model.encode_image(image)
+    second = cached_model.encode_image(image.copy())
+    assert first.key == second.key
+    assert cached_model.model.encode_calls == 1
+
+
+def test_get_answer_serves_repeats_from_answer_cache(cached_model):
+    encoding = cached_model.encode_image(noise(0))
+    answer = cached_model.get_answer(encoding, "What is this?")
+    assert answer
+    assert cached_model.get_answer(encoding, "what is this") == answer
+    assert cached_model.model.query_calls == 1
+
+
+def test_get_answer_without_cache_key_queries_every_time(fake_model):
+    encoding = fake_model.encode_image(noise(0))
+    fake_model.get_answer(encoding, "q")
+    fake_model.get_answer(encoding, "q")
+    assert fake_model.model.query_calls == 2
+
+
+def test_failed_answer_is_logged(fake_model, monkeypatch, caplog):
+    encoding = fake_model.encode_image(noise(0))
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("generation failed")
+
+    monkeypatch.setattr(fake_model.model, "query", fail)
+    with caplog.at_level("WARNING", logger="chatmoon.metrics"):
+        assert fake_model.get_answer(encoding, "q") is None
+    assert "model.get_answer" in caplog.text and "generation failed" in caplog.text
+
+
+def test_get_answer_returns_none_when_cancelled(fake_model):
+    encoding = fake_model.encode_image(noise(0))
+    token = CancelToken()
+    token.cancel()
+    assert fake_model.get_answer(encoding, "q", token=token) is None
+
+
+def test_get_answer_raises_when_busy(fake_model):
+    fake_model.admission = AdmissionController(1)
+    encoding = fake_model.encode_image(noise(0))
+    with fake_model.admission.admit():
+        with pytest.raises(ServerBusy):
+            fake_model.get_answer(encoding, "q")
+
+
+class StubTextModel:
+    """The prefill helpers in-context answers drive, recording their calls."""
+
+    def __init__(self):
+        self.config = SimpleNamespace(
+            text=SimpleNamespace(max_context=2048),
+            tokenizer=SimpleNamespace(templates={"query": {"prefix": [1], "suffix": [2]}}),
+        )
+        self.tokenizer = SimpleNamespace(encode=lambda text: SimpleNamespace(ids=[len(w) for w in text.split()]))
+        self.text = SimpleNamespace(blocks=[])
+        self.device = "cpu"
+        self.prefills = []
+        self.generations = []
+
+    def _load_encoded_image(self, base):
+        pass
+
+    def _prefill_prompt(self, tokens, pos, temperature, top_p):
+        self.prefills.append((tokens.tolist()[0], pos))
+
+    def _decode_one_tok(self):
+        pass
+
+    def _generate_answer(self, prompt_tokens, pos, settings):
+        self.generations.append((prompt_tokens.tolist()[0], pos))
+        for word in ("a", "red", "cup"):
+            self._decode_one_tok()
+            yield f" {word}"
+
+
+def test_recorded_turn_is_prefilled_by_the_next_question(fake_model):
+    inner = fake_model.model.model = StubTextModel()
+    fake_model.attach_context_store(ChatContextStore(1 << 20, 600))
+    encoding = fake_model.encode_image(noise(0))
+
+    with fake_model._inference_lock:
+        fake_model.record_turn("chat", encoding, "Describe this image.", "A cup.")
+    assert inner.prefills == []
+
+    assert fake_model.get_answer(encoding, "What color?", context_id="chat") == " a red cup"
+    turn = [1, 8, 4, 6, 2, 1, 4]
+    assert inner.prefills == [(turn, 730)]
+    assert inner.generations == [([1, 4, 6, 2], 730 + len(turn))]
+    assert fake_model.context_store.get("chat").pos == 730 + len(turn) + 4 + 3
+
+
+def test_answer_frames_only_queries_uncached_frames(cached_model):
+    encodings = [cached_model.encode_image(noise(i)) for i in range(3)]
+    first = cached_model.get_answer(encodings[0], "q")
+    answers = cached_model.answer_frames(encodings + [None], "q")
+    assert answers[0] == first
+    assert all(answers[1:3]) and answers[3] is None
+    assert cached_model.model.query_calls == 3
+
+
+def test_answer_frames_releases_the_lock_between_frames(fake_model, monkeypatch):
+    encodings = [fake_model.encode_image(noise(i)) for i in range(3)]
+    lock = fake_model._inference_lock
+    acquisitions = []
+
+    class CountingLock:
+        def __enter__(self):
+            acquisitions.append(1)
+            return lock.__enter__()
+
+        def __exit__(self, *exc):
+            return lock.__exit__(*exc)
+
+    deadlines = []
+    generate = fake_model._generate_cancellable
+    monkeypatch.setattr(fake_model, "_inference_lock", CountingLock())
+    monkeypatch.setattr(
+        fake_model, "_generate_cancellable",
+        lambda enc, question, token: deadlines.append(token.remaining()) or generate(enc, question, token)
+    )
+    assert all(fake_model.answer_frames(encodings, "q"))
+    assert len(acquisitions) == 3
+    assert min(deadlines) > INFERENCE_REQUEST_TIMEOUT_SECONDS
+
+
+def test_encode_batch_returns_none_for_each_image_when_busy(fake_model):
+    fake_model.admission = AdmissionController(1)
+    images = [noise(0), noise(1)]
+    with fake_model.admission.admit():
+        assert fake_model.encode_batch(images) == [None, None]
+    assert all(fake_model.encode_batch(images))
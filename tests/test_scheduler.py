@@ -0,0 +1,58 @@
+import threading
+import pytest
+from model.admission import CancelToken, RequestCancelled
+from model.scheduler import InferenceScheduler
+
+
+def test_requests_are_batched_up_to_max_size():
+    batches = []
+    release = threading.Event()
+
+    def run_batch(requests, tokens):
+        release.wait(5)
+        batches.append(len(requests))
+        return [f"{payload}:{question}" for payload, question in requests]
+
+    scheduler = InferenceScheduler(run_batch, max_batch_size=3, max_wait_ms=200)
+    futures = [scheduler.submit(i, "q") for i in range(7)]
+    release.set()
+    assert [f.result(timeout=5) for f in futures] == [f"{i}:q" for i in range(7)]
+    assert max(batches) <= 3
+    assert sum(batches) == 7
+    assert len(batches) < 7
+
+
+def test_cancelled_request_is_dropped_before_the_batch():
+    seen = []
+
+    def run_batch(requests, tokens):
+        seen.extend(question for _, question in requests)
+        return ["ok"] * len(requests)
+
+    scheduler = InferenceScheduler(run_batch, max_batch_size=4, max_wait_ms=50)
+    cancelled = CancelToken()
+    cancelled.cancel()
+    dropped = scheduler.submit(None, "dropped", cancelled)
+    kept = scheduler.submit(None, "kept", CancelToken())
+    with pytest.raises(RequestCancelled):
+        dropped.result(timeout=5)
+    assert kept.result(timeout=5) == "ok"
+    assert seen == ["kept"]
+
+
+def test_short_batch_result_fails_unanswered_requests():
+    scheduler = InferenceScheduler(lambda requests, tokens: ["only one"], max_batch_size=2, max_wait_ms=200)
+    first = scheduler.submit(None, "a")
+    second = scheduler.submit(None, "b")
+    assert first.result(timeout=5) == "only one"
+    with pytest.raises(RuntimeError):
+        second.result(timeout=5)
+
+
+def test_batch_exception_fails_every_request():
+    def run_batch(requests, tokens):
+        raise ValueError("boom")
+
+    scheduler = InferenceScheduler(run_batch, max_batch_size=2, max_wait_ms=10)
+    with pytest.raises(ValueError):
+        scheduler.submit(None, "a").result(timeout=5)
@@ -0,0 +1,32 @@
+import pytest
+from PIL import Image
+import model.worker_pool as worker_pool
+from model.worker_pool import WorkerPoolClient
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Two 32x32 RGB segments do not fit, so sharing a second one evicts.
+    monkeypatch.setattr(worker_pool, "WORKER_SHM_BYTES", 4096)
+    client = WorkerPoolClient(num_workers=1)
+    yield client
+    client.shutdown()
+
+
+def test_pinned_segment_survives_eviction_until_unpinned(client):
+    client._share_image("a", Image.new("RGB", (32, 32), (255, 0, 0)))
+    client._share_image("b", Image.new("RGB", (32, 32), (0, 255, 0)))
+    assert set(client._images) == {"a", "b"}
+
+    client._unpin("a")
+    assert set(client._images) == {"b"}
+    client._unpin("b")
+    assert set(client._images) == {"b"}
+
+
+def test_unpinned_segment_is_evicted_by_the_next_share(client):
+    client._share_image("a", Image.new("RGB", (32, 32), (255, 0, 0)))
+    client._unpin("a")
+    client._share_image("b", Image.new("RGB", (32, 32), (0, 255, 0)))
+    assert set(client._images) == {"b"}
+    assert not client._pins["a"]
@@ -1,11 +1,19 @@
 
 import streamlit as st
 import os
+import threading
+import time
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from concurrent.futures import TimeoutError as FutureTimeout
 from datetime import datetime
 from ui.base_page import BasePage
-from services import ChatService, ImageService
-from config import PAGE_MAIN
+from services import ChatService, ImageService, InsightService, FrameService
+from config import PAGE_MAIN, STREAMING_ENABLED, MESSAGES_PAGE_SIZE, ANSWER_POLL_SECONDS, INSIGHTS_POLL_SECONDS
+from config import FRAME_ANSWER_TIMEOUT_SECONDS
 from model.model import Model
+from model.admission import CancelToken, ServerBusy
+from model.answer_cache import normalize_question
 
 class ChatPage(BasePage):
     
@@ -20,13 +28,14 @@ class ChatPage(BasePage):
         display_image = ChatPage._get_display_image(model)
         
         if display_image:
+            insights = ChatPage._get_insights()
             col1, col2 = st.columns([1, 3])
             
             with col1:
-                ChatPage._render_sidebar(display_image)
+                ChatPage._render_sidebar(display_image, insights)
             
             with col2:
-                ChatPage._render_chat_interface(model)
+                ChatPage._render_chat_interface(model, insights)
         
         ChatPage.apply_common_styles()
     
@@ -35,27 +44,78 @@ class ChatPage(BasePage):
         if 'uploaded_image' not in st.session_state:
             return None
         
-        if 'encoded_images_cache' not in st.session_state:
-            st.session_state.encoded_images_cache = {}
-        
-        image_path = st.session_state.current_chat_session.get('image_path')
+        session = st.session_state.current_chat_session
+        image_path = session.get('image_path')
         with st.spinner("Preparing the image, this may take some time..."):
+            if session.get('frames'):
+                ChatPage._frame_encodings(model, session)
+            if image_path:
+                ImageService.wait_for_write(image_path)
             if image_path and os.path.exists(image_path):
-                if image_path in st.session_state.encoded_images_cache:
-                    model.enc_image = st.session_state.encoded_images_cache[image_path]
-                else:
-                    model.encode_image(image_path)
-                    if model.enc_image is not None:
-                        st.session_state.encoded_images_cache[image_path] = model.enc_image
-                return ImageService.load_image(image_path)
+                if (st.session_state.get('image_encoding') is None
+                        or st.session_state.get('image_encoding_path') != image_path):
+                    st.session_state.image_encoding = model.encode_image(
+                        image_path,
+                        ImageService.content_hash_for_path(image_path)
+                    )
+                    st.session_state.image_encoding_path = image_path
+                return ImageService.load_display_image(image_path)
             else:
-                if model.enc_image is None:
-                    model.encode_image(st.session_state.uploaded_image)
+                if st.session_state.get('image_encoding') is None:
+                    st.session_state.image_encoding = model.encode_image(st.session_state.uploaded_image)
                 return st.session_state.uploaded_image
 
     @staticmethod
-    def _render_sidebar(display_image):
-        st.image(display_image, caption="Uploaded Image")
+    def _frame_encodings(model: Model, session):
+        """Encodings of the chat's frames, encoding any that are missing or failed before."""
+        frames = session['frames']
+        encodings = st.session_state.get('frame_encodings')
+        if st.session_state.get('frame_encodings_chat') != session['id'] or len(encodings or []) != len(frames):
+            encodings = [None] * len(frames)
+        missing = [i for i, encoding in enumerate(encodings) if encoding is None]
+        if missing:
+            paths = [frames[i]['image_path'] for i in missing]
+            for path in paths:
+                ImageService.wait_for_write(path)
+            encoded = model.encode_batch(paths, [ImageService.content_hash_for_path(path) for path in paths])
+            encodings = list(encodings)
+            for i, encoding in zip(missing, encoded):
+                encodings[i] = encoding
+            st.session_state.frame_encodings = encodings
+            st.session_state.frame_encodings_chat = session['id']
+        return encodings
+
+    @staticmethod
+    def _get_insights():
+        session = st.session_state.current_chat_session
+        if 'insights' not in session:
+            insights = ChatService.get_insights(session['id'])
+            if insights is not None:
+                session['insights'] = insights
+        return session.get('insights')
+
+    @staticmethod
+    def _render_sidebar(display_image, insights):
+        frames = st.session_state.current_chat_session.get('frames')
+        if frames:
+            images = [ImageService.load_display_image(frame['image_path']) for frame in frames]
+            st.image(
+                [image for image in images if image is not None],
+                caption=[frame['label'] for frame, image in zip(frames, images) if image is not None],
+                width=110
+            )
+        else:
+            st.image(display_image, caption="Uploaded Image")
+        
+        if insights:
+            if insights.get('caption'):
+                st.caption(insights['caption'])
+            if insights.get('objects'):
+                labels = [
+                    f"{obj['label']} ×{obj['count']}" if obj.get('count', 1) > 1 else obj['label']
+                    for obj in insights['objects']
+                ]
+                st.caption("Objects: " + ", ".join(labels))
         
         st.markdown("---")
         
@@ -65,26 +125,29 @@ class ChatPage(BasePage):
         st.markdown("### Recent Chats")
         st.caption("Showing the 10 most recent chats")
         
-        history = ChatService.load_history()
+        recent_chats = ChatService.session_summaries(10)
         
-        if history:
-            for i, chat in enumerate(reversed(history[-10:])):
-                chat_label = chat.get('chat_name', chat.get('image_name', 'Unnamed Chat')[:20])
+        if recent_chats:
+            for i, summary in enumerate(recent_chats):
+                chat_label = summary.get('chat_name', summary.get('image_name', 'Unnamed Chat')[:20])
         
                 if st.button(
                     chat_label, 
                     key=f"chat_{i}", 
                     use_container_width=True
                 ):
-                    st.session_state.current_chat_session = chat
-                    st.session_state.chat_messages = chat['messages']
+                    chat = ChatService.get_session(summary['id'])
+                    if chat is not None:
+                        st.session_state.current_chat_session = chat
+                        st.session_state.chat_messages = chat['messages']
+                        st.session_state.visible_messages = MESSAGES_PAGE_SIZE
                     st.rerun()
         else:
             st.info("No previous chats yet")
     
     
     @staticmethod
-    def _render_chat_interface(model: Model):
+    def _render_chat_interface(model: Model, insights):
 
         chat_name = st.session_state.current_chat_session.get('chat_name', 'Chat')
         timestamp = st.session_state.current_chat_session.get('timestamp', '')
@@ -107,12 +170,7 @@ class ChatPage(BasePage):
                     if st.button("✓", key="save_name", help="Save"):
                         if new_name.strip():
                             st.session_state.current_chat_session['chat_name'] = new_name.strip()
-                            history = ChatService.load_history()
-                            history = ChatService.update_or_append_session(
-                                history, 
-                                st.session_state.current_chat_session
-                            )
-                            ChatService.save_history(history)
+                            ChatService.save_session(st.session_state.current_chat_session)
                             st.session_state.editing_chat_name = False
                             st.rerun()
                 with col_cancel:
@@ -131,45 +189,158 @@ class ChatPage(BasePage):
         with col_time:
             st.markdown(f"<div style='text-align: right; padding-top: 10px;'>{timestamp}</div>", unsafe_allow_html=True)
         
-        if(len(st.session_state.chat_messages) > 0):
+        if len(st.session_state.chat_messages) > 0 or st.session_state.get('chat_prompt'):
             chat_height = 500
         else:
             chat_height = 1
         
-        with st.container(height=chat_height):
+        msgs_container = st.container(height=chat_height)
+        with msgs_container:
             ChatPage._render_msgs()
 
+        chat_id = st.session_state.current_chat_session['id']
+        if insights:
+            ChatPage._render_suggestions(model, insights)
+        elif InsightService.is_pending(chat_id):
+            ChatPage._wait_for_insights(chat_id)
+
         with st.container():
-            ChatPage._render_chat_input(model)
+            ChatPage._render_chat_input(model, msgs_container)
         
     @staticmethod
     def _render_msgs():
-        for msg in st.session_state.chat_messages:
+        messages = st.session_state.chat_messages
+        visible = st.session_state.get('visible_messages', MESSAGES_PAGE_SIZE)
+        hidden = len(messages) - visible
+        if hidden > 0:
+            if st.button(
+                f"Load older messages ({hidden} more)",
+                key="load_older_messages",
+                use_container_width=True
+            ):
+                st.session_state.visible_messages = visible + MESSAGES_PAGE_SIZE
+                st.rerun()
+            messages = messages[hidden:]
+        for msg in messages:
             with st.chat_message("user"):
                 st.write(msg['question'])
             with st.chat_message("assistant"):
                 st.write(msg['answer'])
     
     @staticmethod
-    def _render_chat_input(model: Model):
-        prompt = st.chat_input("Ask question about your image")
+    def _render_suggestions(model: Model, insights):
+        asked = {msg['question'] for msg in st.session_state.chat_messages}
+        suggestions = [s for s in insights.get('suggestions', []) if s['question'] not in asked]
+        if not suggestions:
+            return
+        columns = st.columns(len(suggestions))
+        for i, (column, suggestion) in enumerate(zip(columns, suggestions)):
+            with column:
+                if st.button(suggestion['question'], key=f"suggestion_{i}", use_container_width=True):
+                    ChatPage._save_precomputed(model, suggestion['question'], suggestion['answer'])
+
+    @staticmethod
+    @st.fragment(run_every=INSIGHTS_POLL_SECONDS)
+    def _wait_for_insights(chat_id: str):
+        if InsightService.is_pending(chat_id):
+            st.caption("Preparing a caption and suggested questions...")
+        else:
+            st.rerun()
+
+    @staticmethod
+    def _render_chat_input(model: Model, msgs_container):
+        prompt = st.chat_input("Ask question about your image", key="chat_prompt")
         if prompt:
-            ChatPage._handle_chat_input(prompt, model)
+            ChatPage._handle_chat_input(prompt, model, msgs_container)
 
     @staticmethod
-    def _handle_chat_input(prompt: str, model: Model):
-        with st.spinner("Thinking..."):
-            answer_model = model.get_answer(prompt)
+    def _handle_chat_input(prompt: str, model: Model, msgs_container):
+        insights = st.session_state.current_chat_session.get('insights') or {}
+        for suggestion in insights.get('suggestions', []):
+            if normalize_question(suggestion['question']) == normalize_question(prompt):
+                ChatPage._save_precomputed(model, prompt, suggestion['answer'])
+                return
+        encoding = st.session_state.get('image_encoding')
+        chat_id = st.session_state.current_chat_session.get('id')
+        frames = st.session_state.current_chat_session.get('frames')
+        token = CancelToken(FRAME_ANSWER_TIMEOUT_SECONDS) if frames else CancelToken()
+        ChatPage._cancel_on_disconnect(token)
+        frame_answers = None
+        try:
+            if frames:
+                with st.spinner("Looking at every frame..."):
+                    frame_answers = ChatPage._answer_frames(prompt, model, frames, token)
+                answer_model = FrameService.attribute_answers(frame_answers)
+            elif STREAMING_ENABLED:
+                with msgs_container:
+                    with st.chat_message("user"):
+                        st.write(prompt)
+                    with st.chat_message("assistant"):
+                        answer_model = st.write_stream(model.stream_answer(encoding, prompt, chat_id, token))
+                if not isinstance(answer_model, str) or not answer_model:
+                    answer_model = None
+            else:
+                with st.spinner("Thinking..."):
+                    answer_model = ChatPage._wait_for_answer(model.submit_answer(encoding, prompt, chat_id, token))
+        except ServerBusy:
+            st.warning("The server is busy answering other questions. Please try again in a moment.")
+            return
+        finally:
+            # A rerun stops this script inside an st call; the generation
+            # behind it is abandoned with it.
+            token.cancel()
         if answer_model is not None:
             answer = answer_model
         else:
             answer = "There is an error. Please be sure the image is uploaded correctly."
-       
+        ChatPage._save_message(prompt, answer, frame_answers)
+
+    @staticmethod
+    def _cancel_on_disconnect(token: CancelToken) -> None:
+        # Streamlit only interrupts a run on rerun: a closed tab leaves it
+        # running to the end, so the session's connection is watched instead.
+        ctx = get_script_run_ctx()
+        if ctx is None or not runtime.exists():
+            return
+        session_id, instance = ctx.session_id, runtime.get_instance()
+
+        def watch():
+            while not token.cancelled:
+                if not instance.is_active_session(session_id):
+                    token.cancel()
+                    return
+                time.sleep(ANSWER_POLL_SECONDS)
+
+        threading.Thread(target=watch, name="disconnect-watch", daemon=True).start()
+
+    @staticmethod
+    def _answer_frames(prompt: str, model: Model, frames, token: CancelToken):
+        # The frame set is one request, so a question about a clip takes a
+        # single admission slot however many frames it has.
+        encodings = ChatPage._frame_encodings(model, st.session_state.current_chat_session)
+        answers = ChatPage._wait_for_answer(model.submit_answer_frames(encodings, prompt, token))
+        return [
+            {'label': frame['label'], 'answer': answer}
+            for frame, answer in zip(frames, answers)
+        ]
+
+    @staticmethod
+    def _save_precomputed(model: Model, prompt: str, answer: str):
+        # Answered when the chat was created, so there is no generation; the
+        # turn is queued to join the chat's context with its next question.
+        chat_id = st.session_state.current_chat_session.get('id')
+        model.record_turn(chat_id, st.session_state.get('image_encoding'), prompt, answer)
+        ChatPage._save_message(prompt, answer)
+
+    @staticmethod
+    def _save_message(prompt: str, answer: str, frame_answers=None):
         message = {
             'question': prompt,
             'answer': answer,
             'timestamp': datetime.now().strftime('%H:%M:%S')
         }
+        if frame_answers is not None:
+            message['frames'] = frame_answers
         if not st.session_state.chat_messages or st.session_state.chat_messages[-1]['question'] != prompt:
             st.session_state.chat_messages.append(message)
             
@@ -180,28 +351,44 @@ class ChatPage(BasePage):
             
             current_name = st.session_state.current_chat_session.get('chat_name', '')
             if len(st.session_state.chat_messages) == 1 or current_name.startswith('New Chat - '):
-                history = ChatService.load_history()
+                history = ChatService.session_summaries()
                 new_name = ChatService.generate_chat_name(
                     st.session_state.current_chat_session, 
                     history
                 )
                 st.session_state.current_chat_session['chat_name'] = new_name
             
-            history = ChatService.load_history()
-            history = ChatService.update_or_append_session(
-                history, 
-                st.session_state.current_chat_session
-            )
-            ChatService.save_history(history)
+            ChatService.save_session(st.session_state.current_chat_session)
         
         st.rerun()
     
+    @staticmethod
+    def _wait_for_answer(future):
+        # Updating an element every poll gives Streamlit a point to interrupt
+        # this run when the session reruns.
+        status = st.empty()
+        started = time.monotonic()
+        while True:
+            try:
+                return future.result(timeout=ANSWER_POLL_SECONDS)
+            except FutureTimeout:
+                status.caption(f"Thinking... {int(time.monotonic() - started)}s")
+    
     @staticmethod
     def _handle_back_navigation():
         if 'current_chat_session' in st.session_state:
             del st.session_state.current_chat_session
         if 'chat_messages' in st.session_state:
             del st.session_state.chat_messages
+        if 'visible_messages' in st.session_state:
+            del st.session_state.visible_messages
+        if 'image_encoding' in st.session_state:
+            del st.session_state.image_encoding
+        if 'image_encoding_path' in st.session_state:
+            del st.session_state.image_encoding_path
+        if 'frame_encodings' in st.session_state:
+            del st.session_state.frame_encodings
+            del st.session_state.frame_encodings_chat
         
         st.session_state.page = PAGE_MAIN
         st.rerun()
@@ -2,14 +2,16 @@ import streamlit as st
 import os
 from PIL import Image
 from ui.base_page import BasePage
-from services import ChatService, ImageService
-from config import SUPPORTED_IMAGE_TYPES, PAGE_CHAT
+from services import ChatService, ImageService, InsightService, FrameService
+from services.frame_service import FrameDecodeError
+from config import SUPPORTED_IMAGE_TYPES, SUPPORTED_VIDEO_TYPES, PAGE_CHAT, PREFETCH_ENABLED, MESSAGES_PAGE_SIZE
+from model.model import Model
 
 
 class MainPage(BasePage):
     
     @staticmethod
-    def render():
+    def render(model: Model):
         st.write("# ChatMoonVLM")
         st.markdown("### Your AI-powered image chat assistant")
         
@@ -17,23 +19,41 @@ class MainPage(BasePage):
         
         with col_upload:
             st.markdown("### Start New Chat")
-            st.markdown("Upload an image to begin a conversation")
+            st.markdown("Upload an image, a video or a set of images to begin a conversation")
             
-            image_file = st.file_uploader(
+            uploads = st.file_uploader(
                 "Choose an image", 
-                type=SUPPORTED_IMAGE_TYPES,
+                type=SUPPORTED_IMAGE_TYPES + SUPPORTED_VIDEO_TYPES,
+                accept_multiple_files=True,
                 label_visibility="collapsed"
-            )
+            ) or []
+            single_image = len(uploads) == 1 and not FrameService.is_video(uploads[0].name)
+            image_file = uploads[0] if single_image else None
             
-            if image_file is not None:
-                image = Image.open(image_file)
+            if image_file is None:
+                MainPage._cancel_prefetch(model)
+                if uploads:
+                    MainPage._render_frames_upload(model, uploads)
+            else:
+                if st.session_state.get('preprocessed_upload_id') != image_file.file_id:
+                    MainPage._cancel_prefetch(model)
+                    image = ImageService.preprocess(Image.open(image_file))
+                    st.session_state.preprocessed_upload = image
+                    st.session_state.preprocessed_upload_id = image_file.file_id
+                    st.session_state.preprocessed_upload_hash = ImageService.content_hash(image)
+                    if PREFETCH_ENABLED:
+                        st.session_state.prefetch_future = model.prefetch_encoding(
+                            image,
+                            st.session_state.preprocessed_upload_hash
+                        )
+                image = st.session_state.preprocessed_upload
                 col1, col2, col3 = st.columns([1, 3, 1])
                 with col2:
                     st.image(image, caption="Selected Image")
                     new_chat_button = st.button("Start New Chat", use_container_width=True)
                 
                 if new_chat_button:
-                    history = ChatService.load_history()
+                    history = ChatService.session_summaries()
                     
                     image_name = image_file.name
                     new_chat_session = ChatService.create_session(image_name)
@@ -42,15 +62,21 @@ class MainPage(BasePage):
                     new_chat_session['chat_name'] = chat_name
                     
                     chat_id = new_chat_session['id']
-                    ImageService.save_image(image, chat_id)
+                    new_chat_session['image_path'] = ImageService.save_image(
+                        image,
+                        chat_id,
+                        st.session_state.preprocessed_upload_hash
+                    )
                     
-                    history.append(new_chat_session)
-                    ChatService.save_history(history)
+                    ChatService.save_session(new_chat_session)
+                    InsightService.start(model, chat_id, image, st.session_state.preprocessed_upload_hash)
                     
                     st.session_state.uploaded_image = image
                     st.session_state.uploaded_image_file = image_file
                     st.session_state.current_chat_session = new_chat_session
                     st.session_state.chat_messages = []
+                    st.session_state.visible_messages = MESSAGES_PAGE_SIZE
+                    st.session_state.prefetch_future = None
                     st.session_state.page = PAGE_CHAT
                     st.rerun()
         
@@ -58,11 +84,11 @@ class MainPage(BasePage):
             st.markdown("### Recent Chats")
             st.caption("Showing the 10 most recent chats")
             
-            history = ChatService.load_history()
+            recent_chats = ChatService.session_summaries(10)
             
-            if history:
-                for i, chat in enumerate(reversed(history[-10:])):
-                    chat_label = chat.get('chat_name', chat.get('image_name', 'Unnamed Chat')[:25])
+            if recent_chats:
+                for i, summary in enumerate(recent_chats):
+                    chat_label = summary.get('chat_name', summary.get('image_name', 'Unnamed Chat')[:25])
                     
                     with st.container():
                         if st.button(
@@ -70,8 +96,12 @@ class MainPage(BasePage):
                             key=f"chat_history_{i}", 
                             use_container_width=True
                         ):
+                            chat = ChatService.get_session(summary['id'])
+                            if chat is None:
+                                st.rerun()
                             st.session_state.current_chat_session = chat
                             st.session_state.chat_messages = chat['messages']
+                            st.session_state.visible_messages = MESSAGES_PAGE_SIZE
                             
                             if 'image_path' in chat and os.path.exists(chat['image_path']):
                                 loaded_image = ImageService.load_image(chat['image_path'])
@@ -83,4 +113,58 @@ class MainPage(BasePage):
             else:
                 st.info("No previous chats yet. Start a new chat by uploading an image!")
         
-        MainPage.apply_common_styles()
\ No newline at end of file
+        MainPage.apply_common_styles()
+
+    @staticmethod
+    def _render_frames_upload(model: Model, uploads):
+        col1, col2, col3 = st.columns([1, 3, 1])
+        with col2:
+            if len(uploads) == 1 and not uploads[0].name.lower().endswith('.gif'):
+                st.video(uploads[0])
+            else:
+                st.image(uploads[:8], width=120)
+            st.caption(f"{len(uploads)} file(s); frames are sampled and near-duplicates skipped")
+            new_chat_button = st.button("Start New Chat", key="start_frames_chat", use_container_width=True)
+        
+        if not new_chat_button:
+            return
+        
+        history = ChatService.session_summaries()
+        new_chat_session = ChatService.create_session(uploads[0].name)
+        new_chat_session['chat_name'] = ChatService.generate_chat_name(new_chat_session, history)
+        
+        with st.spinner("Extracting and encoding frames..."):
+            for upload in uploads:
+                upload.seek(0)
+            try:
+                frames, encodings = FrameService.ingest(
+                    model,
+                    FrameService.open_frames(uploads),
+                    new_chat_session['id']
+                )
+            except FrameDecodeError as e:
+                ImageService.release_image(new_chat_session['id'])
+                st.error(str(e))
+                return
+        if not frames:
+            st.error("No frames could be read from the upload.")
+            return
+        
+        new_chat_session['frames'] = frames
+        new_chat_session['image_path'] = frames[0]['image_path']
+        ChatService.save_session(new_chat_session)
+        
+        st.session_state.uploaded_image = ImageService.load_image(frames[0]['image_path'])
+        st.session_state.current_chat_session = new_chat_session
+        st.session_state.chat_messages = []
+        st.session_state.visible_messages = MESSAGES_PAGE_SIZE
+        st.session_state.frame_encodings = encodings
+        st.session_state.frame_encodings_chat = new_chat_session['id']
+        st.session_state.page = PAGE_CHAT
+        st.rerun()
+
+    @staticmethod
+    def _cancel_prefetch(model: Model):
+        model.cancel_prefetch(st.session_state.get('prefetch_future'))
+        st.session_state.prefetch_future = None
+        st.session_state.preprocessed_upload_id = None